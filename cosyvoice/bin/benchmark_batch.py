@@ -0,0 +1,96 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice3
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare offline inference_batch throughput against one request after another')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='prompt text')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='asset/zero_shot_prompt.wav',
+                        help='prompt wav')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=32,
+                        help='number of requests')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=16,
+                        help='inference_batch batch size')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    prompt_text = args.prompt_text
+    if isinstance(cosyvoice, CosyVoice3) and '<|endofprompt|>' not in prompt_text:
+        prompt_text = 'You are a helpful assistant.<|endofprompt|>' + prompt_text
+    # NOTE sentences of different length, so that bucketing matters
+    sentences = ['收到好友从远方寄来的生日礼物。',
+                 '那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                 '八百标兵奔北坡，北坡炮兵并排跑，炮兵怕把标兵碰，标兵怕碰炮兵炮。',
+                 '今天天气不错。']
+    requests = [{'mode': 'zero_shot', 'tts_text': sentences[i % len(sentences)], 'prompt_text': prompt_text, 'prompt_wav': args.prompt_wav}
+                for i in range(args.num_requests)]
+    # warmup
+    cosyvoice.inference_batch(requests[:2], batch_size=2)
+    list(cosyvoice.inference_zero_shot(requests[0]['tts_text'], prompt_text, args.prompt_wav))
+
+    start_time = time.time()
+    speech_len = 0
+    for request in requests:
+        for model_output in cosyvoice.inference_zero_shot(request['tts_text'], prompt_text, args.prompt_wav):
+            speech_len += model_output['tts_speech'].shape[1] / cosyvoice.sample_rate
+    sequential_cost = time.time() - start_time
+    logging.info('sequential: {} requests, {:.1f}s speech in {:.1f}s, rtf {:.3f}'.format(len(requests), speech_len, sequential_cost, sequential_cost / speech_len))
+
+    start_time = time.time()
+    outputs = cosyvoice.inference_batch(requests, batch_size=args.batch_size)
+    batch_cost = time.time() - start_time
+    speech_len = sum(output['tts_speech'].shape[1] for output in outputs) / cosyvoice.sample_rate
+    logging.info('inference_batch: {} requests, {:.1f}s speech in {:.1f}s, rtf {:.3f}, speedup {:.2f}x'.format(
+                 len(requests), speech_len, batch_cost, batch_cost / speech_len, sequential_cost / batch_cost))
+
+
+if __name__ == "__main__":
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,138 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+import torchaudio
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice3
+from cosyvoice.cli.model import CosyVoice2Model
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='quality/speed table of flow inference_cfg_interval')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--cfg_intervals',
+                        type=str,
+                        default='0.0-1.0,0.0-0.6,0.0-0.3,0.2-0.8,1.0-1.0',
+                        help='comma separated t_start-t_end, 0.0-1.0 is cfg on all steps')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesis')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='prompt text')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='asset/zero_shot_prompt.wav',
+                        help='prompt wav')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='number of timed runs')
+    parser.add_argument('--result_dir',
+                        type=str,
+                        default='',
+                        help='save wav of each interval for listening test if set')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def flow_mel(cosyvoice, model_input, token):
+    device = cosyvoice.model.device
+    kwargs = {'token': token.to(device), 'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+              'prompt_token': model_input['flow_prompt_speech_token'].to(device), 'prompt_token_len': model_input['flow_prompt_speech_token_len'].to(device),
+              'prompt_feat': model_input['prompt_speech_feat'].to(device), 'prompt_feat_len': model_input['prompt_speech_feat_len'].to(device),
+              'embedding': model_input['flow_embedding'].to(device)}
+    if isinstance(cosyvoice.model, CosyVoice2Model):
+        kwargs.update({'streaming': False, 'finalize': True})
+    else:
+        kwargs['flow_cache'] = torch.zeros(1, 80, 0, 2)
+    # NOTE CosyVoice flow samples its initial noise from the global generator
+    torch.manual_seed(0)
+    mel = cosyvoice.model.flow.inference(**kwargs)[0]
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return mel
+
+
+@torch.inference_mode()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    prompt_text = args.prompt_text
+    if isinstance(cosyvoice, CosyVoice3) and '<|endofprompt|>' not in prompt_text:
+        prompt_text = 'You are a helpful assistant.<|endofprompt|>' + prompt_text
+    model_input = cosyvoice.frontend.frontend_zero_shot(cosyvoice.frontend.text_normalize(args.tts_text, split=False),
+                                                        cosyvoice.frontend.text_normalize(prompt_text, split=False),
+                                                        args.prompt_wav, cosyvoice.sample_rate, '')
+    device = cosyvoice.model.device
+    token = torch.tensor([list(cosyvoice.model.llm.inference(text=model_input['text'].to(device),
+                                                             text_len=model_input['text_len'].to(device),
+                                                             prompt_text=model_input['prompt_text'].to(device),
+                                                             prompt_text_len=model_input['prompt_text_len'].to(device),
+                                                             prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                                             prompt_speech_token_len=model_input['llm_prompt_speech_token_len'].to(device),
+                                                             embedding=model_input['llm_embedding'].to(device)))], dtype=torch.int32)
+
+    # NOTE flow inference runs 10 euler steps with the same t_span as ConditionalCFM.forward
+    decoder, n_timesteps = cosyvoice.model.flow.decoder, 10
+    t_span = torch.linspace(0, 1, n_timesteps + 1)
+    if decoder.t_scheduler == 'cosine':
+        t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+    table, mel_ref = [], None
+    for cfg_interval in args.cfg_intervals.split(','):
+        decoder.inference_cfg_interval = [float(i) for i in cfg_interval.split('-')]
+        cfg_steps = sum(decoder.get_cfg_steps(t_span))
+        mel = flow_mel(cosyvoice, model_input, token)
+        start_time = time.time()
+        for _ in range(args.num_runs):
+            flow_mel(cosyvoice, model_input, token)
+        cost = (time.time() - start_time) / args.num_runs
+        # NOTE the first interval is the reference, keep 0.0-1.0 first to compare against full cfg
+        mel_ref = mel if mel_ref is None else mel_ref
+        table.append((cfg_interval, cfg_steps, n_timesteps + cfg_steps, cost, (mel - mel_ref).abs().mean().item()))
+        if args.result_dir != '':
+            os.makedirs(args.result_dir, exist_ok=True)
+            speech = cosyvoice.model.hift.inference(speech_feat=mel)[0]
+            torchaudio.save('{}/cfg_{}.wav'.format(args.result_dir, cfg_interval), speech.cpu(), cosyvoice.sample_rate)
+
+    logging.info('{} tokens, reference mel mean abs {:.4f}'.format(token.shape[1], mel_ref.abs().mean().item()))
+    print('| cfg interval | cfg steps | estimator rows | flow time (s) | speedup | mel l1 |')
+    print('|---|---|---|---|---|---|')
+    for cfg_interval, cfg_steps, rows, cost, l1 in table:
+        print('| {} | {} | {} | {:.3f} | {:.2f}x | {:.4f} |'.format(cfg_interval, cfg_steps, rows, cost, table[0][3] / cost, l1))
+
+
+if __name__ == "__main__":
+    main()
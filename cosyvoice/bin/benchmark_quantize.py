@@ -0,0 +1,141 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice3
+from cosyvoice.cli.model import CosyVoice2Model
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare quantized cpu inference against fp32')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--quantize',
+                        type=str,
+                        default='int8',
+                        help='quantize mode')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesis')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='prompt text')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='asset/zero_shot_prompt.wav',
+                        help='prompt wav')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='number of timed runs')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def get_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def get_module_mb(module):
+    # NOTE dynamic quantized Linear keeps its int8 weight and bias in a packed params tuple inside state_dict
+    def size(v):
+        if isinstance(v, torch.Tensor):
+            return v.numel() * v.element_size()
+        if isinstance(v, (tuple, list)):
+            return sum(size(i) for i in v)
+        return 0
+    return sum(size(v) for v in module.state_dict().values()) / 1024 / 1024
+
+
+def flow_mel(cosyvoice, model_input, token):
+    kwargs = {'token': token, 'token_len': torch.tensor([token.shape[1]], dtype=torch.int32),
+              'prompt_token': model_input['flow_prompt_speech_token'], 'prompt_token_len': model_input['flow_prompt_speech_token_len'],
+              'prompt_feat': model_input['prompt_speech_feat'], 'prompt_feat_len': model_input['prompt_speech_feat_len'],
+              'embedding': model_input['flow_embedding']}
+    if isinstance(cosyvoice.model, CosyVoice2Model):
+        kwargs.update({'streaming': False, 'finalize': True})
+    else:
+        kwargs['flow_cache'] = torch.zeros(1, 80, 0, 2)
+    # NOTE CosyVoice flow samples its initial noise from the global generator
+    torch.manual_seed(0)
+    return cosyvoice.model.flow.inference(**kwargs)[0]
+
+
+@torch.inference_mode()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    models, rss = {}, get_rss_mb()
+    for name, quantize in [('fp32', None), (args.quantize, args.quantize)]:
+        models[name] = AutoModel(model_dir=args.model_dir, quantize=quantize)
+        rss, rss_delta = get_rss_mb(), get_rss_mb() - rss
+        logging.info('{} llm {:.1f}MB flow {:.1f}MB, process rss grows {:.1f}MB after loading'.format(
+                     name, get_module_mb(models[name].model.llm), get_module_mb(models[name].model.flow), rss_delta))
+    prompt_text = args.prompt_text
+    if isinstance(models['fp32'], CosyVoice3) and '<|endofprompt|>' not in prompt_text:
+        prompt_text = 'You are a helpful assistant.<|endofprompt|>' + prompt_text
+
+    # 1. rtf of the whole zero shot pipeline
+    for name, cosyvoice in models.items():
+        list(cosyvoice.inference_zero_shot(args.tts_text, prompt_text, args.prompt_wav))
+        cost, speech_len = 0, 0
+        for _ in range(args.num_runs):
+            start_time = time.time()
+            for model_output in cosyvoice.inference_zero_shot(args.tts_text, prompt_text, args.prompt_wav):
+                speech_len += model_output['tts_speech'].shape[1] / cosyvoice.sample_rate
+            cost += time.time() - start_time
+        logging.info('{} rtf {:.3f}'.format(name, cost / speech_len))
+
+    # 2. mel l1 of quantized flow against fp32 flow, both conditioned on the same fp32 llm tokens
+    cosyvoice = models['fp32']
+    model_input = cosyvoice.frontend.frontend_zero_shot(cosyvoice.frontend.text_normalize(args.tts_text, split=False),
+                                                        cosyvoice.frontend.text_normalize(prompt_text, split=False),
+                                                        args.prompt_wav, cosyvoice.sample_rate, '')
+    token = torch.tensor([list(cosyvoice.model.llm.inference(text=model_input['text'],
+                                                             text_len=model_input['text_len'],
+                                                             prompt_text=model_input['prompt_text'],
+                                                             prompt_text_len=model_input['prompt_text_len'],
+                                                             prompt_speech_token=model_input['llm_prompt_speech_token'],
+                                                             prompt_speech_token_len=model_input['llm_prompt_speech_token_len'],
+                                                             embedding=model_input['llm_embedding']))], dtype=torch.int32)
+    mel_fp32 = flow_mel(models['fp32'], model_input, token)
+    mel_quantize = flow_mel(models[args.quantize], model_input, token)
+    logging.info('{} tokens, mel l1 {:.4f}, fp32 mel mean abs {:.4f}'.format(token.shape[1], (mel_fp32 - mel_quantize).abs().mean().item(), mel_fp32.abs().mean().item()))
+
+
+if __name__ == "__main__":
+    main()
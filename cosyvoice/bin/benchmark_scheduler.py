@@ -0,0 +1,140 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import threading
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from hyperpyyaml import load_hyperpyyaml
+from cosyvoice.cli.scheduler import FlowBatchScheduler, LLMBatchScheduler
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='throughput and latency of concurrent sessions with and without cross request batching')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path of a CosyVoice2 model')
+    parser.add_argument('--mode',
+                        type=str,
+                        default='flow',
+                        choices=['flow', 'llm'],
+                        help='benchmark flow decoder batching or llm continuous batching')
+    parser.add_argument('--concurrency',
+                        type=str,
+                        default='1,4,16',
+                        help='comma separated number of concurrent sessions')
+    parser.add_argument('--max_batch_size',
+                        type=int,
+                        default=16,
+                        help='max batch size of the scheduler')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def run_sessions(session, concurrency):
+    threads = [threading.Thread(target=session) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def benchmark_flow(flow, args, device):
+    scheduler = FlowBatchScheduler(flow, max_batch_size=args.max_batch_size, batch_window=0.01)
+
+    def make_input(token_len):
+        return {'token': torch.randint(0, 6561, (1, token_len), device=device), 'token_len': torch.tensor([token_len], device=device),
+                'prompt_token': torch.randint(0, 6561, (1, 50), device=device), 'prompt_token_len': torch.tensor([50], device=device),
+                'prompt_feat': torch.rand(1, 100, 80, device=device), 'prompt_feat_len': torch.tensor([100], device=device),
+                'embedding': torch.rand(1, 192, device=device), 'streaming': False, 'finalize': True}
+
+    # NOTE batched result should match unbatched result
+    inputs = [make_input(token_len) for token_len in [100, 150, 200]]
+    results = [None] * len(inputs)
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, scheduler.inference(**inputs[i])[0])) for i in range(len(inputs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i in range(len(inputs)):
+        logging.info('token_len {} max diff {}'.format(inputs[i]['token_len'].item(), (flow.inference(**inputs[i])[0] - results[i]).abs().max().item()))
+
+    for concurrency in [int(i) for i in args.concurrency.split(',')]:
+        for name, model in [('unbatched', flow), ('batched', scheduler)]:
+            latency = []
+
+            def session(model=model, latency=latency):
+                for _ in range(4):
+                    start_time = time.time()
+                    model.inference(**make_input(150))
+                    latency.append(time.time() - start_time)
+            start_time = time.time()
+            run_sessions(session, concurrency)
+            throughput = len(latency) / (time.time() - start_time)
+            logging.info('concurrency {} {}: throughput {:.2f} req/s, p95 latency {:.3f} s'.format(concurrency, name, throughput, np.percentile(latency, 95)))
+
+
+def benchmark_llm(llm, args, device):
+    for concurrency in [int(i) for i in args.concurrency.split(',')]:
+        for name, batch_scheduler in [('unbatched', None), ('batched', LLMBatchScheduler(llm, max_batch_size=args.max_batch_size))]:
+            if batch_scheduler is not None:
+                llm.batch_scheduler = batch_scheduler
+            elif hasattr(llm, 'batch_scheduler'):
+                del llm.batch_scheduler
+            token_num = []
+
+            def session(token_num=token_num):
+                lm_input = torch.rand(1, 100, llm.llm_input_size, device=device)
+                token_num.append(len(list(llm.inference_wrapper(lm_input, 25, 200, 200, ''))))
+            start_time = time.time()
+            run_sessions(session, concurrency)
+            logging.info('concurrency {} {}: throughput {:.1f} token/s'.format(concurrency, name, sum(token_num) / (time.time() - start_time)))
+    # NOTE the daemon batch thread still evicts finished requests after their last token, exiting inside torch aborts the interpreter
+    time.sleep(1)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # NOTE only build the module under test
+    overrides = {'qwen_pretrain_path': os.path.join(args.model_dir, 'CosyVoice-BlankEN'), 'hift': None, 'llm' if args.mode == 'flow' else 'flow': None}
+    with open('{}/cosyvoice2.yaml'.format(args.model_dir), 'r') as f:
+        configs = load_hyperpyyaml(f, overrides=overrides)
+    module = configs[args.mode]
+    module.load_state_dict(torch.load('{}/{}.pt'.format(args.model_dir, args.mode), map_location=device, weights_only=True), strict=True)
+    with torch.no_grad():
+        if args.mode == 'flow':
+            benchmark_flow(module.to(device).eval(), args, device)
+        else:
+            benchmark_llm(module.to(device).eval(), args, device)
+
+
+if __name__ == "__main__":
+    main()
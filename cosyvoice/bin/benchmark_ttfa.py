@@ -0,0 +1,122 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from hyperpyyaml import load_hyperpyyaml
+from cosyvoice.cli.model import CosyVoice2Model
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='time to first audio of streaming tts with random weights, llm is replaced by a fixed rate token emitter')
+    parser.add_argument('--config',
+                        type=str,
+                        default='{}/../../examples/libritts/cosyvoice2/conf/cosyvoice2.yaml'.format(ROOT_DIR),
+                        help='cosyvoice2 config')
+    parser.add_argument('--token_rate',
+                        type=int,
+                        default=50,
+                        help='llm tokens per second')
+    parser.add_argument('--token_num',
+                        type=int,
+                        default=200,
+                        help='llm tokens per request')
+    parser.add_argument('--prompt_token_len',
+                        type=int,
+                        default=50,
+                        help='prompt speech token length')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=5,
+                        help='number of timed runs')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+class FixedRateLM(torch.nn.Module):
+    def __init__(self, token_rate=50, token_num=200):
+        super().__init__()
+        self.token_rate, self.token_num = token_rate, token_num
+        self.emit_time = []
+
+    def inference(self, **kwargs):
+        self.emit_time = []
+        for _ in range(self.token_num):
+            time.sleep(1 / self.token_rate)
+            self.emit_time.append(time.time())
+            yield int(torch.randint(0, 6561, (1,)))
+
+
+def main():
+    # NOTE handoff = token2wav start time - time when the last required token is emitted
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.config, 'r') as f:
+        configs = load_hyperpyyaml(f, overrides={'llm': None})
+    model = CosyVoice2Model(FixedRateLM(args.token_rate, args.token_num), configs['flow'], configs['hift'])
+    model.flow.to(model.device).eval()
+    model.hift.to(model.device).eval()
+    token2wav, token2wav_start = model.token2wav, []
+
+    def timed_token2wav(*args, **kwargs):
+        token2wav_start.append(time.time())
+        return token2wav(*args, **kwargs)
+    model.token2wav = timed_token2wav
+    first_chunk_token_num = model.token_hop_len + model.flow.pre_lookahead_len
+    ttfa, handoff = [], []
+    with torch.no_grad():
+        for _ in range(args.num_runs):
+            token2wav_start.clear()
+            start_time = time.time()
+            for i, _ in enumerate(model.tts(text=torch.zeros(1, 10, dtype=torch.int32),
+                                            flow_embedding=torch.rand(1, 192),
+                                            llm_embedding=torch.rand(1, 192),
+                                            flow_prompt_speech_token=torch.randint(0, 6561, (1, args.prompt_token_len), dtype=torch.int32),
+                                            prompt_speech_feat=torch.rand(1, args.prompt_token_len * 2, 80),
+                                            stream=True)):
+                if i == 0:
+                    ttfa.append(time.time() - start_time)
+                    handoff.append(token2wav_start[0] - model.llm.emit_time[first_chunk_token_num - 1])
+    logging.info('ttfa {:.1f} ms, token handoff {:.2f} ms (up to 100 ms with sleep polling)'.format(np.mean(ttfa) * 1000, np.mean(handoff) * 1000))
+
+    # NOTE CosyVoice.inference_* calls tts outside inference mode, while flow and hift return inference tensors,
+    # so the crossfade of every chunk after the first one must not write into them
+    chunks = [model_output['tts_speech'] for model_output in model.tts(text=torch.zeros(1, 10, dtype=torch.int32),
+                                                                       flow_embedding=torch.rand(1, 192),
+                                                                       llm_embedding=torch.rand(1, 192),
+                                                                       flow_prompt_speech_token=torch.randint(0, 6561, (1, args.prompt_token_len), dtype=torch.int32),
+                                                                       prompt_speech_feat=torch.rand(1, args.prompt_token_len * 2, 80),
+                                                                       stream=True)]
+    assert len(chunks) > 2, 'streaming check needs at least 3 chunks, increase token_num'
+    assert all(torch.isfinite(chunk).all() for chunk in chunks), 'streaming check got non finite speech'
+    logging.info('streaming check passed, {} chunks outside inference mode'.format(len(chunks)))
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,25 @@ def get_dummy_input(batch_size, seq_len, out_channels, device):
     return x, mask, mu, t, spks, cond
 
 
+def get_dummy_hift_input(hift, seq_len, device):
+    mel = torch.rand((1, hift.conv_pre.in_channels, seq_len), dtype=torch.float32, device=device)
+    s = torch.rand((1, 1, int(seq_len * hift.f0_upsamp.scale_factor)), dtype=torch.float32, device=device) * 0.2 - 0.1
+    x = hift.conv_pre(mel)
+    s_stft = torch.cat(hift._stft(s.squeeze(1)), dim=1)
+    return x, s_stft
+
+
+class HiFTDecoder(torch.nn.Module):
+    """conv_pre output and source stft -> conv_post output, see HiFTGenerator.forward_decoder"""
+
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, x, s_stft):
+        return self.hift.forward_decoder(x, s_stft)
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='export your model for deployment')
     parser.add_argument('--model_dir',
@@ -78,11 +97,13 @@ def main():
         input_names=['x', 'mask', 'mu', 't', 'spks', 'cond'],
         output_names=['estimator_out'],
         dynamic_axes={
-            'x': {2: 'seq_len'},
-            'mask': {2: 'seq_len'},
-            'mu': {2: 'seq_len'},
-            'cond': {2: 'seq_len'},
-            'estimator_out': {2: 'seq_len'},
+            'x': {0: 'batch_size', 2: 'seq_len'},
+            'mask': {0: 'batch_size', 2: 'seq_len'},
+            'mu': {0: 'batch_size', 2: 'seq_len'},
+            't': {0: 'batch_size'},
+            'spks': {0: 'batch_size'},
+            'cond': {0: 'batch_size', 2: 'seq_len'},
+            'estimator_out': {0: 'batch_size', 2: 'seq_len'},
         }
     )
 
@@ -95,7 +116,8 @@ def main():
                                                   sess_options=option, providers=providers)
 
     for _ in tqdm(range(10)):
-        x, mask, mu, t, spks, cond = get_dummy_input(batch_size, random.randint(16, 512), out_channels, device)
+        # NOTE batch 1 is used by the steps outside inference_cfg_interval
+        x, mask, mu, t, spks, cond = get_dummy_input(random.randint(1, batch_size), random.randint(16, 512), out_channels, device)
         output_pytorch = estimator(x, mask, mu, t, spks, cond)
         ort_inputs = {
             'x': x.cpu().numpy(),
@@ -109,6 +131,37 @@ def main():
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
     logging.info('successfully export estimator')
 
+    # 3. export hift decoder, used by load_onnx together with the estimator
+    hift = model.model.hift
+    hift.eval()
+    hift.onnx_decoder = None
+    x, s_stft = get_dummy_hift_input(hift, 256, device)
+    torch.onnx.export(
+        HiFTDecoder(hift),
+        (x, s_stft),
+        '{}/hift.decoder.fp32.onnx'.format(args.model_dir),
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 's_stft'],
+        output_names=['decoder_out'],
+        dynamic_axes={
+            'x': {2: 'seq_len'},
+            's_stft': {2: 'source_len'},
+            'decoder_out': {2: 'out_len'},
+        }
+    )
+
+    # 4. test computation consistency
+    hift_onnx = onnxruntime.InferenceSession('{}/hift.decoder.fp32.onnx'.format(args.model_dir),
+                                             sess_options=option, providers=['CPUExecutionProvider'])
+    for _ in tqdm(range(10)):
+        x, s_stft = get_dummy_hift_input(hift, random.randint(16, 512), device)
+        output_pytorch = hift.forward_decoder(x, s_stft)
+        output_onnx = hift_onnx.run(None, {'x': x.cpu().numpy(), 's_stft': s_stft.cpu().numpy()})[0]
+        torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
+    logging.info('successfully export hift decoder')
+
 
 if __name__ == "__main__":
     main()
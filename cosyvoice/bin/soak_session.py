@@ -0,0 +1,122 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import threading
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice3
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='cancel streaming tts after the first chunks many times and check that memory stays flat')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesis')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='prompt text')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='asset/zero_shot_prompt.wav',
+                        help='prompt wav')
+    parser.add_argument('--num_streams',
+                        type=int,
+                        default=10000,
+                        help='number of cancelled streams')
+    parser.add_argument('--num_chunks',
+                        type=int,
+                        default=1,
+                        help='number of chunks consumed before cancelling')
+    parser.add_argument('--report_interval',
+                        type=int,
+                        default=1000,
+                        help='report memory every report_interval streams')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def get_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def report(cosyvoice, i):
+    gc.collect()
+    gpu_mb = torch.cuda.memory_allocated() / 1024 / 1024 if torch.cuda.is_available() else 0
+    rss = get_rss_mb()
+    logging.info('{} streams cancelled, rss {:.1f}MB, gpu {:.1f}MB, live sessions {}, threads {}'.format(
+                 i, rss, gpu_mb, len(cosyvoice.model.sessions), threading.active_count()))
+    return rss
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    prompt_text = args.prompt_text
+    if isinstance(cosyvoice, CosyVoice3) and '<|endofprompt|>' not in prompt_text:
+        prompt_text = 'You are a helpful assistant.<|endofprompt|>' + prompt_text
+    # NOTE register the prompt once, so that the loop measures sessions instead of the frontend
+    assert cosyvoice.add_zero_shot_spk(prompt_text, args.prompt_wav, 'soak') is True
+    # warmup
+    list(cosyvoice.inference_zero_shot(args.tts_text, prompt_text, args.prompt_wav, zero_shot_spk_id='soak', stream=True))
+
+    rss = [report(cosyvoice, 0)]
+    start_time = time.time()
+    for i in range(args.num_streams):
+        generator = cosyvoice.inference_zero_shot(args.tts_text, prompt_text, args.prompt_wav, zero_shot_spk_id='soak', stream=True)
+        for _ in range(args.num_chunks):
+            next(generator, None)
+        # NOTE half of the streams are closed by the caller, the other half are simply dropped as an abandoned client would do
+        if i % 2 == 0:
+            generator.close()
+        del generator
+        if (i + 1) % args.report_interval == 0:
+            rss.append(report(cosyvoice, i + 1))
+    # NOTE llm threads of cancelled sessions stop at their next token, wait for them before the final report
+    for p in threading.enumerate():
+        if p is not threading.main_thread() and not p.daemon:
+            p.join()
+    rss.append(report(cosyvoice, args.num_streams))
+    logging.info('{} cancelled streams in {:.1f}s, rss grows {:.1f}MB after the first report interval, {:.1f}MB in total'.format(
+                 args.num_streams, time.time() - start_time, rss[-1] - rss[min(1, len(rss) - 1)], rss[-1] - rss[0]))
+
+
+if __name__ == "__main__":
+    with torch.inference_mode():
+        main()
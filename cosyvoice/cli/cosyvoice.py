@@ -13,6 +13,7 @@
 # limitations under the License.
 import os
 import time
+from functools import partial
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -26,7 +27,7 @@ from cosyvoice.utils.class_utils import get_model_type
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, prompt_cache_dir='', load_onnx=False, onnx_concurrent=1, quantize=None):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -42,7 +43,8 @@ class CosyVoice:
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_dir=prompt_cache_dir)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
@@ -51,6 +53,8 @@ class CosyVoice:
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        if quantize is not None:
+            self.model.quantize(quantize)
         if load_jit:
             self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
                                 '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
@@ -60,6 +64,10 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if load_onnx:
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                 '{}/hift.decoder.fp32.onnx'.format(model_dir),
+                                 onnx_concurrent)
         del configs
 
     def list_available_spks(self):
@@ -71,67 +79,129 @@ class CosyVoice:
         model_input = self.frontend.frontend_zero_shot('', prompt_text, prompt_wav, self.sample_rate, '')
         del model_input['text']
         del model_input['text_len']
-        self.frontend.spk2info[zero_shot_spk_id] = model_input
+        self.frontend.add_spk2info(zero_shot_spk_id, model_input)
+        # NOTE prepare the streaming flow prompt cache of default n_timesteps/solver now, instead of in the first request
+        if getattr(self.model, 'flow_prompt_cache_max_bytes', 0) > 0:
+            with torch.inference_mode():
+                self.model.setup_flow_cache(model_input['flow_prompt_speech_token'], model_input['prompt_speech_feat'], model_input['flow_embedding'],
+                                            spk_id=zero_shot_spk_id)
         return True
 
+    def del_zero_shot_spk(self, zero_shot_spk_id):
+        if hasattr(self.model, 'clear_flow_cache'):
+            self.model.clear_flow_cache(zero_shot_spk_id)
+        return self.frontend.del_spk2info(zero_shot_spk_id)
+
     def save_spkinfo(self):
-        torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
+        self.frontend.save_spk2info()
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
+    def pipeline_tts(self, texts, frontend_fn, stream=False, speed=1.0, n_timesteps=10, solver=None):
+        # NOTE frontend and llm of segment i + 1 are started before token2wav of segment i, so that llm latency is hidden between segments,
+        # the prefetched llm job waits for the llm job of segment i, and speech is still yielded in segment order
+        texts, prefetch = iter(tqdm(texts)), None
+        try:
+            i = next(texts, None)
+            if i is None:
+                return
+            model_input = frontend_fn(i)
+            prefetch = self.model.start_llm_job(**model_input)
+            while i is not None:
+                llm_job, prefetch = prefetch, None
+                next_i, next_model_input = next(texts, None), None
+                if next_i is not None:
+                    next_model_input = frontend_fn(next_i)
+                    prefetch = self.model.start_llm_job(**next_model_input, wait_for=llm_job)
                 start_time = time.time()
+                logging.info('synthesis text {}'.format(i))
+                for model_output in self.model.tts(**model_input, stream=stream, speed=speed, llm_job=llm_job, n_timesteps=n_timesteps, solver=solver):
+                    speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+                    logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                    yield model_output
+                    start_time = time.time()
+                i, model_input = next_i, next_model_input
+        finally:
+            # NOTE caller stops before the prefetched segment is consumed, close its session first so that the llm job stops early
+            if prefetch is not None:
+                self.model.release_session(prefetch[0])
+                prefetch[1].join()
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None):
+        yield from self.pipeline_tts(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend),
+                                     lambda i: self.frontend.frontend_sft(i, spk_id), stream=stream, speed=speed,
+                                     n_timesteps=n_timesteps, solver=solver)
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None):
         if self.__class__.__name__ == 'CosyVoice3' and '<|endofprompt|>' not in prompt_text + tts_text:
             logging.warning('<|endofprompt|> not found in CosyVoice3 inference, check your input text')
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+
+        def frontend_fn(i):
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            return self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
+        yield from self.pipeline_tts(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend), frontend_fn, stream=stream, speed=speed,
+                                     n_timesteps=n_timesteps, solver=solver)
 
-    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None):
+        yield from self.pipeline_tts(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend),
+                                     lambda i: self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id), stream=stream, speed=speed,
+                                     n_timesteps=n_timesteps, solver=solver)
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None):
         assert self.__class__.__name__ == 'CosyVoice', 'inference_instruct is only implemented for CosyVoice!'
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
+        yield from self.pipeline_tts(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend),
+                                     lambda i: self.frontend.frontend_instruct(i, spk_id, instruct_text), stream=stream, speed=speed,
+                                     n_timesteps=n_timesteps, solver=solver)
+
+    def inference_batch(self, requests, batch_size=16, speed=1.0, text_frontend=True, n_timesteps=10, solver=None):
+        """offline synthesis of a list of requests, every request is a dict of the arguments of inference_{mode} plus its mode, e.g.
+           {'mode': 'zero_shot', 'tts_text': ..., 'prompt_text': ..., 'prompt_wav': ...}, return one {'tts_speech': ...} per request in order
+        """
+        segments = []
+        for index, request in enumerate(requests):
+            mode, tts_text = request['mode'], request['tts_text']
+            assert not isinstance(tts_text, Generator), 'streaming input text is not supported in inference_batch'
+            if mode == 'sft':
+                frontend_fn = partial(self.frontend.frontend_sft, spk_id=request['spk_id'])
+            elif mode == 'zero_shot':
+                prompt_text = self.frontend.text_normalize(request['prompt_text'], split=False, text_frontend=text_frontend)
+                frontend_fn = partial(self.frontend.frontend_zero_shot, prompt_text=prompt_text, prompt_wav=request['prompt_wav'],
+                                      resample_rate=self.sample_rate, zero_shot_spk_id=request.get('zero_shot_spk_id', ''))
+            elif mode == 'cross_lingual':
+                frontend_fn = partial(self.frontend.frontend_cross_lingual, prompt_wav=request['prompt_wav'],
+                                      resample_rate=self.sample_rate, zero_shot_spk_id=request.get('zero_shot_spk_id', ''))
+            elif mode == 'instruct':
+                assert self.__class__.__name__ == 'CosyVoice', 'inference_instruct is only implemented for CosyVoice!'
+                instruct_text = self.frontend.text_normalize(request['instruct_text'], split=False, text_frontend=text_frontend)
+                frontend_fn = partial(self.frontend.frontend_instruct, spk_id=request['spk_id'], instruct_text=instruct_text)
+            elif mode == 'instruct2':
+                assert self.__class__.__name__ != 'CosyVoice', 'inference_instruct2 is only implemented for CosyVoice2/3!'
+                frontend_fn = partial(self.frontend.frontend_instruct2, instruct_text=request['instruct_text'], prompt_wav=request['prompt_wav'],
+                                      resample_rate=self.sample_rate, zero_shot_spk_id=request.get('zero_shot_spk_id', ''))
+            else:
+                raise ValueError('unsupported batch inference mode {}'.format(mode))
+            for i in self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend):
+                segments.append((index, frontend_fn(i)))
+        # NOTE bucket segments by text length, so that padding in llm, flow and hift batches is small
+        order = sorted(range(len(segments)), key=lambda i: segments[i][1]['text'].shape[1])
+        tts_speech = [None] * len(segments)
+        for i in tqdm(range(0, len(order), batch_size)):
+            bucket = order[i: i + batch_size]
             start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            for j, speech in zip(bucket, self.model.tts_batch([segments[j][1] for j in bucket], speed=speed, n_timesteps=n_timesteps, solver=solver)):
+                tts_speech[j] = speech
+            speech_len = sum(tts_speech[j].shape[1] for j in bucket) / self.sample_rate
+            logging.info('batch {} segments, speech len {}, rtf {}'.format(len(bucket), speech_len, (time.time() - start_time) / speech_len))
+        outputs = [[] for _ in requests]
+        for (index, _), speech in zip(segments, tts_speech):
+            outputs[index].append(speech)
+        return [{'tts_speech': torch.concat(speech, dim=1)} for speech in outputs]
 
-    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0):
+    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0, n_timesteps=10, solver=None):
         model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -140,7 +210,9 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, flow_batch_size=1, llm_batch_size=1,
+                 prompt_cache_dir='', llm_static_len=0, load_onnx=False, onnx_concurrent=1, quantize=None, llm_prefix_cache_mb=0,
+                 flow_prompt_cache_mb=0):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -156,7 +228,8 @@ class CosyVoice2(CosyVoice):
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_dir=prompt_cache_dir)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or load_vllm is True or fp16 is True):
             load_jit, load_trt, load_vllm, fp16 = False, False, False, False
@@ -165,6 +238,8 @@ class CosyVoice2(CosyVoice):
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        if quantize is not None:
+            self.model.quantize(quantize)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_jit:
@@ -174,23 +249,33 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if load_onnx:
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                 '{}/hift.decoder.fp32.onnx'.format(model_dir),
+                                 onnx_concurrent)
+        if flow_batch_size > 1:
+            self.model.enable_flow_batching(max_batch_size=flow_batch_size)
+        if llm_batch_size > 1:
+            self.model.enable_llm_batching(max_batch_size=llm_batch_size)
+        if llm_static_len > 0:
+            self.model.enable_llm_static_decode(max_len=llm_static_len)
+        if llm_prefix_cache_mb > 0:
+            self.model.enable_llm_prefix_cache(max_mb=llm_prefix_cache_mb)
+        if flow_prompt_cache_mb > 0:
+            self.model.enable_flow_prompt_cache(max_mb=flow_prompt_cache_mb)
         del configs
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None):
+        yield from self.pipeline_tts(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend),
+                                     lambda i: self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id), stream=stream, speed=speed,
+                                     n_timesteps=n_timesteps, solver=solver)
 
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, flow_batch_size=1, llm_batch_size=1,
+                 prompt_cache_dir='', llm_static_len=0, load_onnx=False, onnx_concurrent=1, quantize=None, llm_prefix_cache_mb=0,
+                 flow_prompt_cache_mb=0):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -206,7 +291,8 @@ class CosyVoice3(CosyVoice2):
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v3.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_dir=prompt_cache_dir)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_trt is True or fp16 is True):
             load_trt, fp16 = False, False
@@ -215,6 +301,8 @@ class CosyVoice3(CosyVoice2):
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        if quantize is not None:
+            self.model.quantize(quantize)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_trt:
@@ -224,6 +312,20 @@ class CosyVoice3(CosyVoice2):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if load_onnx:
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                 '{}/hift.decoder.fp32.onnx'.format(model_dir),
+                                 onnx_concurrent)
+        if flow_batch_size > 1:
+            self.model.enable_flow_batching(max_batch_size=flow_batch_size)
+        if llm_batch_size > 1:
+            self.model.enable_llm_batching(max_batch_size=llm_batch_size)
+        if llm_static_len > 0:
+            self.model.enable_llm_static_decode(max_len=llm_static_len)
+        if llm_prefix_cache_mb > 0:
+            self.model.enable_llm_prefix_cache(max_mb=llm_prefix_cache_mb)
+        if flow_prompt_cache_mb > 0:
+            self.model.enable_flow_prompt_cache(max_mb=flow_prompt_cache_mb)
         del configs
 
 
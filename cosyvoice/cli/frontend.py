@@ -11,9 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
 from functools import partial
 from typing import Generator
+import hashlib
 import json
+import threading
 import onnxruntime
 import torch
 import numpy as np
@@ -23,8 +26,8 @@ import torchaudio.compliance.kaldi as kaldi
 import os
 import re
 import inflect
-from cosyvoice.utils.file_utils import logging, load_wav
-from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
+from cosyvoice.utils.file_utils import logging, PromptAudio
+from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph_iter, is_only_punctuation
 
 
 class CosyVoiceFrontEnd:
@@ -35,7 +38,9 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_size: int = 32,
+                 prompt_cache_dir: str = ''):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -46,11 +51,22 @@ class CosyVoiceFrontEnd:
         self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
                                                                      providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
                                                                                 "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
-            self.spk2info = torch.load(spk2info, map_location=self.device, weights_only=True)
-        else:
-            self.spk2info = {}
+        # NOTE spk2info is loaded lazily, and reloaded when spk2info file is updated by another process
+        self.spk2info_path = spk2info
+        self.spk2info_mtime = None
+        self.spk2info_dict = {}
+        self.spk2info_lock = threading.RLock()
+        # NOTE speakers added or deleted in this process but not saved yet, they are kept on top of a reloaded file
+        self.spk2info_added, self.spk2info_deleted = set(), set()
         self.allowed_special = allowed_special
+        # NOTE prompt features keyed by hash of prompt pcm, in memory lru and optional on-disk store
+        self.prompt_cache_size = prompt_cache_size
+        self.prompt_cache_dir = prompt_cache_dir
+        self.prompt_cache_tag = os.path.basename(speech_tokenizer_model)
+        self.prompt_cache = OrderedDict()
+        self.prompt_cache_lock = threading.Lock()
+        if prompt_cache_dir != '':
+            os.makedirs(prompt_cache_dir, exist_ok=True)
         self.inflect_parser = inflect.engine()
         # NOTE compatible when no text frontend tool is avaliable
         try:
@@ -75,6 +91,45 @@ class CosyVoiceFrontEnd:
                 logging.info('no frontend is avaliable')
 
 
+    @property
+    def spk2info(self):
+        with self.spk2info_lock:
+            if os.path.exists(self.spk2info_path) and os.path.getmtime(self.spk2info_path) != self.spk2info_mtime:
+                self.spk2info_mtime = os.path.getmtime(self.spk2info_path)
+                spk2info = torch.load(self.spk2info_path, map_location=self.device, weights_only=True)
+                logging.info('load {} speakers from {}'.format(len(spk2info), self.spk2info_path))
+                for spk_id in self.spk2info_added:
+                    spk2info[spk_id] = self.spk2info_dict[spk_id]
+                for spk_id in self.spk2info_deleted:
+                    spk2info.pop(spk_id, None)
+                self.spk2info_dict = spk2info
+            return self.spk2info_dict
+
+    def add_spk2info(self, spk_id, info):
+        with self.spk2info_lock:
+            self.spk2info[spk_id] = info
+            self.spk2info_added.add(spk_id)
+            self.spk2info_deleted.discard(spk_id)
+
+    def del_spk2info(self, spk_id):
+        with self.spk2info_lock:
+            self.spk2info_added.discard(spk_id)
+            if self.spk2info.pop(spk_id, None) is None:
+                return False
+            self.spk2info_deleted.add(spk_id)
+            return True
+
+    def save_spk2info(self):
+        assert self.spk2info_path != '', 'spk2info path is not set'
+        with self.spk2info_lock:
+            spk2info = self.spk2info
+            # NOTE write to a temp file first, so that other processes never load a partial file
+            torch.save(spk2info, '{}.tmp'.format(self.spk2info_path))
+            os.replace('{}.tmp'.format(self.spk2info_path), self.spk2info_path)
+            self.spk2info_mtime = os.path.getmtime(self.spk2info_path)
+            self.spk2info_added.clear()
+            self.spk2info_deleted.clear()
+
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will return _extract_text_token_generator!')
@@ -92,8 +147,11 @@ class CosyVoiceFrontEnd:
             for i in range(text_token.shape[1]):
                 yield text_token[:, i: i + 1]
 
+    def _load_prompt_audio(self, prompt_wav):
+        return prompt_wav if isinstance(prompt_wav, PromptAudio) else PromptAudio(prompt_wav)
+
     def _extract_speech_token(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
+        speech = self._load_prompt_audio(prompt_wav).resample(16000)
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
         feat = whisper.log_mel_spectrogram(speech, n_mels=128)
         speech_token = self.speech_tokenizer_session.run(None,
@@ -106,7 +164,7 @@ class CosyVoiceFrontEnd:
         return speech_token, speech_token_len
 
     def _extract_spk_embedding(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
+        speech = self._load_prompt_audio(prompt_wav).resample(16000)
         feat = kaldi.fbank(speech,
                            num_mel_bins=80,
                            dither=0,
@@ -118,12 +176,58 @@ class CosyVoiceFrontEnd:
         return embedding
 
     def _extract_speech_feat(self, prompt_wav):
-        speech = load_wav(prompt_wav, 24000)
+        speech = self._load_prompt_audio(prompt_wav).resample(24000)
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
         speech_feat = speech_feat.unsqueeze(dim=0)
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def _prompt_cache_key(self, prompt_audio):
+        # NOTE speech token depends on the speech tokenizer version, so it is part of the key
+        key = hashlib.sha256(prompt_audio.speech.numpy().tobytes())
+        key.update('{}_{}'.format(prompt_audio.sample_rate, self.prompt_cache_tag).encode())
+        return key.hexdigest()
+
+    def _extract_prompt_feature(self, prompt_wav):
+        """speech feat/token and spk embedding of prompt_wav, cached by hash of its pcm so a repeated prompt skips all frontend models"""
+        # NOTE decode prompt_wav once, all extractors share its 16k/24k views
+        prompt_wav = self._load_prompt_audio(prompt_wav)
+        if self.prompt_cache_size <= 0 and self.prompt_cache_dir == '':
+            key = None
+        else:
+            key = self._prompt_cache_key(prompt_wav)
+            with self.prompt_cache_lock:
+                if key in self.prompt_cache:
+                    self.prompt_cache.move_to_end(key)
+                    return self.prompt_cache[key]
+            cache_path = os.path.join(self.prompt_cache_dir, '{}.pt'.format(key))
+            if self.prompt_cache_dir != '' and os.path.exists(cache_path):
+                prompt_feature = torch.load(cache_path, map_location=self.device, weights_only=True)
+                self._update_prompt_cache(key, prompt_feature)
+                return prompt_feature
+        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
+        speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
+        embedding = self._extract_spk_embedding(prompt_wav)
+        prompt_feature = {'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len,
+                          'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                          'embedding': embedding}
+        if key is not None:
+            if self.prompt_cache_dir != '':
+                # NOTE write to a temp file first, so that concurrent readers never see a partial file
+                torch.save(prompt_feature, '{}.{}.tmp'.format(cache_path, threading.get_ident()))
+                os.replace('{}.{}.tmp'.format(cache_path, threading.get_ident()), cache_path)
+            self._update_prompt_cache(key, prompt_feature)
+        return prompt_feature
+
+    def _update_prompt_cache(self, key, prompt_feature):
+        if self.prompt_cache_size <= 0:
+            return
+        with self.prompt_cache_lock:
+            self.prompt_cache[key] = prompt_feature
+            self.prompt_cache.move_to_end(key)
+            while len(self.prompt_cache) > self.prompt_cache_size:
+                self.prompt_cache.popitem(last=False)
+
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
@@ -148,42 +252,45 @@ class CosyVoiceFrontEnd:
                 text = text.replace(" - ", "，")
                 text = remove_bracket(text)
                 text = re.sub(r'[，,、]+$', '。', text)
-                texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
-                                             token_min_n=60, merge_len=20, comma_split=False))
+                texts = split_paragraph_iter(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
+                                             token_min_n=60, merge_len=20, comma_split=False)
             else:
                 if self.text_frontend == 'wetext':
                     text = self.en_tn_model.normalize(text)
                 text = spell_out_number(text, self.inflect_parser)
-                texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
-                                             token_min_n=60, merge_len=20, comma_split=False))
-        texts = [i for i in texts if not is_only_punctuation(i)]
+                texts = split_paragraph_iter(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
+                                             token_min_n=60, merge_len=20, comma_split=False)
+        # NOTE segments are produced lazily, so that synthesis of the first segment starts before a long text is fully segmented
+        texts = (i for i in texts if not is_only_punctuation(i))
         return texts if split is True else text
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         embedding = self.spk2info[spk_id]['embedding']
-        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding, 'spk_id': spk_id}
         return model_input
 
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_wav, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
             prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
+            prompt_feature = self._extract_prompt_feature(prompt_wav)
+            speech_feat, speech_feat_len = prompt_feature['speech_feat'], prompt_feature['speech_feat_len']
+            speech_token, speech_token_len = prompt_feature['speech_token'], prompt_feature['speech_token_len']
             if resample_rate == 24000:
                 # cosyvoice2, force speech_feat % speech_token = 2
+                # NOTE do not modify prompt_feature inplace, it is shared by prompt cache
                 token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_wav)
+                speech_feat, speech_feat_len = speech_feat[:, :2 * token_len], torch.full_like(speech_feat_len, 2 * token_len)
+                speech_token, speech_token_len = speech_token[:, :token_len], torch.full_like(speech_token_len, token_len)
+            embedding = prompt_feature['embedding']
             model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
                            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
                            'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
                            'llm_embedding': embedding, 'flow_embedding': embedding}
         else:
-            model_input = {**self.spk2info[zero_shot_spk_id]}
+            model_input = {**self.spk2info[zero_shot_spk_id], 'spk_id': zero_shot_spk_id}
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
         return model_input
@@ -213,9 +320,10 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_wav, resample_rate):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav)
-        embedding = self._extract_spk_embedding(prompt_wav)
+        prompt_feature = self._extract_prompt_feature(prompt_wav)
+        prompt_speech_token, prompt_speech_token_len = prompt_feature['speech_token'], prompt_feature['speech_token_len']
+        prompt_speech_feat, prompt_speech_feat_len = prompt_feature['speech_feat'], prompt_feature['speech_feat_len']
+        embedding = prompt_feature['embedding']
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import logging
 from typing import Generator
 import torch
 import numpy as np
@@ -21,9 +22,56 @@ import time
 from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
-from cosyvoice.utils.common import fade_in_out
+import weakref
+from collections import OrderedDict
+from cosyvoice.utils.common import fade_in_out, make_fade_window, tensor_nbytes
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.common import TrtContextWrapper, OrtSessionWrapper
+from cosyvoice.cli.scheduler import FlowBatchScheduler, LLMBatchScheduler
+from cosyvoice.llm.llm import Qwen2StaticDecoder, Qwen2PrefixCache
+
+
+class TTSSession:
+    """State of one tts call, owned by the tts generator and its llm thread instead of model level dicts.
+
+    speech_token and llm_end are guarded by the session's own condition, so concurrent sessions never share a lock.
+    The session is closed when the generator exits, including GeneratorExit of an abandoned stream, or when it is idle
+    longer than session_timeout, a closed session drops its buffers and stops its llm thread at the next token.
+    """
+    __slots__ = ('uuid', 'speech_token', 'llm_end', 'cond', 'mel_overlap', 'flow_cache', 'hift_cache', 'last_active', 'closed', '__weakref__')
+
+    def __init__(self, uuid, mel_overlap=None, flow_cache=None):
+        self.uuid = uuid
+        self.speech_token, self.llm_end = [], False
+        self.cond = threading.Condition()
+        self.mel_overlap = mel_overlap
+        self.flow_cache = flow_cache
+        self.hift_cache = None
+        self.last_active = time.time()
+        self.closed = False
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def resume(self):
+        if self.closed is True:
+            raise TimeoutError('tts session {} is closed after being idle'.format(self.uuid))
+        self.touch()
+
+    def close(self):
+        with self.cond:
+            if self.closed is True:
+                return
+            self.closed = True
+            self.speech_token, self.mel_overlap, self.flow_cache, self.hift_cache = [], None, None, None
+            self.cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
 
 class CosyVoiceModel:
@@ -43,23 +91,20 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
+        self.mel_window = make_fade_window(self.mel_overlap_len, self.device)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window = make_fade_window(self.source_cache_len, self.device)
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # NOTE live sessions for idle reaping only, the registry never keeps a session alive
+        self.sessions = weakref.WeakValueDictionary()
+        self.sessions_lock = threading.Lock()
+        self.session_timeout = 600
         self.silent_tokens = []
 
     def load(self, llm_model, flow_model, hift_model):
@@ -71,6 +116,24 @@ class CosyVoiceModel:
         hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device, weights_only=True).items()}
         self.hift.load_state_dict(hift_state_dict, strict=True)
         self.hift.to(self.device).eval()
+        self.freeze_for_inference()
+
+    def freeze_for_inference(self):
+        # NOTE fold weight_norm and precompute constants of hift, call it after all state dicts are loaded
+        self.hift.freeze_for_inference()
+
+    def quantize(self, quantize):
+        # NOTE weight only int8 dynamic quantization of nn.Linear for cpu inference, activations are quantized on the fly per batch
+        assert quantize == 'int8', 'only int8 quantization is supported, got {}'.format(quantize)
+        if self.device.type != 'cpu':
+            logging.warning('dynamic quantization only supports cpu, skip {} quantization'.format(quantize))
+            return
+        for parent, name in [(self.llm, 'text_encoder'), (self.llm, 'llm'), (self.llm, 'llm_decoder'), (self.flow, 'encoder'), (self.flow.decoder, 'estimator')]:
+            module = getattr(parent, name, None)
+            if not isinstance(module, torch.nn.Module) or isinstance(module, torch.jit.ScriptModule):
+                continue
+            # NOTE quantize_dynamic only swaps children, wrap it so that a bare Linear like llm_decoder is swapped as well
+            setattr(parent, name, torch.ao.quantization.quantize_dynamic(torch.nn.Sequential(module), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)[0])
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
@@ -91,156 +154,241 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def load_onnx(self, flow_decoder_estimator_model, hift_decoder_model, onnx_concurrent):
+        # NOTE onnxruntime CPUExecutionProvider backend for nodes without gpu, export models by cosyvoice/bin/export_onnx.py
+        for model in [flow_decoder_estimator_model, hift_decoder_model]:
+            assert os.path.exists(model), '{} not found, export it by cosyvoice/bin/export_onnx.py'.format(model)
+        if isinstance(self.flow.decoder.estimator, torch.nn.Module):
+            del self.flow.decoder.estimator
+            self.flow.decoder.estimator = OrtSessionWrapper(flow_decoder_estimator_model, ort_concurrent=onnx_concurrent)
+        else:
+            logging.warning('flow decoder estimator is already replaced by trt, skip onnx estimator')
+        self.hift.onnx_decoder = OrtSessionWrapper(hift_decoder_model, ort_concurrent=onnx_concurrent)
+
     def get_trt_kwargs(self):
-        min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
-        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
-        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2, 80, 3000)]
-        input_names = ["x", "mask", "mu", "cond"]
+        # NOTE batch 1 for the steps outside inference_cfg_interval, which skip the uncond branch
+        min_shape = [(1, 80, 4), (1, 1, 4), (1, 80, 4), (1,), (1, 80), (1, 80, 4)]
+        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2,), (2, 80), (2, 80, 500)]
+        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2,), (2, 80), (2, 80, 3000)]
+        input_names = ["x", "mask", "mu", "t", "spks", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        cur_silent_token_num, max_silent_token_num = 0, 5
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
-            if isinstance(text, Generator):
-                assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
-                token_generator = self.llm.inference_bistream(text=text,
-                                                              prompt_text=prompt_text.to(self.device),
-                                                              prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                              prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                              prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                              embedding=llm_embedding.to(self.device))
+    def init_session(self, this_uuid):
+        return self.register_session(TTSSession(this_uuid, mel_overlap=torch.zeros(1, 80, 0), flow_cache=torch.zeros(1, 80, 0, 2)))
+
+    def register_session(self, session):
+        # NOTE sessions_lock is taken once per request to register and reap, token and chunk updates only take the session's own condition
+        with self.sessions_lock:
+            now = time.time()
+            for idle_session in [i for i in self.sessions.values() if now - i.last_active > self.session_timeout]:
+                logging.warning('close tts session {} after {:.0f}s idle'.format(idle_session.uuid, now - idle_session.last_active))
+                idle_session.close()
+                self.sessions.pop(idle_session.uuid, None)
+            self.sessions[session.uuid] = session
+        return session
+
+    def release_session(self, session):
+        session.close()
+        with self.sessions_lock:
+            self.sessions.pop(session.uuid, None)
+
+    def start_llm_job(self, text=torch.zeros(1, 0, dtype=torch.int32), llm_embedding=torch.zeros(0, 192), prompt_text=torch.zeros(1, 0, dtype=torch.int32),
+                      llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), wait_for=None,
+                      spk_id='', **kwargs):
+        # session owns the variables related to this inference thread
+        session = self.init_session(str(uuid.uuid1()))
+        if source_speech_token.shape[1] == 0:
+            target, args = self.llm_job, (text, prompt_text, llm_prompt_speech_token, llm_embedding, session, spk_id)
+        else:
+            target, args = self.vc_job, (source_speech_token, session)
+        if wait_for is not None:
+            # NOTE pipelined llm jobs start right after the previous one ends, so they never compete with each other
+            target, args = self.wait_job, (wait_for[1], target, args)
+        p = threading.Thread(target=target, args=args)
+        p.start()
+        return session, p
+
+    @staticmethod
+    def wait_job(p, target, args):
+        p.join()
+        target(*args)
+
+    def drop_silent_tokens(self, token_generator, max_silent_token_num=5):
+        cur_silent_token_num = 0
+        for i in token_generator:
+            if i in self.silent_tokens:
+                cur_silent_token_num += 1
+                if cur_silent_token_num > max_silent_token_num:
+                    continue
             else:
-                token_generator = self.llm.inference(text=text.to(self.device),
-                                                     text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_text=prompt_text.to(self.device),
-                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                     prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device),
-                                                     uuid=uuid)  
-            for i in token_generator:
-                if i in self.silent_tokens:
-                    cur_silent_token_num += 1
-                    if cur_silent_token_num > max_silent_token_num:
-                        continue
+                cur_silent_token_num = 0
+            yield i
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session, spk_id=''):
+        cond = session.cond
+        try:
+            # NOTE a prefetched job whose session is already closed does not run llm at all
+            if session.closed is True:
+                return
+            with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+                if isinstance(text, Generator):
+                    assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), \
+                        'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
+                    token_generator = self.llm.inference_bistream(text=text,
+                                                                  prompt_text=prompt_text.to(self.device),
+                                                                  prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                                  prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                                  prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                                  embedding=llm_embedding.to(self.device))
                 else:
-                    cur_silent_token_num = 0
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+                    token_generator = self.llm.inference(text=text.to(self.device),
+                                                         text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_text=prompt_text.to(self.device),
+                                                         prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                         prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                         embedding=llm_embedding.to(self.device),
+                                                         uuid=session.uuid,
+                                                         spk_id=spk_id)
+                for i in self.drop_silent_tokens(token_generator):
+                    # NOTE wake up the streaming loop as soon as a new token is available, stop decoding once the session is closed
+                    with cond:
+                        if session.closed is True:
+                            break
+                        session.speech_token.append(i)
+                        session.touch()
+                        cond.notify()
+        finally:
+            # NOTE always mark llm end, otherwise the streaming loop will wait forever when llm raises
+            with cond:
+                session.llm_end = True
+                cond.notify()
 
-    def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+    def vc_job(self, source_speech_token, session):
+        with session.cond:
+            if session.closed is False:
+                session.speech_token = source_speech_token.flatten().tolist()
+            session.llm_end = True
+            session.cond.notify()
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, finalize=False, speed=1.0, n_timesteps=10, solver=None):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                                                      token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_token=prompt_token.to(self.device),
-                                                                      prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_feat=prompt_feat.to(self.device),
-                                                                      prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+            tts_mel, session.flow_cache = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_token=prompt_token.to(self.device),
+                                                              prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_feat=prompt_feat.to(self.device),
+                                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                              embedding=embedding.to(self.device),
+                                                              flow_cache=session.flow_cache,
+                                                              n_timesteps=n_timesteps,
+                                                              solver=solver)
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, llm_job=None,
+            n_timesteps=10, solver=None, **kwargs):
+        # NOTE llm_job is started ahead by start_llm_job in pipelined inference, otherwise start it here
+        if llm_job is None:
+            llm_job = self.start_llm_job(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text,
+                                         llm_prompt_speech_token=llm_prompt_speech_token, source_speech_token=source_speech_token, **kwargs)
+        session, p = llm_job
+        # NOTE session is closed on return, exception and GeneratorExit of an abandoned stream, the llm thread stops at its next token
+        with session:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                cond = session.cond
+                while True:
+                    token_num = token_hop_len + self.token_overlap_len
+                    with cond:
+                        cond.wait_for(lambda token_num=token_num: len(session.speech_token) >= token_num or session.llm_end is True or session.closed is True)
+                    session.resume()
+                    if len(session.speech_token) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(session.speech_token[:token_hop_len + self.token_overlap_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         session=session,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver,
+                                                         finalize=False)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        session.resume()
+                        with cond:
+                            session.speech_token = session.speech_token[token_hop_len:]
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if session.llm_end is True and len(session.speech_token) < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(session.speech_token).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                session.resume()
+                this_tts_speech_token = torch.tensor(session.speech_token).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
 
+    def tts_batch(self, model_inputs, speed=1.0, n_timesteps=10, solver=None):
+        # NOTE CosyVoice llm and flow only support batch size 1 inference, synthesis the requests one after another
+        return [torch.concat([model_output['tts_speech'] for model_output in self.tts(**model_input, speed=speed, n_timesteps=n_timesteps, solver=solver)], dim=1)
+                for model_input in model_inputs]
+
 
 class CosyVoice2Model(CosyVoiceModel):
 
@@ -260,16 +408,25 @@ class CosyVoice2Model(CosyVoiceModel):
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window = make_fade_window(self.source_cache_len, self.device)
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # NOTE live sessions for idle reaping only, the registry never keeps a session alive
+        self.sessions = weakref.WeakValueDictionary()
+        self.sessions_lock = threading.Lock()
+        self.session_timeout = 600
+        self.flow_scheduler = None
+        # NOTE flow setup_cache of registered speakers, lru keyed by (spk_id, n_timesteps, solver), disabled by default
+        self.flow_prompt_cache = OrderedDict()
+        self.flow_prompt_cache_bytes = 0
+        self.flow_prompt_cache_max_bytes = 0
+        self.flow_prompt_cache_lock = threading.Lock()
         self.silent_tokens = []
 
+    def init_session(self, this_uuid):
+        # NOTE flow_cache stays None unless the session runs incremental flow inference
+        return self.register_session(TTSSession(this_uuid))
+
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
@@ -285,109 +442,265 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def enable_llm_batching(self, max_batch_size=16):
+        if hasattr(self.llm, 'vllm'):
+            logging.warning('vllm is loaded, skip llm batching')
+            return
+        self.llm.batch_scheduler = LLMBatchScheduler(self.llm, max_batch_size=max_batch_size, fp16=self.fp16)
+
+    def enable_llm_static_decode(self, max_len=2048, compile=True):
+        if hasattr(self.llm, 'vllm'):
+            logging.warning('vllm is loaded, skip llm static decode')
+            return
+        self.llm.static_decoder = Qwen2StaticDecoder(self.llm.llm.model, max_len=max_len, compile=compile)
+        # NOTE warmup so that torch.compile happens here instead of in the first request
+        with torch.inference_mode():
+            xs = torch.zeros(1, 2, self.llm.llm_input_size, device=self.device, dtype=self.llm.speech_embedding.weight.dtype)
+            _, cache = self.llm.static_decoder.forward_one_step(xs)
+            self.llm.static_decoder.forward_one_step(xs[:, :1], cache=cache)
+
+    def enable_llm_prefix_cache(self, max_mb=256):
+        if hasattr(self.llm, 'vllm'):
+            logging.warning('vllm is loaded, skip llm prefix cache')
+            return
+        self.llm.prefix_cache = Qwen2PrefixCache(max_mb=max_mb)
+
+    def enable_flow_batching(self, max_batch_size=16, batch_window=0.01):
+        if not isinstance(self.flow.decoder.estimator, torch.nn.Module):
+            logging.warning('trt/onnx estimator is built with fixed batch size, skip flow batching')
+            return
+        self.flow_scheduler = FlowBatchScheduler(self.flow, max_batch_size=max_batch_size, batch_window=batch_window, fp16=self.fp16)
+        logging.info('flow batching is enabled, streaming skips flow chunk inference and flow prompt cache')
+
+    def flow_chunk_available(self):
+        # NOTE incremental flow inference needs torch flow modules, jit encoder and trt/onnx estimator only support whole prefix inference
+        return isinstance(self.flow.decoder.estimator, torch.nn.Module) and not isinstance(getattr(self.flow, 'encoder', None), torch.jit.ScriptModule)
+
+    def setup_flow_cache(self, prompt_token, prompt_feat, embedding, spk_id='', n_timesteps=10, solver=None):
+        """flow.setup_cache of a streaming session, the prompt of a registered speaker is encoded and decoded once and shared by its sessions"""
+        key = (spk_id, n_timesteps, solver)
+        if spk_id != '':
+            with self.flow_prompt_cache_lock:
+                entry = self.flow_prompt_cache.get(key)
+                if entry is not None:
+                    self.flow_prompt_cache.move_to_end(key)
+            # NOTE spk2info can be updated by add_zero_shot_spk or by another process, only reuse a cache built from the same prompt
+            if entry is not None and all(torch.equal(i, j) for i, j in zip(entry[0], (prompt_token, prompt_feat, embedding))):
+                return entry[1]
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+            cache = self.flow.setup_cache(prompt_token=prompt_token.to(self.device),
+                                          prompt_feat=prompt_feat.to(self.device),
+                                          embedding=embedding.to(self.device),
+                                          n_timesteps=n_timesteps,
+                                          solver=solver)
+        cache_bytes = tensor_nbytes(cache) if spk_id != '' and self.flow_prompt_cache_max_bytes > 0 else -1
+        if 0 <= cache_bytes <= self.flow_prompt_cache_max_bytes:
+            with self.flow_prompt_cache_lock:
+                if key in self.flow_prompt_cache:
+                    self.flow_prompt_cache_bytes -= self.flow_prompt_cache.pop(key)[2]
+                self.flow_prompt_cache[key] = ((prompt_token, prompt_feat, embedding), cache, cache_bytes)
+                self.flow_prompt_cache_bytes += cache_bytes
+                while self.flow_prompt_cache_bytes > self.flow_prompt_cache_max_bytes:
+                    self.flow_prompt_cache_bytes -= self.flow_prompt_cache.popitem(last=False)[1][2]
+        return cache
+
+    def clear_flow_cache(self, spk_id):
+        with self.flow_prompt_cache_lock:
+            for key in [k for k in self.flow_prompt_cache if k[0] == spk_id]:
+                self.flow_prompt_cache_bytes -= self.flow_prompt_cache.pop(key)[2]
+
+    def enable_flow_prompt_cache(self, max_mb=4096):
+        # NOTE an entry keeps the estimator cache of every ode step over the prompt, hundreds of MB for a 3s prompt of CosyVoice2
+        if self.flow_chunk_available() is False:
+            logging.warning('flow chunk inference is not available, skip flow prompt cache')
+            return
+        self.flow_prompt_cache_max_bytes = int(max_mb * 1024 * 1024)
+
+    def flow_inference(self, token, prompt_token, prompt_feat, embedding, token_offset, session, stream=False, finalize=False, n_timesteps=10, solver=None):
+        if session.flow_cache is not None:
+            # NOTE tokens before token_offset + pre_lookahead_len have been passed to flow in last chunk
+            token_start = 0 if token_offset == 0 else token_offset + self.flow.pre_lookahead_len
+            tts_mel, session.flow_cache = self.flow.inference_chunk(token=token[:, token_start:].to(self.device, dtype=torch.int32),
+                                                                    cache=session.flow_cache,
+                                                                    finalize=finalize)
+        else:
+            # NOTE whole prefix inference goes through flow_scheduler if enabled, so that decoder of concurrent sessions is batched
+            flow = self.flow_scheduler if self.flow_scheduler is not None else self.flow
+            tts_mel, _ = flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                        token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                        prompt_token=prompt_token.to(self.device),
+                                        prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                        prompt_feat=prompt_feat.to(self.device),
+                                        prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                        embedding=embedding.to(self.device),
+                                        streaming=stream,
+                                        finalize=finalize,
+                                        n_timesteps=n_timesteps,
+                                        solver=solver)
+            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        return tts_mel
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, session, stream=False, finalize=False, speed=1.0, n_timesteps=10, solver=None):
+        with torch.cuda.amp.autocast(self.fp16):
+            tts_mel = self.flow_inference(token, prompt_token, prompt_feat, embedding, token_offset, session, stream=stream, finalize=finalize,
+                                          n_timesteps=n_timesteps, solver=solver)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, llm_job=None,
+            n_timesteps=10, solver=None, spk_id='', **kwargs):
+        # NOTE llm_job is started ahead by start_llm_job in pipelined inference, otherwise start it here
+        if llm_job is None:
+            llm_job = self.start_llm_job(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text,
+                                         llm_prompt_speech_token=llm_prompt_speech_token, source_speech_token=source_speech_token, spk_id=spk_id, **kwargs)
+        session, p = llm_job
+        # NOTE session is closed on return, exception and GeneratorExit of an abandoned stream, the llm thread stops at its next token
+        with session:
+            if stream is True:
+                # NOTE with flow batching, every chunk recomputes the whole prefix through flow_scheduler instead of incremental inference_chunk,
+                # per chunk compute grows with the utterance, but the decoder of concurrent sessions runs in one batch, which pays off at high concurrency
+                if self.flow_scheduler is None and self.flow_chunk_available() is True:
+                    session.flow_cache = self.setup_flow_cache(flow_prompt_speech_token, prompt_speech_feat, flow_embedding, spk_id=spk_id,
+                                                               n_timesteps=n_timesteps, solver=solver)
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                cond = session.cond
+                while True:
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    token_num = token_offset + this_token_hop_len + self.flow.pre_lookahead_len
+                    with cond:
+                        cond.wait_for(lambda token_num=token_num: len(session.speech_token) >= token_num or session.llm_end is True or session.closed is True)
+                    session.resume()
+                    if len(session.speech_token) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = torch.tensor(session.speech_token[:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         session=session,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver,
+                                                         stream=stream,
+                                                         finalize=False)
+                        token_offset += this_token_hop_len
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        session.resume()
+                    if session.llm_end is True and len(session.speech_token) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(session.speech_token).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=token_offset,
+                                                 session=session,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                session.resume()
+                this_tts_speech_token = torch.tensor(session.speech_token).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 session=session,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
 
+    @torch.inference_mode()
+    def tts_batch(self, model_inputs, speed=1.0, n_timesteps=10, solver=None):
+        default_input = {'prompt_text': torch.zeros(1, 0, dtype=torch.int32), 'llm_prompt_speech_token': torch.zeros(1, 0, dtype=torch.int32),
+                         'flow_prompt_speech_token': torch.zeros(1, 0, dtype=torch.int32), 'prompt_speech_feat': torch.zeros(1, 0, 80)}
+        model_inputs = [{**default_input, **model_input} for model_input in model_inputs]
+        # 1. batched llm decoding, every sequence stops at its own eos
+        lm_inputs, min_lens, max_lens = [], [], []
+        with torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+            for model_input in model_inputs:
+                text, prompt_text, speech_token = model_input['text'], model_input['prompt_text'], model_input['llm_prompt_speech_token']
+                lm_input, min_len, max_len = self.llm.prepare_inference_input(text=text.to(self.device),
+                                                                              text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                                              prompt_text=prompt_text.to(self.device),
+                                                                              prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                                              prompt_speech_token=speech_token.to(self.device),
+                                                                              prompt_speech_token_len=torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device))
+                lm_inputs.append(lm_input)
+                min_lens.append(min_len)
+                max_lens.append(max_len)
+            if hasattr(self.llm, 'vllm'):
+                tokens = [list(self.llm.inference_wrapper(lm_input, 25, min_len, max_len, str(uuid.uuid1()))) for lm_input, min_len, max_len in zip(lm_inputs, min_lens, max_lens)]
+            else:
+                tokens = LLMBatchScheduler(self.llm, max_batch_size=len(lm_inputs), fp16=self.fp16, background=False).inference_batch(lm_inputs, 25, min_lens, max_lens)
+        tokens = [list(self.drop_silent_tokens(token)) for token in tokens]
+        # 2. batched flow matching, padded frames are masked out in the estimator
+        flow_inputs = [{'token': torch.tensor(token, dtype=torch.int32).reshape(1, -1).to(self.device),
+                        'token_len': torch.tensor([len(token)], dtype=torch.int32).to(self.device),
+                        'prompt_token': model_input['flow_prompt_speech_token'].to(self.device),
+                        'prompt_token_len': torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(self.device),
+                        'prompt_feat': model_input['prompt_speech_feat'].to(self.device),
+                        'prompt_feat_len': torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(self.device),
+                        'embedding': model_input['flow_embedding'].to(self.device),
+                        'streaming': False,
+                        'finalize': True,
+                        'n_timesteps': n_timesteps,
+                        'solver': solver} for token, model_input in zip(tokens, model_inputs)]
+        if isinstance(self.flow.decoder.estimator, torch.nn.Module):
+            tts_mels = FlowBatchScheduler(self.flow, max_batch_size=len(flow_inputs), fp16=self.fp16, background=False).inference_batch(flow_inputs)
+        else:
+            # NOTE trt/onnx estimator is built with fixed batch size
+            with torch.cuda.amp.autocast(self.fp16):
+                tts_mels = [self.flow.inference(**flow_input)[0].float() for flow_input in flow_inputs]
+        if speed != 1.0:
+            tts_mels = [F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear') for tts_mel in tts_mels]
+        # 3. batched hift on zero padded mel, onnx hift decoder is exported with batch size 1
+        if getattr(self.hift, 'onnx_decoder', None) is not None:
+            return [self.hift.inference(speech_feat=tts_mel)[0].cpu() for tts_mel in tts_mels]
+        mel_len = [tts_mel.shape[2] for tts_mel in tts_mels]
+        tts_mel = torch.zeros(len(tts_mels), tts_mels[0].shape[1], max(mel_len), device=self.device)
+        for i, m in enumerate(tts_mels):
+            tts_mel[i, :, :mel_len[i]] = m[0]
+        tts_speech, _ = self.hift.inference(speech_feat=tts_mel)
+        hop_len = tts_speech.shape[1] // tts_mel.shape[2]
+        return [tts_speech[i:i + 1, :mel_len[i] * hop_len].cpu() for i in range(len(tts_mels))]
+
 
 class CosyVoice3Model(CosyVoice2Model):
 
@@ -405,37 +718,26 @@ class CosyVoice3Model(CosyVoice2Model):
         self.token_hop_len = 25
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # NOTE live sessions for idle reaping only, the registry never keeps a session alive
+        self.sessions = weakref.WeakValueDictionary()
+        self.sessions_lock = threading.Lock()
+        self.session_timeout = 600
+        self.flow_scheduler = None
+        # NOTE flow setup_cache of registered speakers, lru keyed by (spk_id, n_timesteps, solver), disabled by default
+        self.flow_prompt_cache = OrderedDict()
+        self.flow_prompt_cache_bytes = 0
+        self.flow_prompt_cache_max_bytes = 0
+        self.flow_prompt_cache_lock = threading.Lock()
         # FSQ silent and breath token
         self.silent_tokens = [1, 2, 28, 29, 55, 248, 494, 2241, 2242, 2322, 2323]
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, session, stream=False, finalize=False, speed=1.0, n_timesteps=10, solver=None):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
-            # append mel cache
-            if self.hift_cache_dict[uuid] is not None:
-                hift_cache_mel = self.hift_cache_dict[uuid]['mel']
-                tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
-                self.hift_cache_dict[uuid]['mel'] = tts_mel
-            else:
-                self.hift_cache_dict[uuid] = {'mel': tts_mel, 'speech_offset': 0}
+            tts_mel = self.flow_inference(token, prompt_token, prompt_feat, embedding, token_offset, session, stream=stream, finalize=finalize,
+                                          n_timesteps=n_timesteps, solver=solver)
             if speed != 1.0:
                 assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
-            tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
-            self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
+            # NOTE hift_cache keeps the streaming state of causal hift, only new mel frames are vocoded
+            tts_speech, session.hift_cache = self.hift.inference_chunk(speech_feat=tts_mel, cache=session.hift_cache, finalize=finalize)
         return tts_speech
@@ -0,0 +1,294 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from cosyvoice.utils.common import update_window
+from cosyvoice.utils.mask import make_pad_mask
+
+
+class FlowBatchScheduler:
+    """Cross request dynamic batching of the flow matching decoder.
+
+    Every session prepares its decoder input (encoder, conds, speaker embedding) in its own thread,
+    then a single worker thread collects the pending requests within batch_window seconds, pads them
+    into one batch and runs the ode solver once, so each estimator call is one [2B, 80, T] batch.
+    It has the same inference interface as CausalMaskedDiffWithXvec/CausalMaskedDiffWithDiT.
+    """
+
+    def __init__(self,
+                 flow: torch.nn.Module,
+                 max_batch_size: int = 16,
+                 batch_window: float = 0.01,
+                 fp16: bool = False,
+                 n_timesteps: int = 10,
+                 background: bool = True):
+        assert isinstance(flow.decoder.estimator, torch.nn.Module), 'trt estimator is built with fixed batch size, do not use batch scheduler'
+        self.flow = flow
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.fp16 = fp16
+        self.n_timesteps = n_timesteps
+        self.request_queue = queue.Queue()
+        # NOTE background is False for offline inference_batch, which decodes in the caller thread
+        self.batch_thread = threading.Thread(target=self.batch_job, daemon=True) if background is True else None
+        if self.batch_thread is not None:
+            self.batch_thread.start()
+
+    def inference(self,
+                  token,
+                  token_len,
+                  prompt_token,
+                  prompt_token_len,
+                  prompt_feat,
+                  prompt_feat_len,
+                  embedding,
+                  streaming,
+                  finalize,
+                  n_timesteps=None,
+                  solver=None):
+        mu, spks, conds, mel_len1 = self.flow.prepare_decoder_input(token, token_len, prompt_token, prompt_token_len,
+                                                                    prompt_feat, prompt_feat_len, embedding, streaming, finalize)
+        request = {'mu': mu, 'spks': spks, 'conds': conds, 'mel_len1': mel_len1, 'streaming': streaming,
+                   'n_timesteps': self.n_timesteps if n_timesteps is None else n_timesteps, 'solver': solver, 'future': Future()}
+        self.request_queue.put(request)
+        return request['future'].result(), None
+
+    def inference_batch(self, inputs):
+        """decode several non streaming requests as one batch in the caller thread, inputs are keyword arguments of inference"""
+        requests = []
+        for kwargs in inputs:
+            kwargs = dict(kwargs)
+            n_timesteps, solver = kwargs.pop('n_timesteps', None), kwargs.pop('solver', None)
+            mu, spks, conds, mel_len1 = self.flow.prepare_decoder_input(**kwargs)
+            requests.append({'mu': mu, 'spks': spks, 'conds': conds, 'mel_len1': mel_len1, 'streaming': False,
+                             'n_timesteps': self.n_timesteps if n_timesteps is None else n_timesteps, 'solver': solver, 'future': Future()})
+        for batch in self.group(requests):
+            for i in range(0, len(batch), self.max_batch_size):
+                self.decode(batch[i: i + self.max_batch_size])
+        return [r['future'].result() for r in requests]
+
+    @staticmethod
+    def group(requests):
+        # NOTE streaming and non streaming requests use different attention masks, requests with different solver settings
+        # run different estimator calls, decode them separately
+        groups = {}
+        for r in requests:
+            groups.setdefault((r['streaming'], r['n_timesteps'], r['solver']), []).append(r)
+        return list(groups.values())
+
+    def batch_job(self):
+        while True:
+            requests = [self.request_queue.get()]
+            deadline = time.time() + self.batch_window
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.request_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            for batch in self.group(requests):
+                self.decode(batch)
+
+    def decode(self, requests):
+        try:
+            mel_len = torch.tensor([r['mu'].shape[2] for r in requests])
+            mu = torch.zeros(len(requests), requests[0]['mu'].shape[1], mel_len.max().item(), device=requests[0]['mu'].device, dtype=requests[0]['mu'].dtype)
+            conds = torch.zeros_like(mu)
+            for i, r in enumerate(requests):
+                mu[i, :, :mel_len[i]] = r['mu'][0]
+                conds[i, :, :mel_len[i]] = r['conds'][0]
+            spks = torch.concat([r['spks'] for r in requests], dim=0)
+            mask = (~make_pad_mask(mel_len)).to(mu)
+            with torch.cuda.amp.autocast(self.fp16):
+                feat, _ = self.flow.decoder(
+                    mu=mu,
+                    mask=mask.unsqueeze(1),
+                    spks=spks,
+                    cond=conds,
+                    n_timesteps=requests[0]['n_timesteps'],
+                    streaming=requests[0]['streaming'],
+                    solver=requests[0]['solver']
+                )
+            for i, r in enumerate(requests):
+                r['future'].set_result(feat[i:i + 1, :, r['mel_len1']:mel_len[i]].float())
+        except Exception as e:
+            for r in requests:
+                if not r['future'].done():
+                    r['future'].set_exception(e)
+
+
+class LLMBatchScheduler:
+    """Continuous batching decode loop of Qwen2LM/CosyVoice3LM when vllm is not loaded.
+
+    A worker thread keeps a left padded kv cache of all active sequences, new requests are prefilled
+    and joined between steps, every step decodes one token for all active sequences in a single forward,
+    sampling_ids runs once on the whole batch, finished or aborted sequences are evicted from the cache.
+    """
+
+    def __init__(self,
+                 llm: torch.nn.Module,
+                 max_batch_size: int = 16,
+                 fp16: bool = False,
+                 background: bool = True):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.fp16 = fp16
+        self.request_queue = queue.Queue()
+        # NOTE state of active sequences, only accessed by batch thread
+        self.active = []
+        self.cache = None
+        self.mask = None
+        self.window = None
+        # NOTE background is False for offline inference_batch, which decodes in the caller thread
+        self.batch_thread = threading.Thread(target=self.batch_job, daemon=True) if background is True else None
+        if self.batch_thread is not None:
+            self.batch_thread.start()
+
+    def inference(self, lm_input, sampling, min_len, max_len):
+        request = {'lm_input': lm_input, 'sampling': sampling, 'min_len': min_len, 'max_len': max_len,
+                   'out_tokens': [], 'output_queue': queue.Queue(), 'aborted': False}
+        self.request_queue.put(request)
+        try:
+            while True:
+                top_ids = request['output_queue'].get()
+                if isinstance(top_ids, Exception):
+                    raise top_ids
+                if top_ids is None:
+                    break
+                yield top_ids
+        finally:
+            request['aborted'] = True
+
+    def inference_batch(self, lm_inputs, sampling, min_lens, max_lens):
+        """decode several requests to their own eos in the caller thread, only for scheduler created with background=False"""
+        assert self.batch_thread is None, 'inference_batch shares state with the batch thread, create scheduler with background=False'
+        requests = [{'lm_input': lm_input, 'sampling': sampling, 'min_len': min_len, 'max_len': max_len,
+                     'out_tokens': [], 'output_queue': queue.Queue(), 'aborted': False}
+                    for lm_input, min_len, max_len in zip(lm_inputs, min_lens, max_lens)]
+        with torch.inference_mode(), torch.cuda.amp.autocast(self.fp16):
+            for i in range(0, len(requests), self.max_batch_size):
+                for request in requests[i: i + self.max_batch_size]:
+                    self.join(request)
+                while len(self.active) != 0:
+                    self.step()
+        return [request['out_tokens'] for request in requests]
+
+    def batch_job(self):
+        while True:
+            # wait for new request only when there is no active sequence
+            requests = [self.request_queue.get()] if len(self.active) == 0 else []
+            while len(self.active) + len(requests) < self.max_batch_size:
+                try:
+                    requests.append(self.request_queue.get(block=False))
+                except queue.Empty:
+                    break
+            try:
+                with torch.inference_mode(), torch.cuda.amp.autocast(self.fp16):
+                    for request in requests:
+                        if request['aborted'] is False:
+                            self.join(request)
+                    if len(self.active) != 0:
+                        self.step()
+            except Exception as e:
+                for request in self.active + [r for r in requests if all(r is not a for a in self.active)]:
+                    request['output_queue'].put(e)
+                self.active, self.cache, self.mask, self.window = [], None, None, None
+
+    def forward(self, xs, masks, position_ids, cache):
+        # NOTE run Qwen2Model instead of Qwen2ForCausalLM, the hidden state is the same and the unused text lm_head is skipped
+        outs = self.llm.llm.model.model(
+            inputs_embeds=xs,
+            attention_mask=masks,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(cache) if cache is not None else None,
+            use_cache=True,
+            return_dict=True,
+        )
+        new_cache = outs.past_key_values
+        new_cache = new_cache.to_legacy_cache() if isinstance(new_cache, DynamicCache) else new_cache
+        return self.llm.llm_decoder(outs.last_hidden_state[:, -1]).log_softmax(dim=-1), new_cache
+
+    def sample(self, requests, logp, window):
+        """sample one token for all requests in a single call, return indices of unfinished requests and the updated window"""
+        top_ids = self.llm.sampling_ids(logp, window, [request['sampling'] for request in requests],
+                                        ignore_eos=[len(request['out_tokens']) < request['min_len'] for request in requests])
+        keep = []
+        for i, (request, top_id) in enumerate(zip(requests, top_ids)):
+            if top_id in self.llm.stop_token_ids:
+                request['output_queue'].put(None)
+                continue
+            request['output_queue'].put(top_id)
+            request['out_tokens'].append(top_id)
+            if len(request['out_tokens']) == request['max_len']:
+                request['output_queue'].put(None)
+                continue
+            keep.append(i)
+        return keep, update_window(window, torch.tensor(top_ids, device=window.device))
+
+    def join(self, request):
+        if request['max_len'] <= 0:
+            request['output_queue'].put(None)
+            return
+        lm_input = request['lm_input']
+        logp, cache = self.forward(lm_input, None, None, None)
+        keep, window = self.sample([request], logp, self.llm.init_sampling_window(1, lm_input.device))
+        if len(keep) == 0:
+            return
+        mask = torch.ones(1, lm_input.shape[1], dtype=torch.bool, device=lm_input.device)
+        if self.cache is None:
+            self.active, self.cache, self.mask, self.window = [request], cache, mask, window
+            return
+        # NOTE left pad the shorter side, so that all sequences append the new token at the same position
+        pad1, pad2 = max(mask.shape[1] - self.mask.shape[1], 0), max(self.mask.shape[1] - mask.shape[1], 0)
+        self.cache = tuple((torch.concat([F.pad(k1, (0, 0, pad1, 0)), F.pad(k2, (0, 0, pad2, 0))], dim=0),
+                            torch.concat([F.pad(v1, (0, 0, pad1, 0)), F.pad(v2, (0, 0, pad2, 0))], dim=0))
+                           for (k1, v1), (k2, v2) in zip(self.cache, cache))
+        self.mask = torch.concat([F.pad(self.mask, (pad1, 0)), F.pad(mask, (pad2, 0))], dim=0)
+        self.window = torch.concat([self.window, window], dim=0)
+        self.active.append(request)
+
+    def step(self):
+        keep = [i for i, request in enumerate(self.active) if request['aborted'] is False]
+        if len(keep) != len(self.active):
+            self.evict(keep)
+            if len(self.active) == 0:
+                return
+        top_ids = torch.tensor([request['out_tokens'][-1] for request in self.active], device=self.mask.device)
+        xs = self.llm.speech_embedding.weight[top_ids].unsqueeze(dim=1)
+        self.mask = F.pad(self.mask, (0, 1), value=True)
+        position_ids = self.mask.sum(dim=1, keepdim=True) - 1
+        logp, self.cache = self.forward(xs, self.mask.long(), position_ids, self.cache)
+        keep, self.window = self.sample(self.active, logp, self.window)
+        if len(keep) != len(self.active):
+            self.evict(keep)
+
+    def evict(self, keep):
+        self.active = [self.active[i] for i in keep]
+        if len(keep) == 0:
+            self.cache, self.mask, self.window = None, None, None
+            return
+        index = torch.tensor(keep, device=self.mask.device)
+        self.mask = self.mask.index_select(0, index)
+        self.window = self.window.index_select(0, index)
+        # NOTE drop the columns which are padding for all remaining sequences
+        start = self.mask.any(dim=0).nonzero()[0].item()
+        self.mask = self.mask[:, start:]
+        self.cache = tuple((k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]) for k, v in self.cache)
@@ -15,7 +15,7 @@ from torch import nn
 import torch.nn.functional as F
 from einops import repeat
 from x_transformers.x_transformers import RotaryEmbedding
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask_with_cache
 from cosyvoice.flow.DiT.modules import (
     TimestepEmbedding,
     ConvNeXtV2Block,
@@ -78,6 +78,7 @@ class InputEmbedding(nn.Module):
         super().__init__()
         spk_dim = 0 if spk_dim is None else spk_dim
         self.spk_dim = spk_dim
+        self.mel_dim = mel_dim
         self.proj = nn.Linear(mel_dim * 2 + text_dim + spk_dim, out_dim)
         self.conv_pos_embed = CausalConvPositionEmbedding(dim=out_dim)
 
@@ -97,6 +98,52 @@ class InputEmbedding(nn.Module):
         x = self.conv_pos_embed(x) + x
         return x
 
+    def project_const(
+            self,
+            cond: float["b n d"],
+            text_embed: float["b n d"],
+            spks: float["b d"],
+    ):
+        # NOTE proj is linear, so the part of cond/text_embed/spks is computed once and shared by every step
+        to_cat = [cond, text_embed]
+        if self.spk_dim > 0:
+            spks = repeat(spks, "b c -> b t c", t=cond.shape[1])
+            to_cat.append(spks)
+        const = torch.cat(to_cat, dim=-1)
+        # NOTE dynamic quantized proj can not be split by input columns, keep the raw inputs for it
+        if not isinstance(self.proj, nn.Linear):
+            return const
+        return F.linear(const, self.proj.weight[:, self.mel_dim:], self.proj.bias)
+
+    def forward_step(
+            self,
+            x: float["b n d"],
+            const: float["b n d"],
+    ):
+        if isinstance(self.proj, nn.Linear):
+            x = F.linear(x, self.proj.weight[:, :self.mel_dim]) + const
+        else:
+            x = self.proj(torch.cat([x, const], dim=-1))
+        x = self.conv_pos_embed(x) + x
+        return x
+
+    def forward_chunk(
+            self,
+            x: float["b n d"],
+            cond: float["b n d"],
+            text_embed: float["b n d"],
+            spks: float["b d"],
+            cache: tuple | None = None,
+    ):
+        to_cat = [x, cond, text_embed]
+        if self.spk_dim > 0:
+            spks = repeat(spks, "b c -> b t c", t=x.shape[1])
+            to_cat.append(spks)
+
+        x = self.proj(torch.cat(to_cat, dim=-1))
+        conv_pos_embed, cache = self.conv_pos_embed.forward_chunk(x, cache)
+        return conv_pos_embed + x, cache
+
 
 # Transformer backbone using DiT blocks
 
@@ -143,34 +190,98 @@ class DiT(nn.Module):
         self.num_decoding_left_chunks = num_decoding_left_chunks
 
     def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+        return self.forward_step(x, t, self.prepare(mask, mu, spks, cond, streaming=streaming))
+
+    def prepare(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Step invariant part of forward, mask/mu/spks/cond stay the same over all estimator calls of one ode solve.
+           Returns the context of forward_step: constant input projection, rope, attention mask and time embedding cache.
+        """
+        mu = mu.transpose(1, 2)
+        cond = cond.transpose(1, 2)
+        seq_len = mu.shape[1]
+
+        # c: context (text + masked cond audio)
+        const = self.input_embed.project_const(cond, mu, spks)
+
+        rope = self.rotary_embed.forward_from_seq_len(seq_len)
+
+        if streaming is True:
+            attn_mask = add_optional_chunk_mask(mu, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+        else:
+            attn_mask = add_optional_chunk_mask(mu, mask.bool(), False, False, 0, 0, -1).repeat(1, seq_len, 1).unsqueeze(dim=1)
+        return {'const': const, 'rope': rope, 'attn_mask': attn_mask.bool(), 'time_embed': {}}
+
+    def forward_step(self, x, t, context):
+        """Forward with the context of prepare, x may be the first rows of the prepared batch.
+           t is a (b,) tensor, or a float shared by the batch whose time embedding is cached in context.
+        """
+        x = x.transpose(1, 2)
+        batch = x.shape[0]
+
+        # t: conditioning time, x: noised input audio
+        if isinstance(t, float):
+            if t not in context['time_embed']:
+                context['time_embed'][t] = self.time_embed(torch.full((1,), t, device=x.device, dtype=x.dtype))
+            t = context['time_embed'][t].expand(batch, -1)
+        else:
+            if t.ndim == 0:
+                t = t.repeat(batch)
+            t = self.time_embed(t)
+        x = self.input_embed.forward_step(x, context['const'][:batch])
+
+        if self.long_skip_connection is not None:
+            residual = x
+
+        attn_mask, rope = context['attn_mask'][:batch], context['rope']
+        for block in self.transformer_blocks:
+            x = block(x, t, mask=attn_mask, rope=rope)
+
+        if self.long_skip_connection is not None:
+            x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
+
+        x = self.norm_out(x, t)
+        output = self.proj_out(x).transpose(1, 2)
+        return output
+
+    def forward_chunk(self, x, mu, t, spks=None, cond=None, offset=0, cache=None):
+        """Forward just one chunk in streaming mode, the result equals to forward(streaming=True)
+           on the whole prefix when num_decoding_left_chunks < 0.
+           x/mu/cond: (b, c, n) starts at a static_chunk_size boundary, offset: number of frames
+           processed by previous chunks, cache: returned by last call, None for first chunk.
+        """
         x = x.transpose(1, 2)
         mu = mu.transpose(1, 2)
         cond = cond.transpose(1, 2)
-        spks = spks.unsqueeze(dim=1)
         batch, seq_len = x.shape[0], x.shape[1]
         if t.ndim == 0:
             t = t.repeat(batch)
+        if cache is None:
+            cache = {'conv_cache': None, 'att_cache': [None] * len(self.transformer_blocks)}
 
-        # t: conditioning time, c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(t)
-        x = self.input_embed(x, cond, mu, spks.squeeze(1))
+        x, conv_cache = self.input_embed.forward_chunk(x, cond, mu, spks, cache['conv_cache'])
 
-        rope = self.rotary_embed.forward_from_seq_len(seq_len)
+        rope = self.rotary_embed(torch.arange(offset, offset + seq_len, device=self.rotary_embed.inv_freq.device))
 
         if self.long_skip_connection is not None:
             residual = x
 
-        if streaming is True:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
-        else:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1).unsqueeze(dim=1)
+        cache_size = cache['att_cache'][0].shape[1] if cache['att_cache'][0] is not None else 0
+        attn_mask = subsequent_chunk_mask_with_cache(seq_len, cache_size, offset, self.static_chunk_size, self.num_decoding_left_chunks, x.device)
+        attn_mask = attn_mask.unsqueeze(dim=0).unsqueeze(dim=0)
+        # NOTE keep num_decoding_left_chunks left chunks in att_cache when it is >= 0, the next chunk starts at a chunk boundary
+        max_cache_size = self.num_decoding_left_chunks * self.static_chunk_size if self.num_decoding_left_chunks >= 0 else -1
 
-        for block in self.transformer_blocks:
-            x = block(x, t, mask=attn_mask.bool(), rope=rope)
+        att_cache = []
+        for block, block_cache in zip(self.transformer_blocks, cache['att_cache']):
+            x, block_cache = block.forward_chunk(x, t, mask=attn_mask, rope=rope, cache=block_cache)
+            if max_cache_size >= 0:
+                block_cache = block_cache[:, max(block_cache.shape[1] - max_cache_size, 0):]
+            att_cache.append(block_cache)
 
         if self.long_skip_connection is not None:
             x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
 
         x = self.norm_out(x, t)
         output = self.proj_out(x).transpose(1, 2)
-        return output
+        return output, {'conv_cache': conv_cache, 'att_cache': att_cache}
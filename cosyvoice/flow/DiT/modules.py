@@ -143,6 +143,18 @@ class CausalConvPositionEmbedding(nn.Module):
 
         return out
 
+    def forward_chunk(self, x: float["b n d"], cache: tuple | None = None):  # noqa: F722
+        # cache: left context of conv1 and conv2 from previous chunk, None for first chunk
+        x = x.permute(0, 2, 1)
+        x = F.pad(x, (self.kernel_size - 1, 0, 0, 0)) if cache is None else torch.cat([cache[0], x], dim=2)
+        conv1_cache = x[:, :, -(self.kernel_size - 1):]
+        x = self.conv1(x)
+        x = F.pad(x, (self.kernel_size - 1, 0, 0, 0)) if cache is None else torch.cat([cache[1], x], dim=2)
+        conv2_cache = x[:, :, -(self.kernel_size - 1):]
+        x = self.conv2(x)
+        out = x.permute(0, 2, 1)
+        return out, (conv1_cache, conv2_cache)
+
 
 # rotary positional embedding related
 
@@ -342,6 +354,48 @@ class Attention(nn.Module):
         else:
             return self.processor(self, x, mask=mask, rope=rope)
 
+    def forward_chunk(
+        self,
+        x: float["b n d"],  # noised input x  # noqa: F722
+        mask: bool["b h n n_cache+n"],  # noqa: F722
+        rope=None,  # rotary position embedding for x
+        cache: float["b n_cache d_kv"] | None = None,  # noqa: F722
+    ) -> torch.Tensor:
+        # same as AttnProcessor, except that rotated key and value of previous chunks are read from cache
+        batch_size = x.shape[0]
+
+        query = self.to_q(x)
+        key = self.to_k(x)
+        value = self.to_v(x)
+
+        if rope is not None:
+            freqs, xpos_scale = rope
+            q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (1.0, 1.0)
+
+            query = apply_rotary_pos_emb(query, freqs, q_xpos_scale)
+            key = apply_rotary_pos_emb(key, freqs, k_xpos_scale)
+
+        key_value = torch.cat([key, value], dim=-1)
+        if cache is not None:
+            key_value = torch.cat([cache, key_value], dim=1)
+        key, value = key_value.chunk(2, dim=-1)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // self.heads
+        query = query.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        key = key.reshape(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        value = value.reshape(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=0.0, is_causal=False)
+        x = x.transpose(1, 2).reshape(batch_size, -1, self.heads * head_dim)
+        x = x.to(query.dtype)
+
+        # linear proj
+        x = self.to_out[0](x)
+        # dropout
+        x = self.to_out[1](x)
+        return x, key_value
+
 
 # Attention processor
 
@@ -529,6 +583,19 @@ class DiTBlock(nn.Module):
 
         return x
 
+    def forward_chunk(self, x, t, mask, rope=None, cache=None):  # x: noised input of current chunk, t: time embedding
+        norm, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.attn_norm(x, emb=t)
+
+        attn_output, cache = self.attn.forward_chunk(x=norm, mask=mask, rope=rope, cache=cache)
+
+        x = x + gate_msa.unsqueeze(1) * attn_output
+
+        ff_norm = self.ff_norm(x) * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
+        ff_output = self.ff(ff_norm)
+        x = x + gate_mlp.unsqueeze(1) * ff_output
+
+        return x, cache
+
 
 # MMDiT Block https://arxiv.org/abs/2403.03206
 
@@ -11,13 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import pack, rearrange, repeat
 from cosyvoice.utils.common import mask_to_bias
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask_with_cache
 from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
@@ -61,6 +61,15 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        if cache.size(2) == 0:
+            x = F.pad(x, (self.causal_padding, 0), value=0.0)
+        else:
+            x = torch.concat([cache, x], dim=2)
+        cache = x[:, :, -self.causal_padding:]
+        x = super(CausalConv1d, self).forward(x)
+        return x, cache
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +86,11 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, cache = self.block[0].forward_chunk(x, cache)
+        output = self.block[1:](output)
+        return output, cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +98,38 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, time_emb: torch.Tensor,
+                      cache: Tuple[torch.Tensor, torch.Tensor] = (torch.zeros(0, 0, 0), torch.zeros(0, 0, 0))) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        h, cache1 = self.block1.forward_chunk(x, cache[0])
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, cache2 = self.block2.forward_chunk(h, cache[1])
+        output = h + self.res_conv(x)
+        return output, (cache1, cache2)
+
+
+def transformer_block_forward_chunk(block: BasicTransformerBlock, hidden_states: torch.Tensor, attention_mask: torch.Tensor,
+                                    att_cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Same as BasicTransformerBlock.forward with self attention only, except that key and value
+       of previous chunks are read from att_cache (batch_size, cache_t, inner_dim * 2)
+    """
+    attn = block.attn1
+    norm_hidden_states = block.norm1(hidden_states)
+    query = attn.to_q(norm_hidden_states)
+    key_value = torch.concat([attn.to_k(norm_hidden_states), attn.to_v(norm_hidden_states)], dim=-1)
+    if att_cache.size(1) != 0:
+        key_value = torch.concat([att_cache, key_value], dim=1)
+    key, value = key_value.chunk(2, dim=-1)
+    batch_size, head_dim = hidden_states.size(0), query.size(-1) // attn.heads
+    query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    key = key.reshape(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    value = value.reshape(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+    attn_output = attn_output.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+    attn_output = attn.to_out[1](attn.to_out[0](attn_output))
+    hidden_states = attn_output + hidden_states
+    hidden_states = block.ff(block.norm3(hidden_states)) + hidden_states
+    return hidden_states, key_value
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -224,26 +270,76 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        return self.forward_step(x, t, self.prepare(mask, mu, spks, cond, streaming=streaming))
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+    def prepare(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Step invariant part of forward, mask/mu/spks/cond stay the same over all estimator calls of one ode solve.
 
-        x = pack([x, mu], "b * t")[0]
+        Args:
+            mask (torch.Tensor): shape (batch_size, 1, time)
+            mu (torch.Tensor): shape (batch_size, in_channels, time)
+            spks (torch.Tensor, optional): shape: (batch_size, condition_channels). Defaults to None.
+            cond (torch.Tensor, optional): shape (batch_size, in_channels, time)
+            streaming (bool): use chunk attention mask, only for CausalConditionalDecoder
 
+        Returns:
+            Dict: context of forward_step, the constant inputs, the masks of every unet level and caches of
+                attention bias and time embedding
+        """
+        const = [mu]
         if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
+            const.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
         if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+            const.append(cond)
+        # NOTE ConditionalDecoder always uses full attention
+        static_chunk_size = getattr(self, 'static_chunk_size', 0) if streaming is True else 0
+        masks, attn_masks = [mask], []
+        for _ in range(len(self.down_blocks)):
+            mask_down = masks[-1]
+            if static_chunk_size > 0:
+                attn_mask = add_optional_chunk_mask(mask_down.transpose(1, 2), mask_down.bool(), False, False, 0, static_chunk_size, -1)
+            else:
+                attn_mask = add_optional_chunk_mask(mask_down.transpose(1, 2), mask_down.bool(), False, False, 0, 0, -1).repeat(1, mask_down.size(2), 1)
+            attn_masks.append(attn_mask)
+            masks.append(mask_down[:, :, ::2])
+        return {'const': pack(const, "b * t")[0], 'masks': masks[:-1], 'attn_masks': attn_masks, 'attn_bias': {}, 'time_embed': {}}
+
+    def forward_step(self, x, t, context):
+        """Forward with the context of prepare, x may be the first rows of the prepared batch.
+
+        Args:
+            x (torch.Tensor): shape (batch_size, in_channels, time)
+            t (torch.Tensor or float): shape (batch_size), or a float shared by the batch whose time embedding is cached in context
+            context (Dict): returned by prepare
+
+        Returns:
+            torch.Tensor: shape (batch_size, out_channels, time)
+        """
+        batch = x.size(0)
+
+        def attn_bias(level, dtype):
+            if (level, dtype) not in context['attn_bias']:
+                context['attn_bias'][(level, dtype)] = mask_to_bias(context['attn_masks'][level], dtype)
+            return context['attn_bias'][(level, dtype)][:batch]
+
+        if isinstance(t, float):
+            if t not in context['time_embed']:
+                t_in = torch.full((1,), t, device=x.device, dtype=x.dtype)
+                context['time_embed'][t] = self.time_mlp(self.time_embeddings(t_in).to(t_in.dtype))
+            t = context['time_embed'][t].expand(batch, -1)
+        else:
+            t = self.time_embeddings(t).to(t.dtype)
+            t = self.time_mlp(t)
+
+        x = pack([x, context['const'][:batch]], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        masks = [m[:batch] for m in context['masks']]
+        for level, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = masks[level]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_bias(level, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -253,15 +349,12 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
         mask_mid = masks[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_bias(len(masks) - 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -276,8 +369,7 @@ class ConditionalDecoder(nn.Module):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_bias(len(masks), x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -288,7 +380,7 @@ class ConditionalDecoder(nn.Module):
             x = upsample(x * mask_up)
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
-        return output * mask
+        return output * context['masks'][0][:batch]
 
 
 class CausalConditionalDecoder(ConditionalDecoder):
@@ -402,23 +494,39 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
-        """Forward pass of the UNet1DConditional model.
+    def forward_chunk(self, x, mu, t, spks=None, cond=None, offset=0, cache: Optional[Dict] = None):
+        """Forward just one chunk in streaming mode, the result equals to
+           forward(streaming=True) on the whole prefix when num_decoding_left_chunks < 0.
 
         Args:
-            x (torch.Tensor): shape (batch_size, in_channels, time)
-            mask (_type_): shape (batch_size, 1, time)
-            t (_type_): shape (batch_size)
-            spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
-            cond (_type_, optional): placeholder for future use. Defaults to None.
-
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
+            x (torch.Tensor): shape (batch_size, in_channels, time), must start at a static_chunk_size boundary
+            mu (torch.Tensor): shape (batch_size, in_channels, time)
+            t (torch.Tensor): shape (batch_size)
+            spks (torch.Tensor, optional): shape: (batch_size, condition_channels). Defaults to None.
+            cond (torch.Tensor, optional): shape (batch_size, in_channels, time)
+            offset (int): number of frames processed by previous chunks
+            cache (Dict, optional): conv and attention cache returned by last call, None for first chunk
 
         Returns:
-            _type_: _description_
+            torch.Tensor: shape (batch_size, out_channels, time)
+            Dict: new cache for next chunk
         """
+        if cache is None:
+            cache = {'conv_cache': [], 'att_cache': []}
+        conv_cache, att_cache = iter(cache['conv_cache']), iter(cache['att_cache'])
+        new_conv_cache, new_att_cache = [], []
+        # NOTE keep num_decoding_left_chunks left chunks in att_cache when it is >= 0, the next chunk starts at a chunk boundary
+        max_cache_size = self.num_decoding_left_chunks * self.static_chunk_size if self.num_decoding_left_chunks >= 0 else -1
+
+        def transformer_blocks_forward_chunk(x, transformer_blocks, attn_mask):
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, att_cache_i = transformer_block_forward_chunk(transformer_block, x, attn_mask, next(att_cache, torch.zeros(0, 0, 0)))
+                if max_cache_size >= 0:
+                    att_cache_i = att_cache_i[:, max(att_cache_i.size(1) - max_cache_size, 0):]
+                new_att_cache.append(att_cache_i)
+            return rearrange(x, "b t c -> b c t").contiguous()
+
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
@@ -430,65 +538,33 @@ class CausalConditionalDecoder(ConditionalDecoder):
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
+        cache_size = cache['att_cache'][0].size(1) if len(cache['att_cache']) != 0 else 0
+        attn_mask = subsequent_chunk_mask_with_cache(x.size(2), cache_size, offset, self.static_chunk_size, self.num_decoding_left_chunks, x.device)
+        attn_mask = mask_to_bias(attn_mask, x.dtype).unsqueeze(0).unsqueeze(0)
+
         hiddens = []
-        masks = [mask]
         for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            x, resnet_cache = resnet.forward_chunk(x, t, next(conv_cache, (torch.zeros(0, 0, 0), torch.zeros(0, 0, 0))))
+            new_conv_cache.append(resnet_cache)
+            x = transformer_blocks_forward_chunk(x, transformer_blocks, attn_mask)
             hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+            x, downsample_cache = downsample.forward_chunk(x, next(conv_cache, torch.zeros(0, 0, 0)))
+            new_conv_cache.append(downsample_cache)
 
         for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            x, resnet_cache = resnet.forward_chunk(x, t, next(conv_cache, (torch.zeros(0, 0, 0), torch.zeros(0, 0, 0))))
+            new_conv_cache.append(resnet_cache)
+            x = transformer_blocks_forward_chunk(x, transformer_blocks, attn_mask)
 
         for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
-        output = self.final_proj(x * mask_up)
-        return output * mask
+            x, resnet_cache = resnet.forward_chunk(x, t, next(conv_cache, (torch.zeros(0, 0, 0), torch.zeros(0, 0, 0))))
+            new_conv_cache.append(resnet_cache)
+            x = transformer_blocks_forward_chunk(x, transformer_blocks, attn_mask)
+            x, upsample_cache = upsample.forward_chunk(x, next(conv_cache, torch.zeros(0, 0, 0)))
+            new_conv_cache.append(upsample_cache)
+        x, final_block_cache = self.final_block.forward_chunk(x, next(conv_cache, torch.zeros(0, 0, 0)))
+        new_conv_cache.append(final_block_cache)
+        output = self.final_proj(x)
+        return output, {'conv_cache': new_conv_cache, 'att_cache': new_att_cache}
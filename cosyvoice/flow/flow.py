@@ -107,7 +107,9 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -136,9 +138,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -179,6 +182,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         self.only_mask_loss = only_mask_loss
         self.token_mel_ratio = token_mel_ratio
         self.pre_lookahead_len = pre_lookahead_len
+        # NOTE static chunk size in token, inference_chunk must be called on chunk boundary
+        self.chunk_size = self.encoder.static_chunk_size
 
     def forward(
             self,
@@ -236,7 +241,45 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver=None):
+        mu, embedding, conds, mel_len1 = self.prepare_decoder_input(token, token_len, prompt_token, prompt_token_len,
+                                                                    prompt_feat, prompt_feat_len, embedding, streaming, finalize)
+        mel_len2 = mu.shape[2] - mel_len1
+        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(mu)
+        feat, _ = self.decoder(
+            mu=mu,
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver
+        )
+        feat = feat[:, :, mel_len1:]
+        assert feat.shape[2] == mel_len2
+        return feat.float(), None
+
+    @torch.inference_mode()
+    def prepare_decoder_input(self,
+                              token,
+                              token_len,
+                              prompt_token,
+                              prompt_token_len,
+                              prompt_feat,
+                              prompt_feat_len,
+                              embedding,
+                              streaming,
+                              finalize):
+        """Everything in inference before the flow matching decoder, so that decoder of several requests can be batched.
+
+        Returns:
+            torch.Tensor: (1, output_size, mel_len) mu
+            torch.Tensor: (1, output_size) projected speaker embedding
+            torch.Tensor: (1, output_size, mel_len) conds
+            int: prompt mel len
+        """
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -260,19 +303,91 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
+        return h.transpose(1, 2).contiguous(), embedding, conds, mel_len1
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
-        feat, _ = self.decoder(
+    @torch.inference_mode()
+    def setup_cache(self,
+                    prompt_token,
+                    prompt_feat,
+                    embedding,
+                    n_timesteps=10,
+                    solver=None):
+        """Build the session cache for inference_chunk, the chunk aligned part of prompt is encoded in advance,
+           whose lookahead tokens are also prompt tokens, the rest is encoded together with the first chunk.
+           The cache holds the projected embedding, the prompt cond and the encoder/decoder state of the prompt,
+           inference_chunk never modifies it in place, so it can be shared by all sessions with the same prompt.
+
+        Args:
+            prompt_token (torch.Tensor): (1, prompt_token_len)
+            prompt_feat (torch.Tensor): (1, prompt_feat_len, output_size)
+            embedding (torch.Tensor): (1, spk_embed_dim)
+            n_timesteps (int): number of diffusion steps
+            solver (str, optional): ode solver of the decoder, None means cfm_params.solver
+        Returns:
+            Dict: cache for inference_chunk
+        """
+        assert prompt_token.shape[0] == 1
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+        cache = {'embedding': embedding, 'prompt_feat': prompt_feat.transpose(1, 2), 'n_timesteps': n_timesteps, 'solver': solver,
+                 'token': prompt_token[:, :0], 'token_offset': 0, 'encoder_cache': None, 'decoder_cache': None}
+        prompt_chunk_len = (prompt_token.shape[1] - self.pre_lookahead_len) // self.chunk_size * self.chunk_size
+        if prompt_chunk_len > 0:
+            _, cache = self.inference_chunk(prompt_token[:, :prompt_chunk_len + self.pre_lookahead_len], cache, finalize=False)
+        cache['token'] = prompt_token[:, prompt_chunk_len:]
+        return cache
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        cache,
+                        finalize):
+        """Incremental streaming inference, only the new tokens are encoded and decoded.
+
+        Args:
+            token (torch.Tensor): (1, token_len) speech tokens received after last call, the last
+                pre_lookahead_len tokens are used as lookahead context when finalize is False
+            cache (Dict): returned by setup_cache or last call, it is not modified in place
+            finalize (bool): whether it is the last chunk
+        Returns:
+            torch.Tensor: (1, output_size, mel_len) mel of new tokens, prompt part is excluded
+            Dict: new cache
+        """
+        cache = dict(cache)
+        token = torch.concat([cache['token'], token.to(cache['token'])], dim=1)
+        if finalize is False:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            cache['token'] = context
+        else:
+            context = token[:, :0]
+            cache['token'] = token[:, :0]
+        if token.shape[1] == 0:
+            return torch.zeros(1, self.output_size, 0, device=token.device), cache
+        token = self.input_embedding(torch.clamp(token, min=0))
+        context = self.input_embedding(torch.clamp(context, min=0))
+
+        # text encode
+        h, cache['encoder_cache'] = self.encoder.forward_chunk(token, context=context, cache=cache['encoder_cache'])
+        h = self.encoder_proj(h)
+        mel_offset = cache['token_offset'] * self.token_mel_ratio
+        cache['token_offset'] += token.shape[1]
+
+        # get conditions
+        prompt_feat = cache['prompt_feat'][:, :, mel_offset:mel_offset + h.shape[1]]
+        conds = torch.zeros([1, self.output_size, h.shape[1]], device=token.device).to(h.dtype)
+        conds[:, :, :prompt_feat.shape[2]] = prompt_feat
+
+        feat, cache['decoder_cache'] = self.decoder.forward_chunk(
             mu=h.transpose(1, 2).contiguous(),
-            mask=mask.unsqueeze(1),
-            spks=embedding,
+            spks=cache['embedding'],
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=cache['n_timesteps'],
+            cache=cache['decoder_cache'],
+            solver=cache['solver']
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None
+        feat = feat[:, :, max(cache['prompt_feat'].shape[2] - mel_offset, 0):]
+        return feat.float(), cache
 
 
 class CausalMaskedDiffWithDiT(torch.nn.Module):
@@ -308,6 +423,8 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
         self.decoder = decoder
         self.only_mask_loss = only_mask_loss
         self.token_mel_ratio = token_mel_ratio
+        # NOTE static chunk size in token, inference_chunk must be called on chunk boundary
+        self.chunk_size = self.decoder.estimator.static_chunk_size // self.token_mel_ratio
 
     def forward(
             self,
@@ -365,7 +482,45 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver=None):
+        mu, embedding, conds, mel_len1 = self.prepare_decoder_input(token, token_len, prompt_token, prompt_token_len,
+                                                                    prompt_feat, prompt_feat_len, embedding, streaming, finalize)
+        mel_len2 = mu.shape[2] - mel_len1
+        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(mu)
+        feat, _ = self.decoder(
+            mu=mu,
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver
+        )
+        feat = feat[:, :, mel_len1:]
+        assert feat.shape[2] == mel_len2
+        return feat.float(), None
+
+    @torch.inference_mode()
+    def prepare_decoder_input(self,
+                              token,
+                              token_len,
+                              prompt_token,
+                              prompt_token_len,
+                              prompt_feat,
+                              prompt_feat_len,
+                              embedding,
+                              streaming,
+                              finalize):
+        """Everything in inference before the flow matching decoder, so that decoder of several requests can be batched.
+
+        Returns:
+            torch.Tensor: (1, output_size, mel_len) mu
+            torch.Tensor: (1, output_size) projected speaker embedding
+            torch.Tensor: (1, output_size, mel_len) conds
+            int: prompt mel len
+        """
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -388,19 +543,92 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
+        return h.transpose(1, 2).contiguous(), embedding, conds, mel_len1
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
-        feat, _ = self.decoder(
+    @torch.inference_mode()
+    def setup_cache(self,
+                    prompt_token,
+                    prompt_feat,
+                    embedding,
+                    n_timesteps=10,
+                    solver=None):
+        """Build the session cache for inference_chunk, the chunk aligned part of prompt is encoded in advance,
+           whose lookahead tokens are also prompt tokens, the rest is encoded together with the first chunk.
+           The cache holds the projected embedding, the prompt cond and the encoder/decoder state of the prompt,
+           inference_chunk never modifies it in place, so it can be shared by all sessions with the same prompt.
+
+        Args:
+            prompt_token (torch.Tensor): (1, prompt_token_len)
+            prompt_feat (torch.Tensor): (1, prompt_feat_len, output_size)
+            embedding (torch.Tensor): (1, spk_embed_dim)
+            n_timesteps (int): number of diffusion steps
+            solver (str, optional): ode solver of the decoder, None means cfm_params.solver
+        Returns:
+            Dict: cache for inference_chunk
+        """
+        assert prompt_token.shape[0] == 1
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+        cache = {'embedding': embedding, 'prompt_feat': prompt_feat.transpose(1, 2), 'n_timesteps': n_timesteps, 'solver': solver,
+                 'token': prompt_token[:, :0], 'token_offset': 0, 'encoder_cache': None, 'decoder_cache': None}
+        prompt_chunk_len = (prompt_token.shape[1] - self.pre_lookahead_len) // self.chunk_size * self.chunk_size
+        if prompt_chunk_len > 0:
+            _, cache = self.inference_chunk(prompt_token[:, :prompt_chunk_len + self.pre_lookahead_len], cache, finalize=False)
+        cache['token'] = prompt_token[:, prompt_chunk_len:]
+        return cache
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        cache,
+                        finalize):
+        """Incremental streaming inference, only the new tokens are encoded and decoded.
+
+        Args:
+            token (torch.Tensor): (1, token_len) speech tokens received after last call, the last
+                pre_lookahead_len tokens are used as lookahead context when finalize is False
+            cache (Dict): returned by setup_cache or last call, it is not modified in place
+            finalize (bool): whether it is the last chunk
+        Returns:
+            torch.Tensor: (1, output_size, mel_len) mel of new tokens, prompt part is excluded
+            Dict: new cache
+        """
+        cache = dict(cache)
+        token = torch.concat([cache['token'], token.to(cache['token'])], dim=1)
+        if finalize is False:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            cache['token'] = context
+        else:
+            context = token[:, :0]
+            cache['token'] = token[:, :0]
+        if token.shape[1] == 0:
+            return torch.zeros(1, self.output_size, 0, device=token.device), cache
+        token = self.input_embedding(torch.clamp(token, min=0))
+        context = self.input_embedding(torch.clamp(context, min=0))
+
+        # text encode
+        encoder_cache = cache['encoder_cache'] if cache['encoder_cache'] is not None else torch.zeros(0, 0, 0)
+        h, cache['encoder_cache'] = self.pre_lookahead_layer.forward_chunk(token, context=context, cache=encoder_cache)
+        h = h.repeat_interleave(self.token_mel_ratio, dim=1)
+        mel_offset = cache['token_offset'] * self.token_mel_ratio
+        cache['token_offset'] += token.shape[1]
+
+        # get conditions
+        prompt_feat = cache['prompt_feat'][:, :, mel_offset:mel_offset + h.shape[1]]
+        conds = torch.zeros([1, self.output_size, h.shape[1]], device=token.device).to(h.dtype)
+        conds[:, :, :prompt_feat.shape[2]] = prompt_feat
+
+        feat, cache['decoder_cache'] = self.decoder.forward_chunk(
             mu=h.transpose(1, 2).contiguous(),
-            mask=mask.unsqueeze(1),
-            spks=embedding,
+            spks=cache['embedding'],
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=cache['n_timesteps'],
+            cache=cache['decoder_cache'],
+            solver=cache['solver']
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None
+        feat = feat[:, :, max(cache['prompt_feat'].shape[2] - mel_offset, 0):]
+        return feat.float(), cache
 
 
 if __name__ == '__main__':
@@ -430,3 +658,8 @@ if __name__ == '__main__':
                                         prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, prompt_embedding, streaming=True, finalize=finalize)
         pred_chunk = pred_chunk[:, :, i * model.token_mel_ratio:]
         print((pred_gt[:, :, i * model.token_mel_ratio: i * model.token_mel_ratio + pred_chunk.shape[2]] - pred_chunk).abs().max().item())
+    cache = model.setup_cache(prompt_token, prompt_feat, prompt_embedding)
+    for i in range(0, max_len, chunk_size):
+        finalize = True if i + chunk_size + context_size >= max_len else False
+        pred_chunk, cache = model.inference_chunk(token[:, 0 if i == 0 else i + context_size: i + chunk_size + context_size], cache, finalize=finalize)
+        print((pred_gt[:, :, i * model.token_mel_ratio: i * model.token_mel_ratio + pred_chunk.shape[2]] - pred_chunk).abs().max().item())
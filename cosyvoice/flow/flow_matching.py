@@ -15,7 +15,64 @@
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.common import set_all_random_seed, OrtSessionWrapper
+
+
+def euler_solver(velocity_fn, x, t_span):
+    """First order, one estimator call per step.
+
+    Args:
+        velocity_fn (Callable): velocity_fn(x, t) returns dphi_dt at x and timestep t
+        x (torch.Tensor): random noise
+        t_span (List[float]): n_timesteps + 1 timesteps from 0 to 1
+    """
+    for t, t_next in zip(t_span[:-1], t_span[1:]):
+        x = x + (t_next - t) * velocity_fn(x, t)
+    return x
+
+
+def midpoint_solver(velocity_fn, x, t_span):
+    """Second order, two estimator calls per step, the second one at the middle of the step."""
+    for t, t_next in zip(t_span[:-1], t_span[1:]):
+        dt = t_next - t
+        x_mid = x + 0.5 * dt * velocity_fn(x, t)
+        x = x + dt * velocity_fn(x_mid, t + 0.5 * dt)
+    return x
+
+
+def heun_solver(velocity_fn, x, t_span):
+    """Second order, two estimator calls per step, euler prediction corrected by the velocity at its end."""
+    for t, t_next in zip(t_span[:-1], t_span[1:]):
+        dt = t_next - t
+        dphi_dt = velocity_fn(x, t)
+        x_pred = x + dt * dphi_dt
+        x = x + 0.5 * dt * (dphi_dt + velocity_fn(x_pred, t_next))
+    return x
+
+
+def dpm_solver(velocity_fn, x, t_span):
+    """Second order multistep in the spirit of DPM-Solver++(2M), one estimator call per step.
+       The velocity of last step is reused as a linear extrapolation (variable step Adams-Bashforth), the first step is euler.
+    """
+    last_dphi_dt, last_dt = None, None
+    for t, t_next in zip(t_span[:-1], t_span[1:]):
+        dt = t_next - t
+        dphi_dt = velocity_fn(x, t)
+        if last_dphi_dt is None:
+            x = x + dt * dphi_dt
+        else:
+            r = dt / last_dt
+            x = x + dt * ((1 + 0.5 * r) * dphi_dt - 0.5 * r * last_dphi_dt)
+        last_dphi_dt, last_dt = dphi_dt, dt
+    return x
+
+
+ODE_SOLVERS = {
+    'euler': euler_solver,
+    'midpoint': midpoint_solver,
+    'heun': heun_solver,
+    'dpm': dpm_solver,
+}
 
 
 class ConditionalCFM(BASECFM):
@@ -29,12 +86,14 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # NOTE [t_start, t_end] of the timesteps which use cfg, other steps skip the uncond branch, None means cfg on all steps
+        self.inference_cfg_interval = cfm_params.get('inference_cfg_interval', None)
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2), solver=None):
         """Forward diffusion
 
         Args:
@@ -47,6 +106,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): key of ODE_SOLVERS, None means cfm_params.solver
 
         Returns:
             sample: generated mel-spectrogram
@@ -66,11 +126,38 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def use_cfg(self, t, batch_size=1):
+        """Whether the estimator call at timestep t runs classifier-free guidance
+
+        Args:
+            t (float): timestep of the estimator call
+            batch_size (int): number of requests in the batch
         """
-        Fixed euler solver for ODEs.
+        # NOTE an estimator exported with fixed batch can not run the cond half alone, keep cfg on all steps for it
+        if self.inference_cfg_interval is None or getattr(self.estimator, 'min_batch_size', 1) > batch_size:
+            return True
+        t_start, t_end = self.inference_cfg_interval
+        assert 0 <= t_start <= t_end <= 1, 'invalid inference_cfg_interval {}'.format(self.inference_cfg_interval)
+        return t_start <= t <= t_end
+
+    def get_cfg_steps(self, t_span, batch_size=1):
+        """Whether each euler step of t_span runs classifier-free guidance
+
+        Args:
+            t_span (torch.Tensor): n_timesteps interpolated
+                shape: (n_timesteps + 1,)
+            batch_size (int): number of requests in the batch
+
+        Returns:
+            cfg_steps (List[bool]): length n_timesteps
+        """
+        return [self.use_cfg(t, batch_size) for t in t_span[:-1].tolist()]
+
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, solver=None):
+        """
+        ODE solver of ODE_SOLVERS for the classifier-free guided velocity.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -82,61 +169,89 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): key of ODE_SOLVERS, None means cfm_params.solver
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+        solver = self.solver if solver is None else solver
+        assert solver in ODE_SOLVERS, 'unsupported solver {}, choose from {}'.format(solver, list(ODE_SOLVERS.keys()))
 
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         # NOTE when flow run in amp mode, x.dtype is float32, which cause nan in trt fp16 inference, so set dtype=spks.dtype
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=spks.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        for step in range(1, len(t_span)):
+        # NOTE batch layout is [cond_0, ..., cond_B-1, uncond_0, ..., uncond_B-1], B is 1 except for cross request batching
+        batch_size = mu.size(0)
+        x_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mask_in = torch.zeros([2 * batch_size, 1, x.size(2)], device=x.device, dtype=spks.dtype)
+        mu_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        t_in = torch.zeros([2 * batch_size], device=x.device, dtype=spks.dtype)
+        spks_in = torch.zeros([2 * batch_size, 80], device=x.device, dtype=spks.dtype)
+        cond_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mask_in[:batch_size] = mask
+        mask_in[batch_size:] = mask
+        mu_in[:batch_size] = mu
+        spks_in[:batch_size] = spks
+        cond_in[:batch_size] = cond
+        # NOTE masks, rope, constant input projections and time embeddings do not change over the steps, torch estimator prepares them once
+        context = self.estimator.prepare(mask_in, mu_in, spks_in, cond_in, streaming=streaming) if hasattr(self.estimator, 'prepare') else None
+
+        def velocity_fn(x, t):
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            # NOTE calls outside inference_cfg_interval run the estimator on the cond half of the batch only
+            cfg = self.use_cfg(t, batch_size)
+            estimator_batch_size = 2 * batch_size if cfg else batch_size
+            x_in[:batch_size] = x
+            x_in[batch_size:] = x
+            if context is not None:
+                dphi_dt = self.estimator.forward_step(x_in[:estimator_batch_size], t, context)
+            else:
+                t_in[:] = t
+                dphi_dt = self.forward_estimator(
+                    x_in[:estimator_batch_size], mask_in[:estimator_batch_size],
+                    mu_in[:estimator_batch_size], t_in[:estimator_batch_size],
+                    spks_in[:estimator_batch_size],
+                    cond_in[:estimator_batch_size],
+                    streaming
+                )
+            if cfg:
+                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [batch_size, batch_size], dim=0)
+                return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+            # NOTE trt writes its output into x_in, which is overwritten by the next call, while multistep solvers keep the last velocity
+            return dphi_dt if isinstance(self.estimator, torch.nn.Module) else dphi_dt.clone()
 
-        return sol[-1].float()
+        return ODE_SOLVERS[solver](velocity_fn, x, t_span.tolist()).float()
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+        """
+        Fixed euler solver for ODEs.
+        Args:
+            x (torch.Tensor): random noise
+            t_span (torch.Tensor): n_timesteps interpolated
+                shape: (n_timesteps + 1,)
+            mu (torch.Tensor): output of encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask
+                shape: (batch_size, 1, mel_timesteps)
+            spks (torch.Tensor, optional): speaker ids. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+            cond: Not used but kept for future purposes
+        """
+        return self.solve(x, t_span, mu, mask, spks, cond, streaming=streaming, solver='euler')
 
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+        elif isinstance(self.estimator, OrtSessionWrapper):
+            # NOTE same as trt, the onnx estimator is exported without streaming mask
+            return self.estimator(x, mask, mu, t, spks, cond)[0].to(x)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -201,7 +316,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, solver=None):
         """Forward diffusion
 
         Args:
@@ -214,6 +329,7 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): key of ODE_SOLVERS, None means cfm_params.solver
 
         Returns:
             sample: generated mel-spectrogram
@@ -225,4 +341,71 @@ class CausalConditionalCFM(ConditionalCFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver), None
+
+    @torch.inference_mode()
+    def forward_chunk(self, mu, spks, cond, n_timesteps=10, temperature=1.0, cache=None, solver=None):
+        """Forward diffusion of just one chunk in streaming mode, the estimator runs only on the new frames
+
+        Args:
+            mu (torch.Tensor): output of encoder of current chunk, must start at a static_chunk_size boundary
+                shape: (1, n_feats, mel_timesteps)
+            spks (torch.Tensor): speaker embedding
+                shape: (1, spk_emb_dim)
+            cond (torch.Tensor): prompt feature of current chunk, zero for non prompt frames
+                shape: (1, n_feats, mel_timesteps)
+            n_timesteps (int): number of diffusion steps
+            temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
+            cache (dict, optional): frame offset and per estimator call cache returned by last call, None for first chunk
+            solver (str, optional): key of ODE_SOLVERS, None means cfm_params.solver
+
+        Returns:
+            sample: generated mel-spectrogram of current chunk
+                shape: (1, n_feats, mel_timesteps)
+            cache: new cache for next chunk
+        """
+        assert isinstance(self.estimator, torch.nn.Module), 'chunk inference only supports torch estimator'
+        solver = self.solver if solver is None else solver
+        assert solver in ODE_SOLVERS, 'unsupported solver {}, choose from {}'.format(solver, list(ODE_SOLVERS.keys()))
+        if cache is None:
+            cache = {'offset': 0, 'n_timesteps': n_timesteps, 'solver': solver, 'estimator_cache': []}
+        assert cache['n_timesteps'] == n_timesteps and cache['solver'] == solver, 'n_timesteps and solver should not change during chunk inference'
+        offset, estimator_cache = cache['offset'], list(cache['estimator_cache'])
+        x = self.rand_noise[:, :, offset:offset + mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        if self.t_scheduler == 'cosine':
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+
+        # NOTE same cfg batch layout as solve, cond/uncond estimator caches are kept in the same batch
+        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
+        spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
+        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+        num_calls = 0
+
+        def velocity_fn(x, t):
+            # NOTE the solver calls the estimator at the same timesteps in every chunk, so the i-th call reads and updates the i-th estimator cache,
+            # and its cfg batch size, which only depends on t, is the same over chunks
+            nonlocal num_calls
+            estimator_batch_size = 2 if self.use_cfg(t) else 1
+            x_in[:] = x
+            t_in[:] = t
+            dphi_dt, call_cache = self.estimator.forward_chunk(x_in[:estimator_batch_size], mu_in[:estimator_batch_size], t_in[:estimator_batch_size],
+                                                               spks_in[:estimator_batch_size], cond_in[:estimator_batch_size],
+                                                               offset=offset, cache=estimator_cache[num_calls] if num_calls < len(estimator_cache) else None)
+            if num_calls < len(estimator_cache):
+                estimator_cache[num_calls] = call_cache
+            else:
+                estimator_cache.append(call_cache)
+            num_calls += 1
+            if estimator_batch_size == 2:
+                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            return dphi_dt
+
+        x = ODE_SOLVERS[solver](velocity_fn, x, t_span.tolist())
+        return x.float(), {'offset': offset + x.size(2), 'n_timesteps': n_timesteps, 'solver': solver, 'estimator_cache': estimator_cache}
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import List, Optional, Tuple
 import torch
 import torch.nn as nn
 try:
@@ -101,3 +102,17 @@ class CausalConvRNNF0Predictor(nn.Module):
             x = self.condnet[i](x)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
+
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[List[torch.Tensor]] = None, finalize: bool = False) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """ chunk by chunk forward, only new mel frames are fed, the lookahead frames of condnet[0]
+            and the left context of the other convs are kept in cache
+        """
+        new_cache = []
+        for i in range(len(self.condnet)):
+            if isinstance(self.condnet[i], nn.ELU):
+                x = self.condnet[i](x)
+            else:
+                x, conv_cache = self.condnet[i].forward_chunk(x, cache[len(new_cache)] if cache is not None else None, finalize=finalize)
+                new_cache.append(conv_cache)
+        x = x.transpose(1, 2)
+        return torch.abs(self.classifier(x).squeeze(-1)), new_cache
@@ -14,7 +14,7 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -22,7 +22,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
@@ -31,7 +30,7 @@ from torch.distributions.uniform import Uniform
 from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSample, CausalConv1dUpsample
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
-from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.common import init_weights, fold_weight_norm
 
 
 """hifigan based generator implementation.
@@ -116,10 +115,21 @@ class ResBlock(torch.nn.Module):
             x = xt + x
         return x
 
-    def remove_weight_norm(self):
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None) -> Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor]]]:
+        assert self.causal is True, 'chunk forward only support causal ResBlock'
+        new_cache = []
         for idx in range(len(self.convs1)):
-            remove_weight_norm(self.convs1[idx])
-            remove_weight_norm(self.convs2[idx])
+            cache1, cache2 = cache[idx] if cache is not None else (None, None)
+            xt = self.activations1[idx](x)
+            xt, cache1 = self.convs1[idx].forward_chunk(xt, cache1)
+            xt = self.activations2[idx](xt)
+            xt, cache2 = self.convs2[idx].forward_chunk(xt, cache2)
+            x = xt + x
+            new_cache.append((cache1, cache2))
+        return x, new_cache
+
+    def remove_weight_norm(self):
+        fold_weight_norm(self)
 
 
 class SineGen(torch.nn.Module):
@@ -316,6 +326,33 @@ class SineGen2(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    def forward_chunk(self, f0: torch.Tensor, cache: Optional[Dict[str, torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor, Dict[str, torch.Tensor]]:
+        """ same as forward, but continue the phase and the fixed noise of the previous chunk,
+            cache: {'offset': number of generated samples, 'phase': accumulated rad of the last frame}
+        """
+        assert self.training is False and self.causal is True and self.flag_for_pulse is False, 'chunk forward only support causal inference'
+        offset = cache['offset'] if cache is not None else 0
+        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        rad_values = (fn / self.sampling_rate) % 1
+        if offset == 0:
+            rad_values[:, 0, :] = rad_values[:, 0, :] + self.rand_ini.to(rad_values.device)
+        rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2),
+                                                     scale_factor=1 / self.upsample_scale,
+                                                     mode="linear").transpose(1, 2)
+        # NOTE cpu cumsum accumulates in float64, prepend the float64 accumulated phase so that the result equals cumsum over the whole sequence
+        phase = cache['phase'] if cache is not None else torch.zeros(rad_values.shape[0], 1, rad_values.shape[2], dtype=torch.float64, device=rad_values.device)
+        phase = torch.cumsum(torch.concat([phase, rad_values.to(phase.dtype)], dim=1), dim=1)
+        new_cache = {'offset': offset + f0.shape[1], 'phase': phase[:, -1:]}
+        phase = phase[:, 1:].to(rad_values.dtype) * 2 * np.pi
+        phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale,
+                                                scale_factor=self.upsample_scale, mode="nearest").transpose(1, 2)
+        sine_waves = torch.sin(phase) * self.sine_amp
+        uv = self._f02uv(f0)
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * self.sine_waves[:, offset:offset + sine_waves.shape[1]].to(sine_waves.device)
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, new_cache
+
 
 class SourceModuleHnNSF(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -374,6 +411,13 @@ class SourceModuleHnNSF(torch.nn.Module):
             noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[Dict[str, torch.Tensor]] = None) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        assert isinstance(self.l_sin_gen, SineGen2), 'chunk forward only support SineGen2'
+        with torch.no_grad():
+            sine_wavs, _, new_cache = self.l_sin_gen.forward_chunk(x, cache)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        return sine_merge, new_cache
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -471,22 +515,33 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # NOTE non persistent buffer, so that it follows the model device
+        self.register_buffer('stft_window', torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32)), persistent=False)
+        self.num_kernels_folded = False
+        # NOTE set by CosyVoiceModel.load_onnx, see forward_decoder
+        self.onnx_decoder = None
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
-        for l in self.ups:
-            remove_weight_norm(l)
-        for l in self.resblocks:
-            l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
-        for l in self.source_resblocks:
-            l.remove_weight_norm()
+        # NOTE m_source has no weight_norm, fold_weight_norm walks all submodules including f0_predictor
+        fold_weight_norm(self)
+
+    def freeze_for_inference(self):
+        """fold weight_norm into plain weights, fold the 1/num_kernels resblock average into the next layer
+        and precompute snake constants, the model should not be trained or loaded with state dict afterwards
+        """
+        if self.num_kernels_folded is True:
+            return
+        fold_weight_norm(self)
+        # NOTE leaky_relu is positively homogeneous and ups/conv_post are linear, so xs / num_kernels can be folded into their weights
+        with torch.no_grad():
+            for layer in list(self.ups[1:]) + [self.conv_post]:
+                layer.weight.mul_(1.0 / self.num_kernels)
+        self.num_kernels_folded = True
+        for m in self.modules():
+            if isinstance(m, Snake):
+                m.freeze_for_inference()
 
     def _stft(self, x):
         spec = torch.stft(
@@ -504,11 +559,12 @@ class HiFTGenerator(nn.Module):
                                         self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
-    def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
-
-        x = self.conv_pre(x)
+    def forward_decoder(self, x: torch.Tensor, s_stft: torch.Tensor) -> torch.Tensor:
+        """ upsampling and source fusion from conv_pre output to conv_post output, this is the part exported to onnx,
+            stft/istft and the source module stay in torch
+        """
+        if self.onnx_decoder is not None:
+            return self.onnx_decoder(x, s_stft)[0].to(x)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
@@ -527,10 +583,18 @@ class HiFTGenerator(nn.Module):
                     xs = self.resblocks[i * self.num_kernels + j](x)
                 else:
                     xs += self.resblocks[i * self.num_kernels + j](x)
-            x = xs / self.num_kernels
+            x = xs / self.num_kernels if self.num_kernels_folded is False else xs
 
         x = F.leaky_relu(x)
         x = self.conv_post(x)
+        return x
+
+    def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+
+        x = self.conv_pre(x)
+        x = self.forward_decoder(x, s_stft)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
@@ -665,7 +729,11 @@ class CausalHiFTGenerator(HiFTGenerator):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # NOTE non persistent buffer, so that it follows the model device
+        self.register_buffer('stft_window', torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32)), persistent=False)
+        self.num_kernels_folded = False
+        # NOTE set by CosyVoiceModel.load_onnx, see forward_decoder
+        self.onnx_decoder = None
         self.conv_pre_look_right = conv_pre_look_right
         self.f0_predictor = f0_predictor
 
@@ -679,28 +747,7 @@ class CausalHiFTGenerator(HiFTGenerator):
             s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
-        for i in range(self.num_upsamples):
-            x = F.leaky_relu(x, self.lrelu_slope)
-            x = self.ups[i](x)
-
-            if i == self.num_upsamples - 1:
-                x = self.reflection_pad(x)
-
-            # fusion
-            si = self.source_downs[i](s_stft)
-            si = self.source_resblocks[i](si)
-            x = x + si
-
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
-                else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
-            x = xs / self.num_kernels
-
-        x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        x = self.forward_decoder(x, s_stft)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
@@ -725,6 +772,109 @@ class CausalHiFTGenerator(HiFTGenerator):
             generated_speech = self.decode(x=speech_feat[:, :, :-self.f0_predictor.condnet[0].causal_padding], s=s, finalize=finalize)
         return generated_speech, s
 
+    def _stft_chunk(self, s: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = False) -> Tuple[torch.Tensor, Dict]:
+        """ stft of the new source samples, cache holds the samples which are not framed yet,
+            reflect padding is applied at the start of the stream and at finalize, same as center=True
+        """
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        padded = cache['padded'] if cache is not None else False
+        x = torch.concat([cache['buffer'], s], dim=1) if cache is not None else s
+        if padded is False and x.shape[1] > n_fft // 2:
+            x, padded = F.pad(x[:, None], (n_fft // 2, 0), mode='reflect')[:, 0], True
+        if finalize is True:
+            x = F.pad(x[:, None], (0, n_fft // 2), mode='reflect')[:, 0]
+        num_frame = (x.shape[1] - n_fft) // hop_len + 1 if padded is True and x.shape[1] >= n_fft else 0
+        if num_frame == 0:
+            return x.new_zeros(x.shape[0], n_fft + 2, 0), {'padded': padded, 'buffer': x}
+        spec = torch.stft(x, n_fft, hop_len, n_fft, window=self.stft_window.to(x.device), center=False, return_complex=True)
+        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+        return torch.cat([spec[..., 0], spec[..., 1]], dim=1), {'padded': padded, 'buffer': x[:, num_frame * hop_len:]}
+
+    def _istft_chunk(self, magnitude: torch.Tensor, phase: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = False) -> Tuple[torch.Tensor, Dict]:
+        """ istft of the new frames, cache holds the last frames which overlap with the samples not emitted yet,
+            only samples whose overlap-add is complete are emitted unless finalize
+        """
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        start = 0
+        if cache is not None:
+            magnitude, phase = torch.concat([cache['magnitude'], magnitude], dim=2), torch.concat([cache['phase'], phase], dim=2)
+            start = cache['start']
+        num_frame = magnitude.shape[2]
+        end = hop_len * (num_frame - 1) if finalize is True else max(hop_len * num_frame - n_fft // 2, start)
+        if end > start:
+            x = self._istft(magnitude, phase)[:, start:end]
+        else:
+            x = magnitude.new_zeros(magnitude.shape[0], 0)
+        keep = min(n_fft // hop_len - 1, num_frame)
+        return x, {'magnitude': magnitude[:, :, num_frame - keep:], 'phase': phase[:, :, num_frame - keep:], 'start': end - hop_len * (num_frame - keep)}
+
+    def decode_chunk(self, x: torch.Tensor, s_stft: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = False) -> Tuple[torch.Tensor, Dict]:
+        """ same as decode, but only new mel frames and new source stft frames are fed,
+            returns conv_post output of the frames which are ready
+        """
+        cache = {} if cache is None else cache
+        new_cache = {}
+        x, new_cache['conv_pre'] = self.conv_pre.forward_chunk(x, cache.get('conv_pre'), finalize=finalize)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, self.lrelu_slope)
+            x, new_cache['ups.{}'.format(i)] = self.ups[i].forward_chunk(x, cache.get('ups.{}'.format(i)))
+
+            new_cache['reflection_pad'] = cache.get('reflection_pad', False)
+            if i == self.num_upsamples - 1 and new_cache['reflection_pad'] is False and x.shape[2] != 0:
+                # NOTE reflection_pad only affects the first frame, afterwards it is a one frame delay which needs no state
+                x, new_cache['reflection_pad'] = self.reflection_pad(x), True
+
+            # fusion
+            si, new_cache['source_downs.{}'.format(i)] = self.source_downs[i].forward_chunk(s_stft, cache.get('source_downs.{}'.format(i)))
+            si, new_cache['source_resblocks.{}'.format(i)] = self.source_resblocks[i].forward_chunk(si, cache.get('source_resblocks.{}'.format(i)))
+            # NOTE mel branch and source branch may produce different number of frames in one chunk, keep the remaining frames
+            x = torch.concat([cache['x.{}'.format(i)], x], dim=2) if 'x.{}'.format(i) in cache else x
+            si = torch.concat([cache['si.{}'.format(i)], si], dim=2) if 'si.{}'.format(i) in cache else si
+            num_frame = min(x.shape[2], si.shape[2])
+            new_cache['x.{}'.format(i)], new_cache['si.{}'.format(i)] = x[:, :, num_frame:], si[:, :, num_frame:]
+            x = x[:, :, :num_frame] + si[:, :, :num_frame]
+
+            xs = None
+            for j in range(self.num_kernels):
+                key = 'resblocks.{}'.format(i * self.num_kernels + j)
+                xj, new_cache[key] = self.resblocks[i * self.num_kernels + j].forward_chunk(x, cache.get(key))
+                if xs is None:
+                    xs = xj
+                else:
+                    xs += xj
+            x = xs / self.num_kernels if self.num_kernels_folded is False else xs
+
+        x = F.leaky_relu(x)
+        x, new_cache['conv_post'] = self.conv_post.forward_chunk(x, cache.get('conv_post'))
+        return x, new_cache
+
+    @torch.inference_mode()
+    def inference_chunk(self, speech_feat: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = False) -> Tuple[torch.Tensor, Dict]:
+        """ stateful streaming inference, speech_feat only contains the new mel frames,
+            cache carries conv left context/lookahead buffers, SineGen phase and stft/istft overlap of one session,
+            the concatenation of all the outputs equals inference on the whole mel with finalize=True
+        """
+        cache = {} if cache is None else cache
+        # mel->f0 NOTE f0_predictor precision is crucial for causal inference, move self.f0_predictor to cpu if necessary
+        self.f0_predictor.to('cpu')
+        f0, f0_predictor_cache = self.f0_predictor.forward_chunk(speech_feat.cpu(), cache.get('f0_predictor'), finalize=finalize)
+        f0 = f0.to(speech_feat)
+        # f0->source
+        if f0.shape[1] != 0:
+            s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+            s, source_cache = self.m_source.forward_chunk(s, cache.get('source'))
+            s = s.transpose(1, 2)
+        else:
+            s, source_cache = speech_feat.new_zeros(speech_feat.shape[0], 1, 0), cache.get('source')
+        s_stft, stft_cache = self._stft_chunk(s.squeeze(1), cache.get('stft'), finalize=finalize)
+        # mel+source->speech
+        x, decode_cache = self.decode_chunk(speech_feat, s_stft, cache.get('decode'), finalize=finalize)
+        magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
+        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+        generated_speech, istft_cache = self._istft_chunk(magnitude, phase, cache.get('istft'), finalize=finalize)
+        generated_speech = torch.clamp(generated_speech, -self.audio_limit, self.audio_limit)
+        return generated_speech, {'f0_predictor': f0_predictor_cache, 'source': source_cache, 'stft': stft_cache, 'decode': decode_cache, 'istft': istft_cache}
+
 
 if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
@@ -744,3 +894,24 @@ if __name__ == '__main__':
         pred_chunk, _ = model.inference(mel[:, :, : i + chunk_size + context_size], finalize=finalize)
         pred_chunk = pred_chunk[:, i * 480:]
         print((pred_gt[:, i * 480:i * 480 + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
+    # stateful streaming, only new mel frames are fed
+    cache, speech_offset = None, 0
+    for i in range(0, max_len, chunk_size):
+        finalize = True if i + chunk_size >= max_len else False
+        pred_chunk, cache = model.inference_chunk(mel[:, :, i:i + chunk_size], cache=cache, finalize=finalize)
+        print((pred_gt[:, speech_offset:speech_offset + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
+        speech_offset += pred_chunk.shape[1]
+    assert speech_offset == pred_gt.shape[1]
+    # NOTE cpu vocoder speed before and after freeze_for_inference, weight_norm overhead matters most for short streaming chunks
+    import time
+    model.to('cpu')
+    for name in ['weight_norm', 'frozen']:
+        if name == 'frozen':
+            model.freeze_for_inference()
+        pred, _ = model.inference(mel.cpu())
+        print('{} max diff {}'.format(name, (pred - pred_gt.cpu()).abs().max().item()))
+        for mel_len in [10, 30, max_len]:
+            start_time = time.time()
+            for _ in range(10):
+                model.inference(mel[:, :, :mel_len].cpu())
+            print('{}: {:.1f} ms per {} frames'.format(name, (time.time() - start_time) * 100, mel_len))
@@ -12,20 +12,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import queue
 import random
 import time
 import threading
-from typing import Dict, Optional, Callable, List, Generator
+from collections import OrderedDict
+from typing import Dict, Optional, Callable, List, Generator, Tuple, Union
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+from transformers import Qwen2ForCausalLM, DynamicCache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import th_accuracy, update_window
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -149,19 +151,27 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, torch.Tensor],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, List[bool]] = True,
     ):
-        num_trials, max_trials = 0, 100
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (top_ids < self.speech_token_size):
-                break
-            num_trials += 1
-            if num_trials > max_trials:
-                raise RuntimeError('sampling reaches max_trials {} and still get eos when ignore_eos is True, check your input!'.format(max_trials))
-        return top_ids
+        """weighted_scores is [V] or [B, V], decoded_tokens is a token list or an on-device window from init_sampling_window,
+        ignore_eos is a bool or a list of bool per row. Return one token id, or a list of token ids for [B, V] input.
+        """
+        # NOTE ids >= speech_token_size are masked out of the distribution instead of being rejected trial by trial,
+        # which samples from the same distribution with a single host sync
+        ignore_mask = torch.arange(weighted_scores.size(-1), device=weighted_scores.device) >= self.speech_token_size
+        if isinstance(ignore_eos, bool):
+            ignore_mask = ignore_mask if ignore_eos is True else None
+        else:
+            ignore_mask = ignore_mask & torch.tensor(ignore_eos, device=weighted_scores.device).unsqueeze(dim=1)
+        top_ids = self.sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=ignore_mask)
+        return top_ids.tolist()
+
+    def init_sampling_window(self, batch_size: int, device: torch.device):
+        """on-device rolling window of decoded tokens for sampling_ids, padded with IGNORE_ID"""
+        win_size = self.sampling.keywords.get('win_size', 10) if isinstance(self.sampling, functools.partial) else 10
+        return torch.full((batch_size, win_size), IGNORE_ID, dtype=torch.long, device=device)
 
     @torch.inference_mode()
     def inference(
@@ -177,7 +187,9 @@ class TransformerLM(torch.nn.Module):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            spk_id: str = '',
     ) -> Generator[torch.Tensor, None, None]:
+        # NOTE spk_id is not used, text encoder is not causal, so the encoded prompt_text depends on text and no prefix is shared across requests
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
@@ -209,20 +221,26 @@ class TransformerLM(torch.nn.Module):
 
         # 5. step by step decode
         out_tokens = []
+        window = self.init_sampling_window(1, lm_input.device)
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # NOTE jit exported llm only has forward_chunk, otherwise use a kv cache preallocated to the longest possible sequence
+        kv_cache = None if isinstance(self.llm, torch.jit.ScriptModule) else self.llm.init_static_cache(lm_input.size(1) + max_len)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+            if kv_cache is not None:
+                y_pred = self.llm.forward_chunk_static(lm_input, kv_cache, att_mask=att_mask)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=True if i < min_len else False)
             if top_ids == self.eos_token:
                 break
             # in stream mode, yield token one by one
             yield top_ids
             out_tokens.append(top_ids)
+            window = update_window(window, top_ids)
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
@@ -258,6 +276,137 @@ class Qwen2Encoder(torch.nn.Module):
         return xs, new_cache
 
 
+class Qwen2StaticDecoder(torch.nn.Module):
+    """Decode engine for Qwen2Encoder which reuses its weights but not the HuggingFace forward.
+
+    The kv cache of every layer is preallocated to max_len positions and written by position index,
+    so a single token step always has the same shapes and can be compiled once by torch.compile.
+    Only the last hidden state is computed, the prompt prefill runs eagerly.
+    """
+
+    def __init__(self, model: Qwen2ForCausalLM, max_len: int = 2048, compile: bool = True):
+        super().__init__()
+        config = model.config
+        self.layers = model.model.layers
+        self.norm = model.model.norm
+        self.max_len = max_len
+        self.num_heads = config.num_attention_heads
+        self.num_key_value_heads = config.num_key_value_heads
+        self.head_dim = getattr(config, 'head_dim', None) or config.hidden_size // config.num_attention_heads
+        inv_freq = 1.0 / (config.rope_theta ** (torch.arange(0, self.head_dim, 2, dtype=torch.int64).float() / self.head_dim))
+        freqs = torch.outer(torch.arange(max_len).float(), inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        device = next(model.parameters()).device
+        self.register_buffer('cos', emb.cos().to(device), persistent=False)
+        self.register_buffer('sin', emb.sin().to(device), persistent=False)
+        self.register_buffer('positions', torch.arange(max_len, device=device), persistent=False)
+        self.step = torch.compile(self.forward, dynamic=False) if compile is True else self.forward
+
+    @staticmethod
+    def rotate_half(x):
+        x1, x2 = x.chunk(2, dim=-1)
+        return torch.cat((-x2, x1), dim=-1)
+
+    def forward(self, xs, position_ids, key_cache, value_cache):
+        """
+        Args:
+            xs: (1, T, D) input embeddings
+            position_ids: (T,) positions of xs, keys/values are written to these indexes of the cache
+            key_cache, value_cache: per layer list of (1, num_key_value_heads, max_len, head_dim)
+        Returns:
+            (1, T, D) normed last hidden states
+        """
+        T, groups = xs.size(1), self.num_heads // self.num_key_value_heads
+        dtype = key_cache[0].dtype
+        cos, sin = self.cos[position_ids].to(dtype), self.sin[position_ids].to(dtype)
+        # NOTE query heads sharing one kv head are folded into the time axis, so kv heads are never repeated
+        attn_mask = (self.positions.unsqueeze(0) <= position_ids.unsqueeze(1)).repeat(groups, 1)
+        for i, layer in enumerate(self.layers):
+            residual = xs
+            xs = layer.input_layernorm(xs)
+            q = layer.self_attn.q_proj(xs).view(1, T, self.num_heads, self.head_dim).transpose(1, 2).to(dtype)
+            k = layer.self_attn.k_proj(xs).view(1, T, self.num_key_value_heads, self.head_dim).transpose(1, 2).to(dtype)
+            v = layer.self_attn.v_proj(xs).view(1, T, self.num_key_value_heads, self.head_dim).transpose(1, 2).to(dtype)
+            q = q * cos + self.rotate_half(q) * sin
+            k = k * cos + self.rotate_half(k) * sin
+            key_cache[i].index_copy_(2, position_ids, k)
+            value_cache[i].index_copy_(2, position_ids, v)
+            q = q.reshape(1, self.num_key_value_heads, groups * T, self.head_dim)
+            xs = F.scaled_dot_product_attention(q, key_cache[i], value_cache[i], attn_mask=attn_mask)
+            xs = xs.reshape(1, self.num_heads, T, self.head_dim).transpose(1, 2).reshape(1, T, -1)
+            xs = residual + layer.self_attn.o_proj(xs.to(residual.dtype))
+            residual = xs
+            xs = residual + layer.mlp(layer.post_attention_layernorm(xs))
+        return self.norm(xs)
+
+    def init_cache(self, dtype, device):
+        # NOTE one tensor per layer, in place writes to a slice of a stacked cache would be copied back as a whole by torch.compile
+        shape = (1, self.num_key_value_heads, self.max_len, self.head_dim)
+        return ([torch.zeros(shape, dtype=dtype, device=device) for _ in self.layers],
+                [torch.zeros(shape, dtype=dtype, device=device) for _ in self.layers], 0)
+
+    def forward_one_step(self, xs, cache=None):
+        """Same as Qwen2Encoder.forward_one_step with a causal mask, cache is (key_cache, value_cache, offset)."""
+        if cache is None:
+            cache = self.init_cache(xs.dtype, xs.device)
+        key_cache, value_cache, offset = cache
+        assert offset + xs.size(1) <= self.max_len, 'static decoder overflow, {} > max_len {}'.format(offset + xs.size(1), self.max_len)
+        position_ids = self.positions[offset:offset + xs.size(1)]
+        if xs.size(1) == 1:
+            xs = self.step(xs, position_ids, key_cache, value_cache)
+        else:
+            xs = self.forward(xs, position_ids, key_cache, value_cache)
+        return xs, (key_cache, value_cache, offset + position_ids.size(0))
+
+
+class Qwen2PrefixCache:
+    """LRU of the kv state of llm input prefixes shared by many requests, e.g. [sos, prompt_text] of a registered speaker.
+
+    An entry is the per layer (1, num_key_value_heads, prefix_len, head_dim) keys and values of the prefix positions,
+    the total size of all entries is bounded by max_mb. Entries are never written after insertion, every request forks
+    the entry into its own kv cache, so one entry may be used by concurrent requests.
+    """
+
+    def __init__(self, max_mb: float = 256):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_bytes(entry):
+        return sum(i.numel() * i.element_size() for i in entry[0] + entry[1])
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, keys, values):
+        entry = (keys, values)
+        entry_bytes = self.entry_bytes(entry)
+        if entry_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= self.entry_bytes(self.entries.pop(key))
+            self.entries[key] = entry
+            self.num_bytes += entry_bytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= self.entry_bytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+
 class Qwen2LM(TransformerLM):
     def __init__(
             self,
@@ -451,10 +600,32 @@ class Qwen2LM(TransformerLM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            spk_id: str = '',
     ) -> Generator[torch.Tensor, None, None]:
+        lm_input, min_len, max_len = self.prepare_inference_input(text, text_len, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len,
+                                                                  max_token_text_ratio, min_token_text_ratio)
+        # NOTE [sos, prompt_text] is the same for every request of a registered speaker, its kv state is shared by prefix_cache
+        prefix = None
+        if spk_id != '' and getattr(self, 'prefix_cache', None) is not None:
+            prefix = ((spk_id, tuple(prompt_text.flatten().tolist())), 1 + prompt_text.shape[1])
+
+        # 5. step by step decode
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, prefix=prefix):
+            yield token
+
+    def prepare_inference_input(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+    ) -> Tuple[torch.Tensor, int, int]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
-        text_len += prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
 
         # 3. concat llm_input
@@ -467,15 +638,45 @@ class Qwen2LM(TransformerLM):
         lm_input = torch.concat([sos_emb, text, task_id_emb, prompt_speech_token_emb], dim=1)
 
         # 4. cal min/max_length
-        min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
-        max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
+        min_len = int(text_len * min_token_text_ratio)
+        max_len = int(text_len * max_token_text_ratio)
+        return lm_input, min_len, max_len
 
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
-            yield token
+    def prefill_prefix(self, prefix, lm_input, static_decoder=None):
+        """Forward the prefix of lm_input once per prefix key, later requests fork its kv state from prefix_cache.
+
+        Args:
+            prefix: (key, prefix_len) of lm_input[:, :prefix_len]
+            lm_input: (1, T, D) llm input of this request
+            static_decoder: Qwen2StaticDecoder when the request is decoded by it, else None
+        Returns:
+            kv cache of lm_input[:, :prefix_len] owned by this request, and lm_input[:, prefix_len:] to forward next
+        """
+        key, prefix_len = prefix
+        entry = self.prefix_cache.get(key)
+        if entry is None:
+            if static_decoder is not None:
+                _, cache = static_decoder.forward_one_step(lm_input[:, :prefix_len])
+                keys, values = [k[:, :, :prefix_len].clone() for k in cache[0]], [v[:, :, :prefix_len].clone() for v in cache[1]]
+            else:
+                _, cache = self.llm.forward_one_step(lm_input[:, :prefix_len],
+                                                     masks=torch.tril(torch.ones((1, prefix_len, prefix_len), device=lm_input.device)).to(torch.bool),
+                                                     cache=None)
+                keys, values = [cache[i][0].clone() for i in range(len(cache))], [cache[i][1].clone() for i in range(len(cache))]
+            self.prefix_cache.put(key, keys, values)
+        elif static_decoder is not None:
+            key_cache, value_cache, _ = static_decoder.init_cache(lm_input.dtype, lm_input.device)
+            for i in range(len(key_cache)):
+                key_cache[i][:, :, :prefix_len] = entry[0][i]
+                value_cache[i][:, :, :prefix_len] = entry[1][i]
+            cache = (key_cache, value_cache, prefix_len)
+        else:
+            # NOTE DynamicCache concats new keys/values into new tensors, the cached entry is never modified
+            cache = DynamicCache.from_legacy_cache(tuple(zip(entry[0], entry[1])))
+        return cache, lm_input[:, prefix_len:]
 
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, prefix=None):
         if hasattr(self, 'vllm'):
             from vllm import SamplingParams, RequestOutput
             sampling_params = SamplingParams(top_k=sampling,
@@ -505,20 +706,37 @@ class Qwen2LM(TransformerLM):
                 time.sleep(0.001)
             with self.lock:
                 self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'batch_scheduler'):
+            # NOTE continuous batching with other concurrent requests, see cosyvoice.cli.scheduler.LLMBatchScheduler
+            for top_ids in self.batch_scheduler.inference(lm_input, sampling, min_len, max_len):
+                yield top_ids
         else:
             out_tokens = []
+            window = self.init_sampling_window(1, lm_input.device)
             cache = None
+            # NOTE static decoder is only used when the whole utterance fits in its preallocated kv cache
+            static_decoder = getattr(self, 'static_decoder', None)
+            if static_decoder is not None and lm_input.size(1) + max_len > static_decoder.max_len:
+                static_decoder = None
+            if prefix is not None:
+                cache, lm_input = self.prefill_prefix(prefix, lm_input, static_decoder)
             for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
+                if static_decoder is not None:
+                    y_pred, cache = static_decoder.forward_one_step(lm_input, cache=cache)
+                else:
+                    masks = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+                    if i == 0 and cache is not None:
+                        # NOTE the first forward after a forked prefix attends to the prefix positions as well
+                        masks = torch.ones((1, 1, lm_input.shape[1] + cache[0][0].size(2)), device=lm_input.device).to(torch.bool)
+                    y_pred, cache = self.llm.forward_one_step(lm_input, masks=masks, cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=True if i < min_len else False)
                 if top_ids in self.stop_token_ids:
                     break
                 # in stream mode, yield token one by one
                 yield top_ids
                 out_tokens.append(top_ids)
+                window = update_window(window, top_ids)
                 lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
     @torch.inference_mode()
@@ -547,6 +765,7 @@ class Qwen2LM(TransformerLM):
 
         # 2. iterate text
         out_tokens = []
+        window = self.init_sampling_window(1, device)
         cache = None
         # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
         text_cache = self.llm.model.model.embed_tokens(prompt_text)
@@ -588,11 +807,12 @@ class Qwen2LM(TransformerLM):
                         top_ids = self.fill_token
                         next_fill_index += (self.mix_ratio[1] + 1)
                     else:
-                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True)
+                        top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=True)
                     if top_ids == self.fill_token:
                         next_fill_index = len(out_tokens) + self.mix_ratio[1] + 1
                         logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index))
                     out_tokens.append(top_ids)
+                    window = update_window(window, top_ids)
                     if top_ids >= self.speech_token_size:
                         if top_ids == self.fill_token:
                             break
@@ -610,8 +830,9 @@ class Qwen2LM(TransformerLM):
                                                       masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
                                                       cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), window, sampling, ignore_eos=False)
             out_tokens.append(top_ids)
+            window = update_window(window, top_ids)
             if top_ids >= self.speech_token_size:
                 if top_ids == self.eos_token:
                     break
@@ -707,8 +928,7 @@ class CosyVoice3LM(Qwen2LM):
         acc = th_accuracy(logits.view(-1, self.speech_token_size + 200), lm_target, ignore_label=IGNORE_ID)
         return {'loss': loss, 'acc': acc}
 
-    @torch.inference_mode()
-    def inference(
+    def prepare_inference_input(
             self,
             text: torch.Tensor,
             text_len: torch.Tensor,
@@ -716,15 +936,11 @@ class CosyVoice3LM(Qwen2LM):
             prompt_text_len: torch.Tensor,
             prompt_speech_token: torch.Tensor,
             prompt_speech_token_len: torch.Tensor,
-            embedding: torch.Tensor,
-            sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
-            uuid: str = '',
-    ) -> Generator[torch.Tensor, None, None]:
+    ) -> Tuple[torch.Tensor, int, int]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
-        text_len += prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
 
         # 3. concat llm_input
@@ -737,9 +953,6 @@ class CosyVoice3LM(Qwen2LM):
         lm_input = torch.concat([sos_emb, text, task_id_emb, prompt_speech_token_emb], dim=1)
 
         # 4. cal min/max_length
-        min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
-        max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
-
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
-            yield token
+        min_len = int(text_len * min_token_text_ratio)
+        max_len = int(text_len * max_token_text_ratio)
+        return lm_input, min_len, max_len
@@ -69,6 +69,9 @@ class Snake(nn.Module):
         self.alpha.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        # NOTE alpha and 1/alpha precomputed by freeze_for_inference
+        self.register_buffer('frozen_alpha', None, persistent=False)
+        self.register_buffer('frozen_inv_alpha', None, persistent=False)
 
     def forward(self, x):
         '''
@@ -76,9 +79,19 @@ class Snake(nn.Module):
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
-        alpha = self.alpha.unsqueeze(0).unsqueeze(-1)  # line up with x to [B, C, T]
-        if self.alpha_logscale:
-            alpha = torch.exp(alpha)
-        x = x + (1.0 / (alpha + self.no_div_by_zero)) * pow(sin(x * alpha), 2)
+        if self.frozen_alpha is not None:
+            alpha, inv_alpha = self.frozen_alpha, self.frozen_inv_alpha
+        else:
+            alpha = self.alpha.unsqueeze(0).unsqueeze(-1)  # line up with x to [B, C, T]
+            if self.alpha_logscale:
+                alpha = torch.exp(alpha)
+            inv_alpha = 1.0 / (alpha + self.no_div_by_zero)
+        x = torch.addcmul(x, inv_alpha, pow(sin(x * alpha), 2))
 
         return x
+
+    def freeze_for_inference(self):
+        alpha = self.alpha.detach().unsqueeze(0).unsqueeze(-1)
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.frozen_alpha, self.frozen_inv_alpha = alpha, 1.0 / (alpha + self.no_div_by_zero)
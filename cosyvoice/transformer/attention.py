@@ -193,9 +193,47 @@ class MultiHeadedAttention(nn.Module):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
-        scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+        scores = self.compute_scores(q, k, pos_emb)
         return self.forward_attention(v, scores, mask), new_cache
 
+    def compute_scores(self, q: torch.Tensor, k: torch.Tensor,
+                       pos_emb: torch.Tensor) -> torch.Tensor:
+        """Compute attention scores (#batch, n_head, time1, time2).
+
+        Args:
+            q (torch.Tensor): Transformed query (#batch, n_head, time1, d_k).
+            k (torch.Tensor): Transformed key (#batch, n_head, time2, d_k).
+            pos_emb (torch.Tensor): Positional embedding tensor, not used here.
+        """
+        return torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+
+    @torch.jit.unused
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        kv_cache: 'StaticKVCache',
+        layer: int,
+    ) -> torch.Tensor:
+        """Self attention with a preallocated kv cache, the keys and values
+        of x are written into kv_cache in place instead of concatenated.
+
+        Args:
+            x (torch.Tensor): Input tensor (#batch, time1, size).
+            mask (torch.Tensor): Mask tensor (#batch, time1, time2).
+            pos_emb (torch.Tensor): Positional embedding tensor.
+            kv_cache (StaticKVCache): cache shared by all layers.
+            layer (int): index of this layer in kv_cache.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+        """
+        q, k, v = self.forward_qkv(x, x, x)
+        k, v = kv_cache.update(layer, k, v)
+        scores = self.compute_scores(q, k, pos_emb)
+        return self.forward_attention(v, scores, mask)
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -274,7 +312,6 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
                 and `head * d_k == size`
         """
         q, k, v = self.forward_qkv(query, key, value)
-        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
 
         # NOTE(xcsong):
         #   when export onnx model, for 1st chunk, we feed
@@ -302,6 +339,20 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        scores = self.compute_scores(q, k, pos_emb)
+        return self.forward_attention(v, scores, mask), new_cache
+
+    def compute_scores(self, q: torch.Tensor, k: torch.Tensor,
+                       pos_emb: torch.Tensor) -> torch.Tensor:
+        """Compute attention scores with rel. positional encoding.
+
+        Args:
+            q (torch.Tensor): Transformed query (#batch, n_head, time1, d_k).
+            k (torch.Tensor): Transformed key (#batch, n_head, time2, d_k).
+            pos_emb (torch.Tensor): Positional embedding tensor
+                (#batch, time2, size).
+        """
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
         p = p.transpose(1, 2)  # (batch, head, time1, d_k)
@@ -324,7 +375,45 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         if matrix_ac.shape != matrix_bd.shape:
             matrix_bd = self.rel_shift(matrix_bd)
 
-        scores = (matrix_ac + matrix_bd) / math.sqrt(
+        return (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k)  # (batch, head, time1, time2)
 
-        return self.forward_attention(v, scores, mask), new_cache
+
+class StaticKVCache:
+    """Key & value cache preallocated to `max_len` positions for step by step
+    decoding. New keys and values are written in place at the current offset,
+    so a decode step never re-concatenates the history of every layer.
+
+    Args:
+        num_layers (int): number of attention layers sharing the cache.
+        max_len (int): maximum number of cached positions.
+    """
+
+    def __init__(self, num_layers: int, max_len: int):
+        self.num_layers = num_layers
+        self.max_len = max_len
+        self.offset = 0
+        # NOTE allocated on first update, so that batch, head, dtype and device follow the model
+        self.key = None
+        self.value = None
+
+    def update(self, layer: int, k: torch.Tensor,
+               v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write k, v (#batch, head, time, d_k) of layer at the current offset.
+
+        Returns:
+            torch.Tensor: keys of all cached positions (#batch, head, offset + time, d_k).
+            torch.Tensor: values of all cached positions (#batch, head, offset + time, d_k).
+        """
+        if self.key is None:
+            self.key = k.new_zeros((self.num_layers, k.size(0), k.size(1), self.max_len, k.size(3)))
+            self.value = v.new_zeros((self.num_layers, v.size(0), v.size(1), self.max_len, v.size(3)))
+        end = self.offset + k.size(2)
+        assert end <= self.max_len, 'static kv cache overflow, {} > max_len {}'.format(end, self.max_len)
+        self.key[layer, :, :, self.offset:end] = k
+        self.value[layer, :, :, self.offset:end] = v
+        return self.key[layer, :, :, :end], self.value[layer, :, :, :end]
+
+    def advance(self, size: int):
+        """Move the offset forward after all layers consumed a chunk of size positions."""
+        self.offset += size
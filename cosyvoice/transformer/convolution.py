@@ -15,7 +15,7 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """ConvolutionModule definition."""
 
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
@@ -186,6 +186,20 @@ class CausalConv1d(torch.nn.Conv1d):
         assert x.shape[2] == input_timestep
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[torch.Tensor] = None, finalize: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ chunk by chunk forward, cache holds the input frames which are not consumed yet,
+            i.e. left context for causal_type left, lookahead frames for causal_type right
+        """
+        if cache is None:
+            cache = torch.zeros(x.shape[0], x.shape[1], self.causal_padding if self.causal_type == 'left' else 0).to(x)
+        x = torch.concat([cache, x], dim=2)
+        if finalize is True and self.causal_type == 'right':
+            x = F.pad(x, (0, self.causal_padding), value=0.0)
+        output_timestep = max(x.shape[2] - self.causal_padding, 0)
+        if output_timestep == 0:
+            return x.new_zeros(x.shape[0], self.out_channels, 0), x
+        return super(CausalConv1d, self).forward(x), x[:, :, output_timestep:]
+
 
 class CausalConv1dDownSample(torch.nn.Conv1d):
     def __init__(
@@ -220,6 +234,17 @@ class CausalConv1dDownSample(torch.nn.Conv1d):
         x = super(CausalConv1dDownSample, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ chunk by chunk forward, cache holds the input frames which are not consumed yet
+        """
+        if cache is None:
+            cache = torch.zeros(x.shape[0], x.shape[1], self.causal_padding).to(x)
+        x = torch.concat([cache, x], dim=2)
+        output_timestep = (x.shape[2] - self.kernel_size[0]) // self.stride[0] + 1 if x.shape[2] >= self.kernel_size[0] else 0
+        if output_timestep == 0:
+            return x.new_zeros(x.shape[0], self.out_channels, 0), x
+        return super(CausalConv1dDownSample, self).forward(x), x[:, :, output_timestep * self.stride[0]:]
+
 
 class CausalConv1dUpsample(torch.nn.Conv1d):
     def __init__(
@@ -256,3 +281,16 @@ class CausalConv1dUpsample(torch.nn.Conv1d):
         x = super(CausalConv1dUpsample, self).forward(x)
         assert input_timestep == x.shape[2]
         return x
+
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ chunk by chunk forward, cache holds the last causal_padding upsampled frames
+        """
+        if x.shape[2] != 0:
+            x = self.upsample(x)
+        if cache is None:
+            cache = torch.zeros(x.shape[0], x.shape[1], self.causal_padding).to(x)
+        x = torch.concat([cache, x], dim=2)
+        output_timestep = x.shape[2] - self.causal_padding
+        if output_timestep == 0:
+            return x.new_zeros(x.shape[0], self.out_channels, 0), x
+        return super(CausalConv1dUpsample, self).forward(x), x[:, :, output_timestep:]
@@ -20,6 +20,7 @@ from typing import Tuple
 import torch
 import torch.utils.checkpoint as ckpt
 
+from cosyvoice.transformer.attention import StaticKVCache
 from cosyvoice.transformer.convolution import ConvolutionModule
 from cosyvoice.transformer.encoder_layer import TransformerEncoderLayer
 from cosyvoice.transformer.encoder_layer import ConformerEncoderLayer
@@ -383,6 +384,52 @@ class TransformerEncoder(BaseEncoder):
                 dropout_rate, normalize_before) for _ in range(num_blocks)
         ])
 
+    @torch.jit.unused
+    def forward_chunk_static(
+        self,
+        xs: torch.Tensor,
+        kv_cache: StaticKVCache,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Same as forward_chunk with required_cache_size=-1, but the history
+            is kept in a preallocated StaticKVCache which is updated in place,
+            so no per step torch.cat/re-stack of the attention cache is needed.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim)
+            kv_cache (StaticKVCache): cache created by init_static_cache,
+                kv_cache.offset is used as the offset of xs.
+            att_mask (torch.Tensor): mask tensor (b=1, time, kv_cache.offset + time)
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, chunk_size, hidden-dim).
+        """
+        assert xs.size(0) == 1
+        offset = kv_cache.offset
+        tmp_masks = torch.ones(1,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        tmp_masks = tmp_masks.unsqueeze(1)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        chunk_size = xs.size(1)
+        pos_emb = self.embed.position_encoding(offset=0,
+                                               size=offset + chunk_size)
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_static(xs, att_mask, pos_emb, kv_cache, i)
+        kv_cache.advance(chunk_size)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
+    @torch.jit.unused
+    def init_static_cache(self, max_len: int) -> StaticKVCache:
+        """Create an empty StaticKVCache of max_len positions for forward_chunk_static."""
+        return StaticKVCache(len(self.encoders), max_len)
+
 
 class ConformerEncoder(BaseEncoder):
     """Conformer encoder module."""
@@ -472,3 +519,34 @@ class ConformerEncoder(BaseEncoder):
                 normalize_before,
             ) for _ in range(num_blocks)
         ])
+
+
+if __name__ == '__main__':
+    # NOTE cpu decode speed of the CosyVoice1 llm, forward_chunk with a growing att_cache against forward_chunk_static
+    import time
+    torch.manual_seed(0)
+    torch.set_grad_enabled(False)
+    model = TransformerEncoder(1024, 1024, attention_heads=16, linear_units=4096, num_blocks=14, input_layer='linear_legacy',
+                               pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', static_chunk_size=1)
+    model.eval()
+    prompt = torch.randn(1, 150, 1024)
+    for num_tokens in [200, 500, 1000]:
+        tokens = torch.randn(num_tokens, 1, 1, 1024)
+        outputs = {}
+        for name in ['forward_chunk', 'forward_chunk_static']:
+            lm_input, offset, outputs[name] = prompt, 0, []
+            att_cache, cnn_cache = torch.zeros((0, 0, 0, 0)), torch.zeros((0, 0, 0, 0))
+            kv_cache = model.init_static_cache(prompt.size(1) + num_tokens)
+            start_time = time.time()
+            for i in range(num_tokens):
+                att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]))).to(torch.bool)
+                if name == 'forward_chunk_static':
+                    y_pred = model.forward_chunk_static(lm_input, kv_cache, att_mask=att_mask)
+                else:
+                    y_pred, att_cache, cnn_cache = model.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                       att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+                outputs[name].append(y_pred[:, -1])
+                offset += lm_input.size(1)
+                lm_input = tokens[i]
+            print('{} tokens {}: {:.1f} tokens/s'.format(num_tokens, name, num_tokens / (time.time() - start_time)))
+        print('max diff {}'.format((torch.cat(outputs['forward_chunk']) - torch.cat(outputs['forward_chunk_static'])).abs().max().item()))
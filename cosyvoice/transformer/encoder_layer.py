@@ -105,6 +105,43 @@ class TransformerEncoderLayer(nn.Module):
         fake_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         return x, mask, new_att_cache, fake_cnn_cache
 
+    @torch.jit.unused
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        kv_cache,
+        layer: int,
+    ) -> torch.Tensor:
+        """Same as forward, but keys and values are kept in a preallocated
+            StaticKVCache shared by all layers.
+
+        Args:
+            x (torch.Tensor): (#batch, time, size)
+            mask (torch.Tensor): Mask tensor for the input (#batch, time，time).
+            pos_emb (torch.Tensor): positional encoding
+            kv_cache (StaticKVCache): cache written in place by self_attn.
+            layer (int): index of this layer in kv_cache.
+        Returns:
+            torch.Tensor: Output tensor (#batch, time, size).
+        """
+        residual = x
+        if self.normalize_before:
+            x = self.norm1(x)
+        x_att = self.self_attn.forward_static(x, mask, pos_emb, kv_cache, layer)
+        x = residual + self.dropout(x_att)
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm2(x)
+        return x
+
 
 class ConformerEncoderLayer(nn.Module):
     """Encoder layer module.
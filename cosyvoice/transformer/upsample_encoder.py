@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask_with_cache
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +63,20 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, channels, seq_len)
+        cache: (batch_size, channels, stride * 2), last upsampled frames of previous chunk, empty for first chunk
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.stride * 2, 0), value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, in_channels: int, channels: int, pre_lookahead_len: int = 1):
@@ -102,6 +117,35 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0),
+                      cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels)
+        context: (batch_size, pre_lookahead_len, channels), empty for last chunk
+        cache: (batch_size, channels, conv2 kernel_size - 1), last conv1 outputs of previous chunk, empty for first chunk
+        """
+        outputs = inputs.transpose(1, 2).contiguous()
+        context = context.transpose(1, 2).contiguous()
+        # look ahead
+        if context.size(2) == 0:
+            outputs = F.pad(outputs, (0, self.pre_lookahead_len), mode='constant', value=0.0)
+        else:
+            assert context.size(2) == self.pre_lookahead_len
+            outputs = torch.concat([outputs, context], dim=2)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # outputs
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.conv2.kernel_size[0] - 1, 0), mode='constant', value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -(self.conv2.kernel_size[0] - 1):]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -319,3 +363,71 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: Optional[Dict] = None,
+    ) -> Tuple[torch.Tensor, Dict]:
+        """ Forward just one chunk in streaming mode, the result equals to
+            forward(streaming=True) on the whole prefix
+
+        Args:
+            xs (torch.Tensor): chunk input (1, T, D), must start at a
+                static_chunk_size boundary, and T must be a multiple of
+                static_chunk_size except for the last chunk
+            context (torch.Tensor): lookahead input (1, pre_lookahead_len, D),
+                empty for the last chunk
+            cache (Dict): cache returned by last call, None for first chunk
+        Returns:
+            torch.Tensor: output of current input xs, (1, T * stride, D)
+            Dict: new cache for next chunk
+        """
+        assert xs.size(0) == 1, 'only support batch size 1 in chunk inference'
+        if cache is None:
+            cache = {'offset': 0, 'pre_lookahead_cache': torch.zeros(0, 0, 0), 'up_layer_cache': torch.zeros(0, 0, 0),
+                     'att_cache': [torch.zeros(0, 0, 0, 0)] * len(self.encoders),
+                     'up_att_cache': [torch.zeros(0, 0, 0, 0)] * len(self.up_encoders)}
+        offset = cache['offset']
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.embed(xs, masks)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=xs.size(1))
+        # lookahead + conformer encoder
+        xs, pre_lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context=context, cache=cache['pre_lookahead_cache'])
+        xs, att_cache = self.forward_layers_chunk(self.encoders, self.embed, xs, offset, self.static_chunk_size, cache['att_cache'])
+
+        # upsample + conformer encoder
+        xs = xs.transpose(1, 2).contiguous()
+        xs, up_layer_cache = self.up_layer.forward_chunk(xs, cache=cache['up_layer_cache'])
+        xs = xs.transpose(1, 2).contiguous()
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.up_embed(xs, masks)
+        xs, up_att_cache = self.forward_layers_chunk(self.up_encoders, self.up_embed, xs, offset * self.up_layer.stride,
+                                                     self.static_chunk_size * self.up_layer.stride, cache['up_att_cache'])
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        new_cache = {'offset': offset + xs.size(1) // self.up_layer.stride, 'pre_lookahead_cache': pre_lookahead_cache,
+                     'up_layer_cache': up_layer_cache, 'att_cache': att_cache, 'up_att_cache': up_att_cache}
+        return xs, new_cache
+
+    def forward_layers_chunk(self, layers: torch.nn.ModuleList, embed: torch.nn.Module,
+                             xs: torch.Tensor, offset: int, chunk_size: int,
+                             att_cache: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        # NOTE all left chunks are kept in encoder att_cache, so that chunk inference is identical to whole prefix inference
+        cache_size = att_cache[0].size(2)
+        assert cache_size == offset, 'encoder att_cache should cover all left frames'
+        embed.pos_enc.extend_pe(xs.new_zeros(1, cache_size + xs.size(1)))
+        pos_emb = embed.pos_enc.position_encoding(offset=0, size=cache_size + xs.size(1))
+        chunk_masks = subsequent_chunk_mask_with_cache(xs.size(1), cache_size, offset, chunk_size, -1, xs.device).unsqueeze(0)
+        mask_pad = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        new_att_cache = []
+        for i, layer in enumerate(layers):
+            xs, _, new_att_cache_i, _ = layer(xs, chunk_masks, pos_emb, mask_pad, att_cache=att_cache[i])
+            new_att_cache.append(new_att_cache_i)
+        return xs, new_att_cache
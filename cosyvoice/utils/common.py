@@ -16,6 +16,7 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Unility functions for Transformer."""
 
+import os
 import queue
 import random
 from typing import List
@@ -134,47 +135,95 @@ def init_weights(m, mean=0.0, std=0.01):
         m.weight.data.normal_(mean, std)
 
 
+def fold_weight_norm(module: torch.nn.Module):
+    """fold weight_norm of module and all its submodules into plain weights,
+    both torch.nn.utils.parametrizations.weight_norm and the legacy hook style weight_norm are supported
+    """
+    from torch.nn.utils import parametrize, remove_weight_norm
+    from torch.nn.utils.weight_norm import WeightNorm
+    for m in list(module.modules()):
+        if parametrize.is_parametrized(m, 'weight'):
+            parametrize.remove_parametrizations(m, 'weight', leave_parametrized=True)
+        for hook in list(m._forward_pre_hooks.values()):
+            if isinstance(hook, WeightNorm):
+                remove_weight_norm(m, hook.name)
+
+
 # Repetition Aware Sampling in VALL-E 2
-def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
-    return top_ids
-
-
-def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)].item()
-    return top_ids
-
-
-def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True).item()
-    return top_ids
+def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, ignore_mask=None):
+    """weighted_scores is [V] or [B, V], decoded_tokens is a list of token ids or an on-device [B, L] window
+    padded with IGNORE_ID, see update_window. Token ids in ignore_mask are never sampled.
+    Return sampled token ids as a tensor of shape weighted_scores.shape[:-1].
+    """
+    scores = weighted_scores.reshape(-1, weighted_scores.size(-1))
+    probs = scores.softmax(dim=-1)
+    top_probs = top_p_top_k_probs(probs, top_p=top_p, top_k=top_k)
+    top_probs = top_probs / top_probs.sum(dim=-1, keepdim=True)
+    if isinstance(decoded_tokens, torch.Tensor):
+        window = decoded_tokens.reshape(scores.size(0), -1)[:, -win_size:]
+    else:
+        window = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=scores.device).reshape(scores.size(0), -1)
+    rep_num = torch.zeros_like(probs).scatter_add_(1, window.clamp(min=0), (window >= 0).to(probs.dtype))
+    repeated = rep_num >= win_size * tau_r
+    # NOTE closed form of sampling from nucleus and falling back to random sampling when the sampled token repeats too much in window,
+    # so there is a single multinomial draw and no host sync
+    probs = top_probs.masked_fill(repeated, 0) + (top_probs * repeated).sum(dim=-1, keepdim=True) * probs
+    return masked_multinomial(probs, ignore_mask, fallback=scores.softmax(dim=-1)).reshape(weighted_scores.shape[:-1])
+
+
+def top_p_top_k_probs(probs, top_p=0.8, top_k=25):
+    """keep at most top_k most likely tokens until their cumulative probability reaches top_p, probs is [B, V]"""
+    sorted_value, sorted_idx = probs.topk(min(top_k, probs.size(-1)), dim=-1)
+    # NOTE a token is kept when the cumulative probability before it is below top_p, so the most likely token is always kept
+    keep = (sorted_value.cumsum(dim=-1) - sorted_value) < top_p
+    return torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_value * keep)
+
+
+def masked_multinomial(probs, ignore_mask=None, fallback=None):
+    """draw one token per row of probs [B, V], token ids in ignore_mask [V] or [B, V] are never sampled.
+    Masking equals to rejecting ignored ids trial by trial, rows whose whole mass is ignored draw from fallback instead.
+    """
+    if ignore_mask is not None:
+        probs = probs.masked_fill(ignore_mask, 0)
+        if fallback is not None:
+            probs = torch.where(probs.sum(dim=-1, keepdim=True) > 0, probs, fallback.masked_fill(ignore_mask, 0))
+    return probs.multinomial(1, replacement=True).squeeze(dim=-1)
+
+
+def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25, ignore_mask=None):
+    scores = weighted_scores.reshape(-1, weighted_scores.size(-1))
+    probs = scores.softmax(dim=-1)
+    return masked_multinomial(top_p_top_k_probs(probs, top_p=top_p, top_k=top_k), ignore_mask, fallback=probs).reshape(weighted_scores.shape[:-1])
+
+
+def random_sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=None):
+    scores = weighted_scores.reshape(-1, weighted_scores.size(-1))
+    return masked_multinomial(scores.softmax(dim=-1), ignore_mask).reshape(weighted_scores.shape[:-1])
+
+
+def update_window(window, top_ids):
+    """roll the on-device [B, L] repetition window of ras_sampling by one token, top_ids is an int or a [B] tensor"""
+    if isinstance(top_ids, torch.Tensor):
+        top_ids = top_ids.reshape(-1, 1).to(window)
+    else:
+        top_ids = window.new_full((window.size(0), 1), top_ids)
+    return torch.concat([window[:, 1:], top_ids], dim=1)
+
+
+def make_fade_window(overlap_len, device):
+    """hamming window of fade_in_out, precomputed once on the model device"""
+    return torch.from_numpy(np.hamming(2 * overlap_len)).float().to(device)
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    # NOTE overlap add on the device of fade_in_mel, window from make_fade_window avoids any host copy or sync,
+    # a numpy window is still accepted and copied to device on every call.
+    # out of place, inputs may be inference tensors of flow/hift while tts runs outside inference mode
+    if not isinstance(window, torch.Tensor):
+        window = torch.from_numpy(window).to(fade_in_mel.device)
     mel_overlap_len = int(window.shape[0] / 2)
-    if fade_in_mel.device == torch.device('cpu'):
-        fade_in_mel = fade_in_mel.clone()
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    overlap = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
+    return torch.concat([overlap.to(fade_in_mel.dtype), fade_in_mel[..., mel_overlap_len:]], dim=-1)
 
 
 def set_all_random_seed(seed):
@@ -184,6 +233,17 @@ def set_all_random_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def tensor_nbytes(obj) -> int:
+    """total bytes of the tensors in a nested dict/list/tuple, e.g. a streaming cache"""
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in obj)
+    return 0
+
+
 def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     assert mask.dtype == torch.bool
     assert dtype in [torch.float32, torch.bfloat16, torch.float16]
@@ -199,6 +259,10 @@ class TrtContextWrapper:
     def __init__(self, trt_engine, trt_concurrent=1, device='cuda:0'):
         self.trt_context_pool = queue.Queue(maxsize=trt_concurrent)
         self.trt_engine = trt_engine
+        # NOTE engines built before the batch 1 profile only accept batch 2
+        input_name = trt_engine.get_tensor_name(0)
+        batch_size = trt_engine.get_tensor_shape(input_name)[0]
+        self.min_batch_size = batch_size if batch_size != -1 else trt_engine.get_tensor_profile_shape(input_name, 0)[0][0]
         for _ in range(trt_concurrent):
             trt_context = trt_engine.create_execution_context()
             trt_stream = torch.cuda.stream(torch.cuda.Stream(device))
@@ -211,3 +275,137 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+class OrtSessionWrapper:
+    """Pool of onnxruntime CPUExecutionProvider sessions with their io bindings, same concurrency model as TrtContextWrapper.
+    Called with torch tensors in the order of the onnx inputs, returns the onnx outputs as cpu fp32 torch tensors.
+    """
+
+    def __init__(self, onnx_model, ort_concurrent=1, intra_op_num_threads=0):
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # NOTE split cpu cores among concurrent sessions by default
+        option.intra_op_num_threads = intra_op_num_threads if intra_op_num_threads > 0 else max(1, (os.cpu_count() or 1) // ort_concurrent)
+        self.ort_session_pool = queue.Queue(maxsize=ort_concurrent)
+        for _ in range(ort_concurrent):
+            ort_session = onnxruntime.InferenceSession(onnx_model, sess_options=option, providers=['CPUExecutionProvider'])
+            self.ort_session_pool.put([ort_session, ort_session.io_binding()])
+        assert self.ort_session_pool.empty() is False, 'no avaialbe onnx session'
+        self.input_names = [i.name for i in ort_session.get_inputs()]
+        self.output_names = [i.name for i in ort_session.get_outputs()]
+        # NOTE dynamic batch axis is a str, models exported before dynamic batch have a fixed int batch
+        batch_size = ort_session.get_inputs()[0].shape[0]
+        self.min_batch_size = batch_size if isinstance(batch_size, int) else 1
+
+    def acquire_session(self):
+        return self.ort_session_pool.get()
+
+    def release_session(self, ort_session, io_binding):
+        self.ort_session_pool.put([ort_session, io_binding])
+
+    def __call__(self, *inputs):
+        assert len(inputs) == len(self.input_names), 'expect inputs {}, got {} tensors'.format(self.input_names, len(inputs))
+        # NOTE keep references of the cpu fp32 inputs until run_with_iobinding returns, io binding only holds their data_ptr
+        inputs = [i.detach().to('cpu', torch.float32).contiguous() for i in inputs]
+        ort_session, io_binding = self.acquire_session()
+        try:
+            for name, i in zip(self.input_names, inputs):
+                io_binding.bind_input(name, 'cpu', 0, np.float32, list(i.shape), i.data_ptr())
+            for name in self.output_names:
+                io_binding.bind_output(name, 'cpu')
+            ort_session.run_with_iobinding(io_binding)
+            outputs = io_binding.copy_outputs_to_cpu()
+            io_binding.clear_binding_inputs()
+            io_binding.clear_binding_outputs()
+        finally:
+            self.release_session(ort_session, io_binding)
+        return [torch.from_numpy(o) for o in outputs]
+
+
+if __name__ == '__main__':
+    # NOTE micro benchmark of ras_sampling against the former per token python loop implementation
+    import time
+
+    def legacy_ras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+        prob, indices = [], []
+        cum_prob = 0.0
+        sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+        for i in range(len(sorted_idx)):
+            if cum_prob < top_p and len(prob) < top_k:
+                cum_prob += sorted_value[i]
+                prob.append(sorted_value[i])
+                indices.append(sorted_idx[i])
+            else:
+                break
+        prob = torch.tensor(prob).to(weighted_scores)
+        indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+        top_ids = indices[prob.multinomial(1, replacement=True)].item()
+        rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+        if rep_num >= win_size * tau_r:
+            top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True).item()
+        return top_ids
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    vocab_size, speech_token_size, n_iter = 6564, 6561, 500
+
+    # sampled distribution should match the former implementation, including the eos rejection
+    logits = torch.randn(vocab_size, device=device) * 3
+    logits[speech_token_size] = logits.max() + 1
+    decoded_tokens = logits.topk(3).indices.tolist()[1:] * 3
+    ignore_mask = torch.arange(vocab_size, device=device) >= speech_token_size
+    legacy_hist, hist = torch.zeros(vocab_size), torch.zeros(vocab_size)
+    for _ in range(20000):
+        while True:
+            top_ids = legacy_ras_sampling(logits, decoded_tokens)
+            if top_ids < speech_token_size:
+                break
+        legacy_hist[top_ids] += 1
+    window = torch.tensor(decoded_tokens, device=device).unsqueeze(dim=0)
+    for top_ids in ras_sampling(logits.unsqueeze(dim=0).repeat(20000, 1), window.repeat(20000, 1), 25, ignore_mask=ignore_mask).tolist():
+        hist[top_ids] += 1
+    print('total variation distance {:.4f}'.format((legacy_hist - hist).abs().sum().item() / 2 / 20000))
+
+    for batch_size in [1, 16, 64]:
+        logits = torch.randn(batch_size, vocab_size, device=device) * 3
+        decoded_tokens = [torch.randint(0, speech_token_size, (200,)).tolist() for _ in range(batch_size)]
+        start_time = time.time()
+        for _ in range(n_iter // batch_size + 1):
+            for i in range(batch_size):
+                legacy_ras_sampling(logits[i], decoded_tokens[i])
+        legacy_time = (time.time() - start_time) / (n_iter // batch_size + 1)
+        window = torch.tensor([tokens[-10:] for tokens in decoded_tokens], device=device)
+        start_time = time.time()
+        for _ in range(n_iter // batch_size + 1):
+            top_ids = ras_sampling(logits, window, 25, ignore_mask=ignore_mask)
+            window = update_window(window, top_ids)
+            top_ids.tolist()
+        tensor_time = (time.time() - start_time) / (n_iter // batch_size + 1)
+        print('batch {}: legacy {:.3f} ms/step, tensorized {:.3f} ms/step'.format(batch_size, legacy_time * 1000, tensor_time * 1000))
+
+    # NOTE per streaming chunk cost of mel and speech crossfade, against the former host round trip with a numpy window
+    def legacy_fade_in_out(fade_in_mel, fade_out_mel, window):
+        device = fade_in_mel.device
+        fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+        mel_overlap_len = int(window.shape[0] / 2)
+        if fade_in_mel.device == torch.device('cpu'):
+            fade_in_mel = fade_in_mel.clone()
+        fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
+            fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
+        return fade_in_mel.to(device)
+
+    for name, shape, overlap_len in [('mel', (1, 80, 34 + 93), 34), ('speech', (1, 25 * 2 * 480), 20 * 256)]:
+        fade_in, fade_out = torch.randn(shape, device=device), torch.randn(shape, device=device)
+        np_window, window = np.hamming(2 * overlap_len), make_fade_window(overlap_len, device)
+        print('{} max diff {:.2e}'.format(name, (legacy_fade_in_out(fade_in, fade_out, np_window) - fade_in_out(fade_in, fade_out, window)).abs().max().item()))
+        for impl, w in [(legacy_fade_in_out, np_window), (fade_in_out, window)]:
+            chunks = [fade_in.clone() for _ in range(n_iter)]
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.time()
+            for chunk in chunks:
+                impl(chunk, fade_out, w)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            print('{} {}: {:.1f} us/chunk'.format(name, impl.__name__, (time.time() - start_time) / n_iter * 1e6))
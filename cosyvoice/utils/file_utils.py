@@ -16,6 +16,7 @@
 
 import os
 import json
+import threading
 import torch
 import torchaudio
 import logging
@@ -46,10 +47,44 @@ def load_wav(wav, target_sr, min_sr=16000):
     speech = speech.mean(dim=0, keepdim=True)
     if sample_rate != target_sr:
         assert sample_rate >= min_sr, 'wav sample rate {} must be greater than {}'.format(sample_rate, target_sr)
-        speech = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=target_sr)(speech)
+        speech = get_resampler(sample_rate, target_sr)(speech)
     return speech
 
 
+resampler_dict = {}
+resampler_lock = threading.Lock()
+
+
+def get_resampler(orig_sr, target_sr):
+    # NOTE the resample kernel only depends on (orig_sr, target_sr), so build it once and share it
+    with resampler_lock:
+        if (orig_sr, target_sr) not in resampler_dict:
+            resampler_dict[(orig_sr, target_sr)] = torchaudio.transforms.Resample(orig_freq=orig_sr, new_freq=target_sr)
+        return resampler_dict[(orig_sr, target_sr)]
+
+
+class PromptAudio:
+    """Prompt wav decoded once, resampled views are computed once per target sample rate."""
+
+    def __init__(self, wav, sample_rate=None, min_sr=16000):
+        if isinstance(wav, torch.Tensor):
+            # NOTE already decoded pcm, e.g. prompt audio received by grpc server
+            assert sample_rate is not None, 'sample_rate is required when wav is a pcm tensor'
+            speech = wav.reshape(-1, wav.shape[-1])
+        else:
+            speech, sample_rate = torchaudio.load(wav, backend='soundfile')
+        self.speech = speech.mean(dim=0, keepdim=True)
+        self.sample_rate = sample_rate
+        self.min_sr = min_sr
+        self.views = {sample_rate: self.speech}
+
+    def resample(self, target_sr):
+        if target_sr not in self.views:
+            assert self.sample_rate >= self.min_sr, 'wav sample rate {} must be greater than {}'.format(self.sample_rate, target_sr)
+            self.views[target_sr] = get_resampler(self.sample_rate, target_sr)(self.speech)
+        return self.views[target_sr]
+
+
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     import tensorrt as trt
     logging.info("Converting onnx to trt...")
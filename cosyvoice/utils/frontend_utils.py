@@ -63,18 +63,18 @@ def spell_out_number(text: str, inflect_parser):
 # 2. cal sentence len according to lang
 # 3. split sentence according to puncatation
 def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False):
+    return list(split_paragraph_iter(text, tokenize, lang=lang, token_max_n=token_max_n, token_min_n=token_min_n, merge_len=merge_len, comma_split=comma_split))
+
+
+# generator form of split_paragraph, a segment is yielded as soon as the next one is closed,
+# so that synthesis of the first segment can start before a long document is fully segmented
+def split_paragraph_iter(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False):
     def calc_utt_length(_text: str):
         if lang == "zh":
             return len(_text)
         else:
             return len(tokenize(_text))
 
-    def should_merge(_text: str):
-        if lang == "zh":
-            return len(_text) < merge_len
-        else:
-            return len(tokenize(_text)) < merge_len
-
     if lang == "zh":
         pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';']
     else:
@@ -88,33 +88,39 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
         else:
             text += "."
 
-    st = 0
-    utts = []
-    for i, c in enumerate(text):
-        if c in pounc:
-            if len(text[st: i]) > 0:
-                utts.append(text[st: i] + c)
-            if i + 1 < len(text) and text[i + 1] in ['"', '”']:
-                tmp = utts.pop(-1)
-                utts.append(tmp + text[i + 1])
-                st = i + 2
-            else:
-                st = i + 1
-
-    final_utts = []
-    cur_utt = ""
-    for utt in utts:
-        if calc_utt_length(cur_utt + utt) > token_max_n and calc_utt_length(cur_utt) > token_min_n:
-            final_utts.append(cur_utt)
-            cur_utt = ""
-        cur_utt = cur_utt + utt
+    def split_utts():
+        # NOTE keep the last sentence back, a closing quote right after a punctuation is appended to it
+        st, last = 0, None
+        for i, c in enumerate(text):
+            if c in pounc:
+                if len(text[st: i]) > 0:
+                    if last is not None:
+                        yield last
+                    last = text[st: i] + c
+                if i + 1 < len(text) and text[i + 1] in ['"', '”']:
+                    if last is not None:
+                        last = last + text[i + 1]
+                    st = i + 2
+                else:
+                    st = i + 1
+        if last is not None:
+            yield last
+
+    # NOTE every sentence is tokenized exactly once, buffer length is the running sum of its sentence lengths
+    prev_utt, cur_utt, cur_len = None, "", 0
+    for utt in split_utts():
+        utt_len = calc_utt_length(utt)
+        if cur_len + utt_len > token_max_n and cur_len > token_min_n:
+            if prev_utt is not None:
+                yield prev_utt
+            prev_utt, cur_utt, cur_len = cur_utt, "", 0
+        cur_utt, cur_len = cur_utt + utt, cur_len + utt_len
+    if len(cur_utt) > 0 and cur_len < merge_len and prev_utt is not None:
+        prev_utt, cur_utt = prev_utt + cur_utt, ""
+    if prev_utt is not None:
+        yield prev_utt
     if len(cur_utt) > 0:
-        if should_merge(cur_utt) and len(final_utts) != 0:
-            final_utts[-1] = final_utts[-1] + cur_utt
-        else:
-            final_utts.append(cur_utt)
-
-    return final_utts
+        yield cur_utt
 
 
 # remove blank between chinese character
@@ -134,3 +140,24 @@ def is_only_punctuation(text):
     # Regular expression: Match strings that consist only of punctuation marks or are empty.
     punctuation_pattern = r'^[\p{P}\p{S}]*$'
     return bool(regex.fullmatch(punctuation_pattern, text))
+
+
+if __name__ == '__main__':
+    # NOTE split a 100k-character english document, tokenizer is a word/punctuation regex that records how much text it is fed
+    import time
+    import random
+    words = ['speech', 'token', 'flow', 'matching', 'vocoder', 'the', 'a', 'of', 'synthesis', 'language', 'model', 'streaming']
+    text = ' '.join(' '.join(random.choices(words, k=random.randint(3, 30))) + random.choice(['.', '?', '!', ';', ',']) for _ in range(6000))[:100000]
+    tokenized_chars = []
+
+    def tokenize(_text):
+        tokenized_chars.append(len(_text))
+        return regex.findall(r'\w+|[^\w\s]', _text)
+    start_time = time.time()
+    next(split_paragraph_iter(text, tokenize, "en"))
+    first_time = time.time() - start_time
+    tokenized_chars.clear()
+    start_time = time.time()
+    utts = split_paragraph(text, tokenize, "en")
+    print('{} chars -> {} segments in {:.1f} ms, first segment after {:.2f} ms, tokenize called {} times on {} chars'.format(
+          len(text), len(utts), (time.time() - start_time) * 1000, first_time * 1000, len(tokenized_chars), sum(tokenized_chars)))
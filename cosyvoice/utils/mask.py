@@ -158,6 +158,45 @@ def subsequent_chunk_mask(
     return ret
 
 
+def subsequent_chunk_mask_with_cache(
+        size: int,
+        cache_size: int,
+        offset: int,
+        chunk_size: int,
+        num_left_chunks: int = -1,
+        device: torch.device = torch.device("cpu"),
+) -> torch.Tensor:
+    """Create mask (size, cache_size + size) with chunk size for chunk by chunk
+       inference, where the query starts at absolute position offset, and the
+       key is the concat of cache_size cached frames and the query itself
+
+    Args:
+        size (int): size of query
+        cache_size (int): size of cached key, covers [offset - cache_size, offset)
+        offset (int): absolute position of the first query frame
+        chunk_size (int): size of chunk
+        num_left_chunks (int): number of left chunks
+            <0: use full chunk
+            >=0: use num_left_chunks
+        device (torch.device): "cpu" or "cuda" or torch.Tensor.device
+
+    Returns:
+        torch.Tensor: mask
+
+    Examples:
+        >>> subsequent_chunk_mask_with_cache(2, 2, 2, 2)
+        [[1, 1, 1, 1],
+         [1, 1, 1, 1]]
+    """
+    query_idx = torch.arange(offset, offset + size, device=device)
+    key_idx = torch.arange(offset - cache_size, offset + size, device=device)
+    chunk_idx = torch.div(query_idx, chunk_size, rounding_mode='trunc')
+    ret = key_idx.unsqueeze(0) < ((chunk_idx + 1) * chunk_size).unsqueeze(1)
+    if num_left_chunks >= 0:
+        ret = ret & (key_idx.unsqueeze(0) >= ((chunk_idx - num_left_chunks) * chunk_size).unsqueeze(1))
+    return ret
+
+
 def add_optional_chunk_mask(xs: torch.Tensor,
                             masks: torch.Tensor,
                             use_dynamic_chunk: bool,
@@ -0,0 +1,110 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import logging
+import threading
+import time
+import requests
+import numpy as np
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+
+def send_request():
+    url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
+    payload = {'tts_text': args.tts_text, 'stream': args.stream}
+    files = None
+    if args.mode == 'sft':
+        payload['spk_id'] = args.spk_id
+    elif args.zero_shot_spk_id != '':
+        payload['zero_shot_spk_id'] = args.zero_shot_spk_id
+    else:
+        payload['prompt_text'] = args.prompt_text
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+    start_time = time.time()
+    response = requests.request("POST", url, data=payload, files=files, stream=True)
+    response.raise_for_status()
+    first_chunk_time, audio_bytes = None, 0
+    for r in response.iter_content(chunk_size=None):
+        if first_chunk_time is None and len(r) != 0:
+            first_chunk_time = time.time()
+        audio_bytes += len(r)
+    end_time = time.time()
+    speech_len = audio_bytes / 2 / int(response.headers['sample_rate'])
+    return first_chunk_time - start_time, (end_time - start_time) / speech_len
+
+
+def main():
+    ttfb, rtf = [], []
+    lock = threading.Lock()
+
+    def session():
+        for _ in range(args.num_requests):
+            this_ttfb, this_rtf = send_request()
+            with lock:
+                ttfb.append(this_ttfb)
+                rtf.append(this_rtf)
+    start_time = time.time()
+    threads = [threading.Thread(target=session) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    logging.info('concurrency {} stream {}: {} requests in {:.2f} s'.format(args.concurrency, args.stream, len(ttfb), time.time() - start_time))
+    for name, value in [('ttfb', ttfb), ('rtf', rtf)]:
+        logging.info('{} p50 {:.3f} p90 {:.3f} p99 {:.3f}'.format(name, *np.percentile(value, [50, 90, 99])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',
+                        type=str,
+                        default='0.0.0.0')
+    parser.add_argument('--port',
+                        type=int,
+                        default='50000')
+    parser.add_argument('--mode',
+                        default='zero_shot',
+                        choices=['sft', 'zero_shot'],
+                        help='request mode')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=10,
+                        help='number of sequential requests per client')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='request streaming synthesis')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--spk_id',
+                        type=str,
+                        default='中文女')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='speaker registered on server, prompt_wav is not uploaded when set')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='../../../asset/zero_shot_prompt.wav')
+    args = parser.parse_args()
+    main()
@@ -20,31 +20,49 @@ import numpy as np
 
 
 def main():
+    if args.mode in ['register', 'list', 'delete']:
+        url = "http://{}:{}/speakers".format(args.host, args.port)
+        if args.mode == 'register':
+            files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+            response = requests.request("POST", url, data={'zero_shot_spk_id': args.zero_shot_spk_id, 'prompt_text': args.prompt_text}, files=files)
+        elif args.mode == 'list':
+            response = requests.request("GET", url)
+        else:
+            response = requests.request("DELETE", '{}/{}'.format(url, args.zero_shot_spk_id))
+        logging.info('get response {} {}'.format(response.status_code, response.text))
+        return
     url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
     if args.mode == 'sft':
         payload = {
             'tts_text': args.tts_text,
-            'spk_id': args.spk_id
+            'spk_id': args.spk_id,
+            'stream': args.stream
         }
         response = requests.request("GET", url, data=payload, stream=True)
     elif args.mode == 'zero_shot':
         payload = {
             'tts_text': args.tts_text,
-            'prompt_text': args.prompt_text
+            'prompt_text': args.prompt_text,
+            'zero_shot_spk_id': args.zero_shot_spk_id,
+            'stream': args.stream
         }
-        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        # NOTE speaker is registered on server, no need to upload prompt_wav
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))] if args.zero_shot_spk_id == '' else None
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     elif args.mode == 'cross_lingual':
         payload = {
             'tts_text': args.tts_text,
+            'zero_shot_spk_id': args.zero_shot_spk_id,
+            'stream': args.stream
         }
-        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))] if args.zero_shot_spk_id == '' else None
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     else:
         payload = {
             'tts_text': args.tts_text,
             'spk_id': args.spk_id,
-            'instruct_text': args.instruct_text
+            'instruct_text': args.instruct_text,
+            'stream': args.stream
         }
         response = requests.request("GET", url, data=payload, stream=True)
     tts_audio = b''
@@ -52,7 +70,7 @@ def main():
         tts_audio += r
     tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
     logging.info('save response to {}'.format(args.tts_wav))
-    torchaudio.save(args.tts_wav, tts_speech, target_sr)
+    torchaudio.save(args.tts_wav, tts_speech, int(response.headers.get('sample_rate', target_sr)))
     logging.info('get response')
 
 
@@ -66,7 +84,7 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'register', 'list', 'delete'],
                         help='request mode')
     parser.add_argument('--tts_text',
                         type=str,
@@ -80,10 +98,17 @@ if __name__ == "__main__":
     parser.add_argument('--prompt_wav',
                         type=str,
                         default='../../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='speaker registered by register mode, prompt_wav is not uploaded when set')
     parser.add_argument('--instruct_text',
                         type=str,
                         default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
                                  Fights with fervor for justice, but struggles with impulsiveness.')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='receive audio chunk by chunk in streaming mode')
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import io
 import sys
 import argparse
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
@@ -25,7 +29,7 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
-from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.file_utils import PromptAudio
 
 app = FastAPI()
 # set cross region allowance
@@ -37,48 +41,123 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+async def generate_data(inference, *inference_args, **inference_kwargs):
+    """run the synchronous inference generator on executor, and bridge its audio chunks to the event loop through a bounded queue"""
+    loop = asyncio.get_running_loop()
+    chunk_queue = asyncio.Queue(maxsize=args.max_queue)
+    stop = threading.Event()
+
+    def put(item):
+        # NOTE blocks the inference thread when the queue is full, so a slow client slows down its own synthesis only
+        asyncio.run_coroutine_threadsafe(chunk_queue.put(item), loop).result()
+
+    def produce():
+        model_output = inference(*inference_args, **inference_kwargs)
+        try:
+            for i in model_output:
+                if stop.is_set():
+                    return
+                put((i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes())
+            if not stop.is_set():
+                put(None)
+        except Exception as e:
+            logging.exception('inference failed')
+            if not stop.is_set():
+                put(e)
+        finally:
+            model_output.close()
+
+    loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await chunk_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # NOTE client finished or disconnected, stop the producer and unblock its pending put
+        stop.set()
+        while not chunk_queue.empty():
+            chunk_queue.get_nowait()
+
+
+def streaming_response(inference, *inference_args, **inference_kwargs):
+    return StreamingResponse(generate_data(inference, *inference_args, **inference_kwargs),
+                             media_type='application/octet-stream',
+                             headers={'sample_rate': str(cosyvoice.sample_rate)})
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+async def inference_sft(tts_text: str = Form(), spk_id: str = Form(), stream: bool = Form(False)):
+    return streaming_response(cosyvoice.inference_sft, tts_text, spk_id, stream=stream)
+
+
+async def load_prompt_wav(prompt_wav, zero_shot_spk_id):
+    # NOTE prompt_wav is not needed when zero_shot_spk_id is registered by /speakers
+    if zero_shot_spk_id != '':
+        if zero_shot_spk_id not in cosyvoice.list_available_spks():
+            raise HTTPException(status_code=404, detail='speaker {} is not registered'.format(zero_shot_spk_id))
+        return None
+    if prompt_wav is None:
+        raise HTTPException(status_code=400, detail='prompt_wav or zero_shot_spk_id is required')
+    # NOTE decode once, pipeline_tts calls the frontend for every text segment and a stream can only be read once
+    return PromptAudio(io.BytesIO(await prompt_wav.read()))
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(''), prompt_wav: UploadFile = File(None), zero_shot_spk_id: str = Form(''),
+                              stream: bool = Form(False)):
+    prompt_wav = await load_prompt_wav(prompt_wav, zero_shot_spk_id)
+    return streaming_response(cosyvoice.inference_zero_shot, tts_text, prompt_text, prompt_wav, zero_shot_spk_id=zero_shot_spk_id, stream=stream)
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(None), zero_shot_spk_id: str = Form(''), stream: bool = Form(False)):
+    prompt_wav = await load_prompt_wav(prompt_wav, zero_shot_spk_id)
+    return streaming_response(cosyvoice.inference_cross_lingual, tts_text, prompt_wav, zero_shot_spk_id=zero_shot_spk_id, stream=stream)
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form(), stream: bool = Form(False)):
+    return streaming_response(cosyvoice.inference_instruct, tts_text, spk_id, instruct_text, stream=stream)
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
-async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File(None), zero_shot_spk_id: str = Form(''),
+                              stream: bool = Form(False)):
+    prompt_wav = await load_prompt_wav(prompt_wav, zero_shot_spk_id)
+    return streaming_response(cosyvoice.inference_instruct2, tts_text, instruct_text, prompt_wav, zero_shot_spk_id=zero_shot_spk_id, stream=stream)
+
+
+@app.post("/speakers")
+async def register_speaker(zero_shot_spk_id: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
+    prompt_wav = io.BytesIO(await prompt_wav.read())
+
+    def register():
+        cosyvoice.add_zero_shot_spk(prompt_text, prompt_wav, zero_shot_spk_id)
+        cosyvoice.save_spkinfo()
+    await asyncio.get_running_loop().run_in_executor(executor, register)
+    return {'zero_shot_spk_id': zero_shot_spk_id}
+
+
+@app.get("/speakers")
+async def list_speakers():
+    return {'spk_ids': cosyvoice.list_available_spks()}
+
+
+@app.delete("/speakers/{zero_shot_spk_id}")
+async def delete_speaker(zero_shot_spk_id: str):
+    if cosyvoice.del_zero_shot_spk(zero_shot_spk_id) is False:
+        raise HTTPException(status_code=404, detail='speaker {} is not registered'.format(zero_shot_spk_id))
+    await asyncio.get_running_loop().run_in_executor(executor, cosyvoice.save_spkinfo)
+    return {'zero_shot_spk_id': zero_shot_spk_id}
 
 
 if __name__ == '__main__':
@@ -86,10 +165,19 @@ if __name__ == '__main__':
     parser.add_argument('--port',
                         type=int,
                         default=50000)
+    parser.add_argument('--max_conc',
+                        type=int,
+                        default=4,
+                        help='number of concurrent synthesis threads')
+    parser.add_argument('--max_queue',
+                        type=int,
+                        default=8,
+                        help='number of audio chunks buffered per request before synthesis waits for the client')
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice2-0.5B',
                         help='local path or modelscope repo id')
     args = parser.parse_args()
     cosyvoice = AutoModel(model_dir=args.model_dir)
+    executor = ThreadPoolExecutor(max_workers=args.max_conc)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -30,6 +30,21 @@ from cosyvoice.utils.file_utils import load_wav
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
+        if args.mode == 'register':
+            logging.info('register speaker {}'.format(args.zero_shot_spk_id))
+            prompt_speech = load_wav(args.prompt_wav, 16000)
+            response = stub.RegisterSpeaker(cosyvoice_pb2.RegisterSpeakerRequest(zero_shot_spk_id=args.zero_shot_spk_id,
+                                                                                 prompt_text=args.prompt_text,
+                                                                                 prompt_audio=(prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()))
+            logging.info('register speaker success {}'.format(response.success))
+            return
+        if args.mode == 'list':
+            logging.info('available speakers {}'.format(list(stub.ListSpeakers(cosyvoice_pb2.ListSpeakersRequest()).spk_ids)))
+            return
+        if args.mode == 'delete':
+            response = stub.DeleteSpeaker(cosyvoice_pb2.DeleteSpeakerRequest(zero_shot_spk_id=args.zero_shot_spk_id))
+            logging.info('delete speaker {} success {}'.format(args.zero_shot_spk_id, response.success))
+            return
         request = cosyvoice_pb2.Request()
         if args.mode == 'sft':
             logging.info('send sft request')
@@ -41,16 +56,23 @@ def main():
             logging.info('send zero_shot request')
             zero_shot_request = cosyvoice_pb2.zeroshotRequest()
             zero_shot_request.tts_text = args.tts_text
-            zero_shot_request.prompt_text = args.prompt_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            if args.zero_shot_spk_id != '':
+                # NOTE speaker is registered on server, only send text
+                zero_shot_request.zero_shot_spk_id = args.zero_shot_spk_id
+            else:
+                zero_shot_request.prompt_text = args.prompt_text
+                prompt_speech = load_wav(args.prompt_wav, 16000)
+                zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
             request.zero_shot_request.CopyFrom(zero_shot_request)
         elif args.mode == 'cross_lingual':
             logging.info('send cross_lingual request')
             cross_lingual_request = cosyvoice_pb2.crosslingualRequest()
             cross_lingual_request.tts_text = args.tts_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            cross_lingual_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            if args.zero_shot_spk_id != '':
+                cross_lingual_request.zero_shot_spk_id = args.zero_shot_spk_id
+            else:
+                prompt_speech = load_wav(args.prompt_wav, 16000)
+                cross_lingual_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
             request.cross_lingual_request.CopyFrom(cross_lingual_request)
         else:
             logging.info('send instruct request')
@@ -80,7 +102,7 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'register', 'list', 'delete'],
                         help='request mode')
     parser.add_argument('--tts_text',
                         type=str,
@@ -94,6 +116,10 @@ if __name__ == "__main__":
     parser.add_argument('--prompt_wav',
                         type=str,
                         default='../../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='speaker registered by register mode, prompt_text/prompt_wav are not sent when set')
     parser.add_argument('--instruct_text',
                         type=str,
                         default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
@@ -26,6 +26,7 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.file_utils import PromptAudio
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -42,16 +43,20 @@ class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
             model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
+            # NOTE prompt_audio is not needed when zero_shot_spk_id is registered by RegisterSpeaker
+            zero_shot_spk_id = request.zero_shot_request.zero_shot_spk_id
+            self.check_speaker(zero_shot_spk_id, context)
             model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
                                                               request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+                                                              self.load_prompt_audio(request.zero_shot_request.prompt_audio),
+                                                              zero_shot_spk_id=zero_shot_spk_id)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            zero_shot_spk_id = request.cross_lingual_request.zero_shot_spk_id
+            self.check_speaker(zero_shot_spk_id, context)
+            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text,
+                                                                  self.load_prompt_audio(request.cross_lingual_request.prompt_audio),
+                                                                  zero_shot_spk_id=zero_shot_spk_id)
         else:
             logging.info('get instruct inference request')
             model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
@@ -64,6 +69,34 @@ class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
             response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
             yield response
 
+    def RegisterSpeaker(self, request, context):
+        logging.info('register speaker {}'.format(request.zero_shot_spk_id))
+        if request.zero_shot_spk_id == '' or len(request.prompt_audio) == 0:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'zero_shot_spk_id and prompt_audio are required')
+        self.cosyvoice.add_zero_shot_spk(request.prompt_text, self.load_prompt_audio(request.prompt_audio), request.zero_shot_spk_id)
+        self.cosyvoice.save_spkinfo()
+        return cosyvoice_pb2.SpeakerResponse(success=True)
+
+    def ListSpeakers(self, request, context):
+        return cosyvoice_pb2.ListSpeakersResponse(spk_ids=self.cosyvoice.list_available_spks())
+
+    def DeleteSpeaker(self, request, context):
+        logging.info('delete speaker {}'.format(request.zero_shot_spk_id))
+        success = self.cosyvoice.del_zero_shot_spk(request.zero_shot_spk_id)
+        if success is True:
+            self.cosyvoice.save_spkinfo()
+        return cosyvoice_pb2.SpeakerResponse(success=success)
+
+    def load_prompt_audio(self, prompt_audio):
+        if len(prompt_audio) == 0:
+            return None
+        prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
+        return PromptAudio(prompt_speech_16k.float() / (2**15), sample_rate=16000)
+
+    def check_speaker(self, zero_shot_spk_id, context):
+        if zero_shot_spk_id != '' and zero_shot_spk_id not in self.cosyvoice.list_available_spks():
+            context.abort(grpc.StatusCode.NOT_FOUND, 'speaker {} is not registered'.format(zero_shot_spk_id))
+
 
 def main():
     grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_conc), maximum_concurrent_rpcs=args.max_conc)